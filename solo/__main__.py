@@ -1,8 +1,15 @@
 import argparse
+import json
 import logging
 import os
+import sys
 
-from .obfuscator import Obfuscator
+from .context import random_seed
+from .obfuscator import MAX_CODE_SIZE, Obfuscator
+from .policy import Policy
+from .profiler import RunProfiler
+from .report import compare_literal_tables
+from .solidity.artifacts import load_artifact
 
 plugins = {
     "rename": {"name": "identifierRenaming", "enabled": True},
@@ -16,7 +23,9 @@ plugins = {
 
 parser = argparse.ArgumentParser()
 
-parser.add_argument("filepath", help="the path of the file to obfuscate")
+parser.add_argument(
+    "filepath", help="the paths of the files to obfuscate", nargs="+"
+)
 parser.add_argument(
     "--version", "-v", help="display version of this obfuscator", action="store_true"
 )
@@ -26,6 +35,146 @@ parser.add_argument(
 parser.add_argument(
     "--output", "-o", help="the path of the obfuscated file", metavar="out.sol"
 )
+parser.add_argument(
+    "--unchecked",
+    help="evaluate generated arithmetic in unchecked blocks to save gas",
+    action="store_true",
+)
+parser.add_argument(
+    "--share-constants",
+    help="generate repeated constants by one shared function each",
+    action="store_true",
+)
+parser.add_argument(
+    "--predicate-budget",
+    help="max gas an opaque predicate may add to a function call",
+    metavar="GAS",
+    type=int,
+)
+parser.add_argument(
+    "--predicate-inputs",
+    default="local",
+    choices=["local", "constant", "immutable"],
+    help="where the inputs of opaque predicates come from",
+)
+parser.add_argument(
+    "--literal-tables",
+    default="storage",
+    choices=["storage", "code"],
+    help="keep extracted literals in storage arrays or in pure decode functions",
+)
+parser.add_argument(
+    "--pack-literals",
+    help="pack bools, addresses and small uints extracted by dfo into shared slots",
+    action="store_true",
+)
+parser.add_argument(
+    "--shared-helpers",
+    help="generate the dfo helpers once as free functions shared by all contracts",
+    action="store_true",
+)
+parser.add_argument(
+    "--profile",
+    help="JSON call frequency or gas profile per function, hot functions are "
+    "obfuscated less, cold ones more",
+    metavar="profile.json",
+)
+parser.add_argument(
+    "--hot-threshold",
+    help="profile weight from which a function is hot, default 10%% of the max",
+    type=float,
+)
+parser.add_argument(
+    "--max-size",
+    help="runtime bytecode size budget of every contract, EIP-170 limit if no "
+    "size is given, contracts over budget are obfuscated less",
+    metavar="BYTES",
+    type=int,
+    nargs="?",
+    const=MAX_CODE_SIZE,
+)
+parser.add_argument(
+    "--max-gas",
+    help="gas budget of every external function, estimated by solc",
+    metavar="GAS",
+    type=int,
+)
+parser.add_argument(
+    "--report",
+    help="write the gas and bytecode overhead of every plugin as JSON, the "
+    "source is compiled after every plugin, files and variants are reported "
+    "by their paths",
+    metavar="report.json",
+)
+parser.add_argument(
+    "--compare-literal-tables",
+    help="obfuscate every file with dfo alone in every kind of literal tables, "
+    "compile them and write the size and gas estimates of solc as JSON",
+    metavar="tables.json",
+)
+parser.add_argument(
+    "--run-report",
+    help="write the wall time, CPU time and node counts of every phase as JSON, "
+    "aggregated over all files",
+    metavar="run.json",
+)
+parser.add_argument(
+    "--trace-memory",
+    help="record the peak memory of every phase in the run report, slow",
+    action="store_true",
+)
+parser.add_argument(
+    "--cprofile-dir",
+    help="dump the cProfile stats of every phase in this directory",
+    metavar="DIR",
+)
+parser.add_argument(
+    "--verify",
+    choices=["ast", "source", "batch"],
+    help="check that the output compiles, ast imports the syntax tree into solc "
+    "without building and parsing the source, batch compiles all outputs and "
+    "their originals in one job and compares their ABIs",
+)
+parser.add_argument(
+    "--abi-ignore-renaming",
+    help="with --verify batch, compare the ABIs modulo renaming instead of "
+    "reporting renamed external and public members",
+    action="store_true",
+)
+parser.add_argument(
+    "--artifact",
+    help="load the syntax trees from a solc standard json output, Hardhat or "
+    "Foundry build-info or Foundry artifact instead of running solc, the files "
+    "are then source unit names in it",
+    metavar="build-info.json",
+)
+parser.add_argument(
+    "--project",
+    help="drop the AST annotations the selected plugins don't read and intern "
+    "repeated strings at load time, saves memory and load time",
+    action="store_true",
+)
+parser.add_argument(
+    "--seed",
+    help="seed of the random choices, the same seed gives the same output",
+    type=int,
+)
+parser.add_argument(
+    "--variants",
+    help="obfuscate every file N times with the seeds --seed (a random one by "
+    "default) to --seed + N - 1 from one parse, outputs are "
+    "[filename].[seed].out.sol or --output with a {seed} placeholder, the seeds "
+    "are recorded in [filename].variants.json",
+    type=int,
+    metavar="N",
+)
+parser.add_argument(
+    "--variant-jobs",
+    help="build the variants in N forked processes",
+    type=int,
+    default=1,
+    metavar="N",
+)
 parser.add_argument(
     "--jobs",
     "-j",
@@ -36,28 +185,24 @@ parser.add_argument(
     action="extend",
 )
 
-args = parser.parse_args()
-
-if args.verbose == True:
-    logging.basicConfig(level=logging.DEBUG)
-else:
-    logging.basicConfig(level=logging.INFO)
-
 logger = logging.getLogger(__name__)
 
 
-def main():
-    file_name = os.path.basename(args.filepath)
-    file_dir = os.path.dirname(args.filepath)
+def main() -> int:
+    args = parser.parse_args()
 
-    # Use output_path otherwise [file_name].out.sol
-    if args.output is not None:
-        output_path = args.output
+    if args.verbose == True:
+        logging.basicConfig(level=logging.DEBUG)
     else:
-        file_base, _ = os.path.splitext(file_name)
-        output_path = file_dir + os.path.sep + file_base + ".out.sol"
+        logging.basicConfig(level=logging.INFO)
 
-    logger.debug(f"Using {output_path} as output")
+    if args.output is not None and len(args.filepath) > 1:
+        parser.error("--output can only be used with a single file")
+    if args.project and args.verify == "ast":
+        parser.error("--project can't be used with --verify ast")
+    if args.variants is not None and args.output is not None:
+        if "{seed}" not in args.output:
+            parser.error("--output needs a {seed} placeholder with --variants")
 
     # Load plugins in command line argument order
     active_plugins = []
@@ -65,10 +210,132 @@ def main():
         if plugins[j]["enabled"] is True:
             active_plugins.append(plugins[j]["name"])
 
+    # Obfuscation intensity per function, from the profile and NatSpec tags
+    if args.profile is not None:
+        policy = Policy.from_file(args.profile, hot_threshold=args.hot_threshold)
+    else:
+        policy = Policy()
+
     # Do obfuscate, see obfuscator.py
-    obfuscator = Obfuscator(verbose=args.verbose, plugins=active_plugins)
-    obfuscator.run(url=args.filepath, output=output_path)
+    # Plugin options, each plugin takes the ones its run() accepts
+    options = {
+        "unchecked": args.unchecked,
+        "share_constants": args.share_constants,
+        "predicate_budget": args.predicate_budget,
+        "predicate_inputs": args.predicate_inputs,
+        "literal_tables": args.literal_tables,
+        "pack_literals": args.pack_literals,
+        "shared_helpers": args.shared_helpers,
+        "policy": policy,
+    }
+
+    obfuscator = Obfuscator(
+        verbose=args.verbose,
+        plugins=active_plugins,
+        options=options,
+        max_size=args.max_size,
+        max_gas=args.max_gas,
+        report=args.report,
+        verify=args.verify,
+        project=args.project,
+        ignore_renaming=args.abi_ignore_renaming,
+        profiler=RunProfiler(
+            enabled=args.run_report is not None,
+            memory=args.trace_memory,
+            profile_dir=args.cprofile_dir,
+        ),
+    )
+
+    # Only the requested source units are read from the artifact
+    units = {}
+    if args.artifact is not None:
+        obfuscator.profiler.start_run(args.artifact)
+        with obfuscator.profiler.phase("load"):
+            units = load_artifact(args.artifact, args.filepath, obfuscator.fields)
+        for filepath in args.filepath:
+            if filepath not in units:
+                logger.error(f"{filepath} is not found in {args.artifact}")
+
+    # Whether --verify found problems in any output, see the exit status
+    failed = False
+    tables = {}
+    for filepath in args.filepath:
+        if args.artifact is not None and filepath not in units:
+            continue
+        if args.compare_literal_tables is not None:
+            if filepath not in units:
+                units[filepath] = obfuscator.load(filepath)
+            if units[filepath] is None:
+                continue
+            tables[filepath] = compare_literal_tables(
+                units[filepath], shared_helpers=args.shared_helpers, seed=args.seed
+            )
+        file_name = os.path.basename(filepath)
+        file_dir = os.path.dirname(filepath)
+
+        # Use output_path otherwise [file_name].out.sol
+        file_base, _ = os.path.splitext(file_name)
+        if args.output is not None:
+            output_path = args.output
+        elif args.variants is not None:
+            output_path = file_dir + os.path.sep + file_base + ".{seed}.out.sol"
+        else:
+            output_path = file_dir + os.path.sep + file_base + ".out.sol"
+
+        logger.debug(f"Using {output_path} as output")
+        if args.variants is None:
+            context = obfuscator.run(
+                url=filepath,
+                output=output_path,
+                node=units.get(filepath),
+                seed=args.seed,
+            )
+            if context is not None and len(context.errors) > 0:
+                failed = True
+            continue
+
+        # Every variant is reproducible with --seed and the same plugins. A
+        # fixed default would make every build the same and predictable
+        first = args.seed if args.seed is not None else random_seed()
+        manifest = obfuscator.variants(
+            url=filepath,
+            output=output_path,
+            seeds=list(range(first, first + args.variants)),
+            node=units.get(filepath),
+            jobs=args.variant_jobs,
+        )
+        if any(len(v["errors"]) > 0 for v in manifest):
+            failed = True
+        manifest_path = file_dir + os.path.sep + file_base + ".variants.json"
+        with open(manifest_path, "w") as fp:
+            json.dump(
+                {
+                    "source": filepath,
+                    "jobs": args.jobs,
+                    "seed": first,
+                    "variants": manifest,
+                },
+                fp,
+                indent=2,
+            )
+
+    if args.verify == "batch":
+        if len(obfuscator.verify_batch()) > 0:
+            failed = True
+
+    if args.report is not None:
+        obfuscator.dump_report()
+
+    if args.compare_literal_tables is not None:
+        with open(args.compare_literal_tables, "w") as fp:
+            json.dump(tables, fp, indent=2)
+        logger.info(f"Literal tables compared in {args.compare_literal_tables}")
+
+    if args.run_report is not None:
+        obfuscator.profiler.dump(args.run_report)
+
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,400 @@
+"""
+Throughput benchmark: generates synthetic Solidity sources of growing size,
+times every phase of the obfuscation separately (solc, AST load, each plugin,
+build) and fails if a phase stops scaling linearly or regresses against a
+saved baseline.
+
+Usage:
+
+    python -m solo.bench --sizes 1 2 4 8 --save bench.json
+    python -m solo.bench --sizes 1 2 4 8 --baseline bench.json
+    python -m solo.bench --nodes
+    python -m solo.bench --clone --functions 16 --depth 3
+"""
+
+import argparse
+import json
+import logging
+import random
+import time
+from copy import deepcopy
+
+import solcx
+
+from .obfuscator import Obfuscator
+from .solidity.nodes import (
+    Assignment,
+    BinaryOperation,
+    Block,
+    ExpressionStatement,
+    Identifier,
+    Literal,
+    SourceBuilder,
+    SourceUnit,
+)
+from .solidity.utils import from_standard_output
+
+logger = logging.getLogger(__name__)
+
+# Statements in every generated block
+BLOCK_SIZE = 3
+
+
+def literal(rng: random.Random) -> str:
+    return str(rng.choice([0, 1, 2, 10, 255, rng.randrange(2**32)]))
+
+
+def gen_expr(rng: random.Random, literals: int) -> str:
+    expr = "r"
+    for _ in range(literals):
+        expr = f"({expr} {rng.choice(['^', '&', '|'])} {literal(rng)})"
+    return expr
+
+
+def gen_block(rng: random.Random, depth: int, literals: int, indent: int) -> list:
+    pad = " " * indent
+    lines = []
+    for _ in range(BLOCK_SIZE):
+        kind = rng.choice(["assign", "if", "for"] if depth > 0 else ["assign"])
+        if kind == "assign":
+            lines.append(f"{pad}r = {gen_expr(rng, literals)};")
+        elif kind == "if":
+            lines.append(f"{pad}if (r > {literal(rng)}) {{")
+            lines += gen_block(rng, depth - 1, literals, indent + 4)
+            lines.append(f"{pad}}} else {{")
+            lines += gen_block(rng, depth - 1, literals, indent + 4)
+            lines.append(f"{pad}}}")
+        else:
+            i = f"i{depth}"
+            lines.append(f"{pad}for (uint256 {i} = 0; {i} < (a % 4); {i}++) {{")
+            lines += gen_block(rng, depth - 1, literals, indent + 4)
+            lines.append(f"{pad}}}")
+    return lines
+
+
+def generate_source(
+    contracts: int, functions: int, depth: int, literals: int, seed: int = 0
+) -> str:
+    """
+    Generate a synthetic source.
+
+    Arguments:
+        contracts: number of contracts
+        functions: functions in every contract
+        depth: nesting depth of if and for statements in every function
+        literals: literals in every expression
+        seed: seed of the generator, same arguments generate the same source
+    """
+    rng = random.Random(seed)
+    lines = ["// SPDX-License-Identifier: MIT", "pragma solidity ^0.8.28;", ""]
+    for c in range(contracts):
+        lines.append(f"contract C{c} {{")
+        lines.append(f"    uint256 s = {literal(rng)};")
+        for f in range(functions):
+            lines.append(f"    function f{f}(uint256 a) public returns (uint256){{")
+            lines.append("        uint256 r = a ^ s;")
+            lines += gen_block(rng, depth, literals, 8)
+            lines.append("        s = r;")
+            lines.append("        return r;")
+            lines.append("    }")
+        lines.append("}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def run_phases(src: str, obfuscator: Obfuscator, seed: int = 0) -> dict[str, float]:
+    """
+    Returns:
+        out: {phase: seconds}, phases are "solc", "load", every plugin by its
+            module name and "build"
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    output_json = solcx.compile_standard(
+        {
+            "language": "Solidity",
+            "sources": {"temp.sol": {"content": src}},
+            "settings": {"outputSelection": {"*": {"": ["ast"]}}},
+        }
+    )
+    timings["solc"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    root = from_standard_output(output_json)[0]
+    timings["load"] = time.perf_counter() - start
+
+    context = obfuscator.new_context(seed)
+    context.policy.assign(root)
+    for plugin in obfuscator.plugins:
+        start = time.perf_counter()
+        root = plugin.run(root, **obfuscator.plugin_options(plugin, context))
+        timings[plugin.__name__.rsplit(".", 1)[-1]] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    SourceBuilder().build(root)
+    timings["build"] = time.perf_counter() - start
+
+    return timings
+
+
+def bench(
+    sizes: list[int],
+    obfuscator: Obfuscator,
+    functions: int = 8,
+    depth: int = 2,
+    literals: int = 2,
+    repeat: int = 3,
+) -> dict:
+    """
+    Time every phase on sources of *sizes* contracts, the fastest of *repeat*
+    runs is kept.
+
+    Returns:
+        out: {size: {"bytes": source length, "phases": {phase: seconds}}}
+    """
+    results = {}
+    for size in sizes:
+        src = generate_source(size, functions, depth, literals)
+        best = {}
+        for r in range(repeat):
+            for phase, seconds in run_phases(src, obfuscator, r).items():
+                best[phase] = min(best.get(phase, seconds), seconds)
+        results[str(size)] = {"bytes": len(src), "phases": best}
+        logger.info(
+            f"{size} contracts, {len(src)} bytes: "
+            + ", ".join(f"{p} {s * 1000:.1f}ms" for p, s in best.items())
+        )
+    return results
+
+
+def bench_nodes(number: int = 10000, repeat: int = 5) -> dict[str, float]:
+    """
+    Construction cost of the nodes plugins generate, the same block is built
+    with the generic NodeBase.__init__() and with NodeBase.make(), the fastest
+    of *repeat* runs is kept.
+
+    Returns:
+        out: {"generic": microseconds per node, "make": microseconds per node}
+    """
+
+    def build(new):
+        product = new(
+            BinaryOperation,
+            operator="*",
+            leftExpression=new(Identifier, name="a"),
+            rightExpression=new(Literal, kind="number", value="3", hexValue="0x3"),
+        )
+        assignment = new(
+            Assignment,
+            leftHandSide=new(Identifier, name="s"),
+            operator="=",
+            rightHandSide=product,
+        )
+        statement = new(ExpressionStatement, expression=assignment)
+        return new(Block, statements=[statement])
+
+    constructors = {
+        "generic": lambda cls, **fields: cls(**fields),
+        "make": lambda cls, **fields: cls.make(**fields),
+    }
+    results = {}
+    for name, new in constructors.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                build(new)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        # 7 nodes per block
+        results[name] = best / number / 7 * 1e6
+    return results
+
+
+def bench_clone(root: SourceUnit, repeat: int = 5) -> dict[str, float]:
+    """
+    Copy cost of function-sized subtrees, every function of *root* is copied
+    with deepcopy() as _bind() used to do and with NodeBase.clone(), the
+    fastest of *repeat* runs is kept.
+
+    Returns:
+        out: {"deepcopy": microseconds per function, "clone": ...}
+    """
+
+    def detached_deepcopy(node):
+        # Detach the parent, otherwise the whole tree is copied
+        parent, node._parent = node._parent, None
+        try:
+            return deepcopy(node)
+        finally:
+            node._parent = parent
+
+    functions = list(root.functions)
+    copiers = {"deepcopy": detached_deepcopy, "clone": lambda node: node.clone()}
+    results = {}
+    for name, copier in copiers.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for func in functions:
+                copier(func)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results[name] = best / max(len(functions), 1) * 1e6
+    return results
+
+
+def check(
+    results: dict,
+    baseline: dict | None = None,
+    threshold: float = 0.2,
+    linearity: float = 2.0,
+    min_time: float = 0.005,
+) -> list[str]:
+    """
+    Compare the time per source byte of every phase across the sizes and with
+    the baseline, phases faster than *min_time* are too noisy to be compared.
+
+    Arguments:
+        threshold: max slowdown against the baseline, 0.2 for 20%
+        linearity: max growth of the time per byte from the smallest to the
+            largest size
+
+    Returns:
+        out: failures, empty if everything is fine
+    """
+    failures = []
+    sizes = sorted(results, key=int)
+    small, large = results[sizes[0]], results[sizes[-1]]
+    for phase, seconds in large["phases"].items():
+        if seconds < min_time or phase not in small["phases"]:
+            continue
+        growth = (seconds / large["bytes"]) / max(
+            small["phases"][phase] / small["bytes"], 1e-12
+        )
+        if growth > linearity:
+            failures.append(
+                f"{phase} doesn't scale linearly, time per byte grows {growth:.2f}x "
+                f"from {sizes[0]} to {sizes[-1]} contracts"
+            )
+
+    for size in sizes if baseline is not None else []:
+        if size not in baseline:
+            continue
+        old, new = baseline[size], results[size]
+        for phase, seconds in new["phases"].items():
+            if seconds < min_time or phase not in old["phases"]:
+                continue
+            ratio = (seconds / new["bytes"]) / (old["phases"][phase] / old["bytes"])
+            if ratio > 1 + threshold:
+                failures.append(
+                    f"{phase} regressed {(ratio - 1) * 100:.0f}% on {size} contracts"
+                )
+    return failures
+
+
+def main():
+    from .__main__ import plugins
+
+    parser = argparse.ArgumentParser(prog="python -m solo.bench")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        default=[],
+        choices=plugins.keys(),
+        help="set the plugins to execute, all of them by default",
+        nargs="*",
+        action="extend",
+    )
+    parser.add_argument(
+        "--sizes",
+        help="numbers of contracts to generate",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+    )
+    parser.add_argument(
+        "--functions", help="functions per contract", type=int, default=8
+    )
+    parser.add_argument("--depth", help="nesting depth", type=int, default=2)
+    parser.add_argument(
+        "--literals", help="literals per expression", type=int, default=2
+    )
+    parser.add_argument("--repeat", help="runs per size", type=int, default=3)
+    parser.add_argument(
+        "--nodes",
+        help="only compare the node constructors, see bench_nodes()",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--clone",
+        help="only compare deepcopy() and clone() on the functions of a "
+        "generated source, see bench_clone()",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--baseline", help="compare with saved results", metavar="bench.json"
+    )
+    parser.add_argument("--save", help="save the results", metavar="bench.json")
+    parser.add_argument(
+        "--threshold",
+        help="max slowdown against the baseline",
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument(
+        "--linearity",
+        help="max growth of the time per byte across the sizes",
+        type=float,
+        default=2.0,
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.nodes:
+        results = bench_nodes()
+        logger.info(
+            f"Generic {results['generic']:.2f}us per node, "
+            f"make() {results['make']:.2f}us per node"
+        )
+        return 0
+
+    if args.clone:
+        src = generate_source(1, args.functions, args.depth, args.literals)
+        output_json = solcx.compile_standard(
+            {
+                "language": "Solidity",
+                "sources": {"temp.sol": {"content": src}},
+                "settings": {"outputSelection": {"*": {"": ["ast"]}}},
+            }
+        )
+        results = bench_clone(from_standard_output(output_json)[0])
+        logger.info(
+            f"deepcopy() {results['deepcopy']:.1f}us per function, "
+            f"clone() {results['clone']:.1f}us per function"
+        )
+        return 0
+
+    jobs = args.jobs or list(plugins.keys())
+    obfuscator = Obfuscator(plugins=[plugins[j]["name"] for j in jobs])
+    results = bench(
+        args.sizes, obfuscator, args.functions, args.depth, args.literals, args.repeat
+    )
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)
+    if args.save is not None:
+        with open(args.save, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+    failures = check(results, baseline, args.threshold, args.linearity)
+    for failure in failures:
+        logger.error(failure)
+    return 1 if len(failures) > 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,57 @@
+import random
+
+from .policy import Policy
+
+
+def random_seed() -> int:
+    """A seed nobody can guess, for jobs that aren't given one."""
+    return random.SystemRandom().randrange(2**32)
+
+
+class Context:
+    """
+    State of one obfuscation job. A fresh context for every job keeps the jobs
+    independent, so that a long-lived process doesn't carry names or caches
+    from one job over to the next.
+
+    Nothing here is global, so jobs can run one after another or interleaved
+    in the same process and each is still reproduced by its seed.
+
+    Plugins get the context of the running job as the "context" option, see
+    Obfuscator.plugin_options().
+
+    Arguments:
+        seed(int): seed of the random choices, a random one is drawn if None,
+            it's recorded either way so that the job can be reproduced
+        policy(Policy): profile and thresholds of the job, it gets its own
+            copy of the levels and back-off steps, see Policy.job()
+
+    Attributes:
+        random: generator of all random choices of the job
+        leaves: shared leaves of the job, see utils.LEAF()
+        replacements: {original name: new name} given by identifierRenaming
+        errors: error messages of the verification
+        gas_report: stage costs, shared by the jobs of a run and kept by unit,
+            None if not reported
+        verifier: collects the outputs of the job to compile them in a batch,
+            None if not verified that way
+    """
+
+    def __init__(self, seed: int | None = None, policy: Policy | None = None):
+        if seed is None:
+            seed = random_seed()
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.leaves = {}
+        self.policy = policy.job() if policy is not None else Policy()
+        self.replacements: dict[str, str] = {}
+        self.errors: list[str] = []
+        self.gas_report = None
+        self.verifier = None
+
+    def to_dict(self) -> dict:
+        return {
+            "seed": self.seed,
+            "replacements": self.replacements,
+            "errors": self.errors,
+        }
@@ -0,0 +1,472 @@
+"""
+Differential execution harness: deploys the original and the obfuscated
+contracts side by side on an in-process EVM, replays the same calls on both,
+checks that the results and the observable state match, and records the gas
+each call really uses.
+
+Requires web3 and eth-tester with the py-evm backend, both are in
+requirements.txt:
+
+    pip install -r requirements.txt
+
+Usage:
+
+    python -m solo.harness tests/ERC20.sol -j cff const dfo --calls 200
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import random
+
+import solcx
+
+from .obfuscator import Obfuscator
+from .solidity.nodes import SourceBuilder, SourceUnit
+
+logger = logging.getLogger(__name__)
+
+try:
+    from web3 import Web3, EthereumTesterProvider
+    from web3.exceptions import ContractLogicError
+except ImportError:
+    Web3 = None
+
+
+def compile_contracts(src: str) -> dict[str, dict]:
+    """
+    Returns:
+        out: {contract name: {"abi": abi, "bytecode": creation bytecode}}
+    """
+    solc_options = {
+        "language": "Solidity",
+        "sources": {"temp.sol": {"content": src}},
+        "settings": {
+            "outputSelection": {"*": {"*": ["abi", "evm.bytecode.object"]}}
+        },
+    }
+    output_json = solcx.compile_standard(solc_options)
+    return {
+        name: {"abi": c["abi"], "bytecode": c["evm"]["bytecode"]["object"]}
+        for name, c in output_json["contracts"]["temp.sol"].items()
+    }
+
+
+def random_value(abi_type: str, rng: random.Random, accounts: list):
+    """A random argument of *abi_type*, biased to the edge cases."""
+    if abi_type.endswith("]"):
+        item_type, _, length = abi_type[:-1].rpartition("[")
+        n = int(length) if length != "" else rng.randrange(4)
+        return [random_value(item_type, rng, accounts) for _ in range(n)]
+    if abi_type.startswith("uint"):
+        bits = int(abi_type[4:] or 256)
+        return rng.choice([0, 1, rng.randrange(256), rng.randrange(2**bits)])
+    if abi_type.startswith("int"):
+        bits = int(abi_type[3:] or 256)
+        return rng.choice(
+            [0, -1, 1, rng.randrange(-(2 ** (bits - 1)), 2 ** (bits - 1))]
+        )
+    if abi_type == "address":
+        return rng.choice(accounts)
+    if abi_type == "bool":
+        return rng.random() < 0.5
+    if abi_type == "string":
+        return "".join(rng.choice("abcdef") for _ in range(rng.randrange(8)))
+    if abi_type == "bytes":
+        return rng.randbytes(rng.randrange(40))
+    if abi_type.startswith("bytes"):
+        return rng.randbytes(int(abi_type[5:]))
+    raise ValueError(f"Unsupported ABI type {abi_type}")
+
+
+def key_values(abi_type: str, accounts: list) -> list | None:
+    """
+    Keys a getter taking *abi_type* is called with to read the state, e.g.
+    balanceOf(account), None if the type isn't a key.
+    """
+    if abi_type == "address":
+        return list(accounts)
+    if abi_type.startswith(("uint", "int")):
+        return [0, 1]
+    if abi_type == "bool":
+        return [False, True]
+    return None
+
+
+# Max calls of a getter with keys, e.g. allowance(a, b) of 4 accounts
+MAX_GETTER_CALLS = 16
+
+
+def signature(name: str, entry: dict) -> str:
+    return f"{name}({','.join(i['type'] for i in entry['inputs'])})"
+
+
+class Side:
+    """
+    A deployed contract, either the original or the obfuscated one, *args*
+    and *tx* are the constructor arguments and transaction.
+    """
+
+    def __init__(
+        self,
+        w3,
+        abi: list,
+        bytecode: str,
+        names: dict[str, str],
+        args: list = [],
+        tx: dict | None = None,
+    ):
+        self.w3 = w3
+        self.names = names  # {original name: deployed name}
+        factory = w3.eth.contract(abi=abi, bytecode=bytecode)
+        receipt = w3.eth.wait_for_transaction_receipt(
+            factory.constructor(*args).transact(tx or {"from": w3.eth.accounts[0]})
+        )
+        self.address = receipt.contractAddress
+        self.instance = w3.eth.contract(address=self.address, abi=abi)
+        self.deploy_gas = receipt.gasUsed
+
+    def function(self, name: str, entry: dict):
+        sig = signature(self.names.get(name, name), entry)
+        return self.instance.get_function_by_signature(sig)
+
+    def call(self, name: str, entry: dict, args: list, tx: dict) -> tuple:
+        """
+        Returns:
+            out: (result, gas), result is ("revert",) if the call reverts and
+                gas is None for view functions
+        """
+        fn = self.function(name, entry)(*args)
+        try:
+            result = fn.call(tx)
+        except ContractLogicError:
+            return ("revert",), None
+        if entry["stateMutability"] in ("view", "pure"):
+            return result, None
+        receipt = self.w3.eth.wait_for_transaction_receipt(fn.transact(tx))
+        return result, receipt.gasUsed
+
+    def state(self, getters: list[tuple[dict, list]]) -> dict:
+        """
+        Observable state, the balance and the outputs of all getters, each one
+        called with its arguments, see Harness.getters().
+        """
+        state = {"balance": self.w3.eth.get_balance(self.address)}
+        for entry, args in getters:
+            key = f"{entry['name']}({', '.join(repr(a) for a in args)})"
+            try:
+                state[key] = self.function(entry["name"], entry)(*args).call()
+            except ContractLogicError:
+                state[key] = ("revert",)
+        return state
+
+
+class Harness:
+    """
+    Arguments:
+        original(SourceUnit): the source before obfuscation
+        obfuscated(SourceUnit): the same source after obfuscation, contracts
+            are matched by order, functions by solc AST ids
+    """
+
+    def __init__(self, original: SourceUnit, obfuscated: SourceUnit):
+        if Web3 is None:
+            raise ImportError('The harness needs web3, pip install "web3[tester]"')
+
+        self.w3 = Web3(EthereumTesterProvider())
+        builder = SourceBuilder()
+        self.original = compile_contracts(builder.build(original))
+        self.obfuscated = compile_contracts(builder.build(obfuscated))
+
+        self.pairs = {}  # {original contract name: (obfuscated name, names)}
+        functions = {f.id: f.name for f in obfuscated.functions if hasattr(f, "id")}
+        variables = {}
+        for contract in obfuscated.contracts:
+            for n in contract:
+                if hasattr(n, "id") and hasattr(n, "name"):
+                    variables[n.id] = n.name
+
+        for old, new in zip(original.contracts, obfuscated.contracts):
+            names = {}
+            for n in old:
+                if not hasattr(n, "id"):
+                    continue
+                if n.id in functions:
+                    names[n.name] = functions[n.id]
+                elif n.id in variables:
+                    names[n.name] = variables[n.id]
+            self.pairs[old.name] = (new.name, names)
+
+        self.results = {}
+        self.mismatches = []
+        self.replayed = 0  # calls replayed on both sides
+
+    def deployable(self) -> list[str]:
+        """Contracts that can be deployed, i.e. that have bytecode."""
+        deployable = []
+        for name in self.pairs:
+            compiled = self.original.get(name)
+            if compiled is None or compiled["bytecode"] == "":
+                continue
+            deployable.append(name)
+        return deployable
+
+    def constructor_call(self, name: str, calls: list[dict], seed: int = 0) -> dict:
+        """
+        The constructor call of *name*, the one recorded in *calls* as
+        {"contract", "function": "constructor", "args", "sender", "value"} or
+        one with random arguments.
+        """
+        for call in calls:
+            if call["contract"] == name and call["function"] == "constructor":
+                return call
+        rng = random.Random(seed)
+        accounts = self.w3.eth.accounts[:4]
+        inputs = [
+            i
+            for e in self.original[name]["abi"]
+            if e["type"] == "constructor"
+            for i in e["inputs"]
+        ]
+        return {
+            "contract": name,
+            "function": "constructor",
+            "args": [random_value(i["type"], rng, accounts) for i in inputs],
+        }
+
+    def getters(self, entries: list[dict]) -> list[tuple[dict, list]]:
+        """
+        Calls of the view functions that read the state: the ones without
+        arguments, and the ones taking keys (see key_values()) called with
+        every combination of the known accounts and key values.
+        """
+        accounts = self.w3.eth.accounts[:4]
+        getters = []
+        for entry in entries:
+            if entry["stateMutability"] not in ("view", "pure"):
+                continue
+            values = [key_values(i["type"], accounts) for i in entry["inputs"]]
+            if any(v is None for v in values):
+                continue
+            combinations = itertools.product(*values)
+            for args in itertools.islice(combinations, MAX_GETTER_CALLS):
+                getters.append((entry, list(args)))
+        return getters
+
+    def random_calls(self, name: str, n: int, seed: int = 0) -> list[dict]:
+        """Generate *n* random calls of the non-view functions of *name*."""
+        rng = random.Random(seed)
+        accounts = self.w3.eth.accounts[:4]
+        entries = [
+            e
+            for e in self.original[name]["abi"]
+            if e["type"] == "function"
+            and e["stateMutability"] not in ("view", "pure")
+            and "tuple" not in signature(e["name"], e)
+        ]
+        if len(entries) == 0:
+            return []
+
+        calls = []
+        for _ in range(n):
+            entry = rng.choice(entries)
+            calls.append(
+                {
+                    "contract": name,
+                    "function": signature(entry["name"], entry),
+                    "args": [
+                        random_value(i["type"], rng, accounts) for i in entry["inputs"]
+                    ],
+                    "sender": rng.randrange(len(accounts)),
+                    "value": (
+                        rng.choice([0, 10**15])
+                        if entry["stateMutability"] == "payable"
+                        else 0
+                    ),
+                }
+            )
+        return calls
+
+    def replay(self, name: str, calls: list[dict], constructor: dict | None = None):
+        """
+        Deploy both versions of *name* with the *constructor* call and replay
+        *calls* on them, the results and the state are compared after every
+        call. Constructor calls in *calls* are not replayed.
+        """
+        new_name, names = self.pairs[name]
+        abi = self.original[name]["abi"]
+        entries = [e for e in abi if e["type"] == "function"]
+        by_signature = {signature(e["name"], e): e for e in entries}
+        by_name = {e["name"]: e for e in entries}
+        getters = self.getters(list(by_signature.values()))
+
+        accounts = self.w3.eth.accounts
+        if constructor is None:
+            constructor = self.constructor_call(name, calls)
+        args = constructor.get("args", [])
+        tx = {
+            "from": accounts[constructor.get("sender", 0)],
+            "value": constructor.get("value", 0),
+        }
+        original = Side(self.w3, abi, self.original[name]["bytecode"], {}, args, tx)
+        obfuscated = Side(
+            self.w3,
+            self.obfuscated[new_name]["abi"],
+            self.obfuscated[new_name]["bytecode"],
+            names,
+            args,
+            tx,
+        )
+
+        result = self.results.setdefault(
+            name,
+            {
+                "deploy": {"original": 0, "obfuscated": 0},
+                "functions": {},
+            },
+        )
+        result["deploy"]["original"] = original.deploy_gas
+        result["deploy"]["obfuscated"] = obfuscated.deploy_gas
+
+        for i, call in enumerate(calls):
+            function = call["function"]
+            if function == "constructor":
+                continue
+            entry = by_signature.get(function) or by_name.get(function)
+            if entry is None:
+                raise ValueError(f"Unknown function {function} of {name}")
+
+            tx = {
+                "from": accounts[call.get("sender", 0)],
+                "value": call.get("value", 0),
+            }
+            args = call.get("args", [])
+            expected, gas = original.call(entry["name"], entry, args, tx)
+            actual, obfuscated_gas = obfuscated.call(entry["name"], entry, args, tx)
+
+            if expected != actual:
+                self.mismatch(name, i, call, "result", expected, actual)
+            expected, actual = original.state(getters), obfuscated.state(getters)
+            if expected != actual:
+                self.mismatch(name, i, call, "state", expected, actual)
+            self.replayed += 1
+
+            if gas is None or obfuscated_gas is None:
+                continue
+            stats = result["functions"].setdefault(
+                signature(entry["name"], entry),
+                {"calls": 0, "original": 0, "obfuscated": 0},
+            )
+            stats["calls"] += 1
+            stats["original"] += gas
+            stats["obfuscated"] += obfuscated_gas
+
+    def mismatch(self, name: str, i: int, call: dict, what: str, expected, actual):
+        logger.error(
+            f"{name}: {what} of call #{i} {call['function']} differs, "
+            f"expected {expected}, got {actual}"
+        )
+        self.mismatches.append(
+            {
+                "contract": name,
+                "call": i,
+                "function": call["function"],
+                "what": what,
+                "expected": repr(expected),
+                "actual": repr(actual),
+            }
+        )
+
+    def report(self) -> dict:
+        for result in self.results.values():
+            for stats in result["functions"].values():
+                stats["overhead"] = stats["obfuscated"] - stats["original"]
+        return {
+            "replayed": self.replayed,
+            "contracts": self.results,
+            "mismatches": self.mismatches,
+        }
+
+
+def main():
+    from .__main__ import plugins
+
+    parser = argparse.ArgumentParser(prog="python -m solo.harness")
+    parser.add_argument("filepath", help="the path of the file to obfuscate")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        default=[],
+        choices=plugins.keys(),
+        help="set the plugins to execute",
+        nargs="*",
+        action="extend",
+    )
+    parser.add_argument(
+        "--calls", help="random calls per contract", type=int, default=100
+    )
+    parser.add_argument("--seed", help="seed of the random calls", type=int, default=0)
+    parser.add_argument(
+        "--sequence",
+        help='recorded calls as JSON, [{"contract", "function", "args", '
+        '"sender", "value"}], used instead of random calls. A call of the '
+        '"constructor" function gives the constructor arguments, they are '
+        "random otherwise",
+        metavar="calls.json",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="write the gas and mismatches as JSON",
+        metavar="out.json",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    obfuscator = Obfuscator(plugins=[plugins[j]["name"] for j in args.jobs])
+    original = obfuscator.load(args.filepath)
+    if original is None:
+        return 1
+    obfuscated = obfuscator.obfuscate(original.clone())
+
+    harness = Harness(original, obfuscated)
+    sequence = None
+    if args.sequence is not None:
+        with open(args.sequence, "r") as fp:
+            sequence = json.load(fp)
+    for name in harness.deployable():
+        if sequence is not None:
+            calls = [c for c in sequence if c["contract"] == name]
+        else:
+            calls = harness.random_calls(name, args.calls, args.seed)
+        try:
+            constructor = harness.constructor_call(name, calls, args.seed)
+            harness.replay(name, calls, constructor)
+        except ValueError as e:
+            logger.error(f"Cannot replay {name}: {e}")
+
+    report = harness.report()
+    for name, result in report["contracts"].items():
+        for sig, stats in result["functions"].items():
+            logger.info(
+                f"{name}.{sig}: {stats['calls']} calls, {stats['original']} -> "
+                f"{stats['obfuscated']} gas ({stats['overhead']:+})"
+            )
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if len(report["mismatches"]) > 0:
+        logger.error(f"{len(report['mismatches'])} mismatches found")
+        return 1
+    # Nothing compared is not a pass
+    if harness.replayed == 0:
+        logger.error("No call was replayed")
+        return 1
+    logger.info(f"{harness.replayed} calls replayed, no mismatch")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
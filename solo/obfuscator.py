@@ -1,11 +1,20 @@
+import hashlib
+import inspect
 import logging
+import multiprocessing
 import time
+from copy import deepcopy
 from importlib import import_module
 from packaging import version
 
 import solcx
 
-from .solidity.nodes import SourceBuilder
+from .context import Context
+from .policy import Policy
+from .profiler import RunProfiler
+from .verify import BatchVerifier, verify_ast, verify_source
+from .report import GasReport, compile_source
+from .solidity.nodes import NodeBase, SourceBuilder, SourceUnit
 from .solidity.utils import from_standard_output
 
 logger = logging.getLogger(__name__)
@@ -17,70 +26,574 @@ REQUIRED_SOLC_VER = "0.8.28"
 try:
     solc_ver = solcx.get_solc_version()
 except Exception as e:
+    # Trees can still be loaded from standard json outputs and artifacts
+    solc_ver = None
     logger.error("solc is not found on your system.")
 
 required_ver = version.parse(REQUIRED_SOLC_VER)
 
-if solc_ver < required_ver:
+if solc_ver is not None and solc_ver < required_ver:
     logger.warning(
         f"Your solc version {str(solc_ver)} is smaller than "
         f"{str(REQUIRED_SOLC_VER)}, the output could be wrong!"
     )
 
+# EIP-170 runtime bytecode size limit
+MAX_CODE_SIZE = 24576
+
+
+def walk(root: NodeBase) -> "Generator[NodeBase]":
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        yield node
+        stack.extend(node._children)
+
 
 class Obfuscator:
 
-    def __init__(self, verbose=False, plugins: list = []):
+    def __init__(
+        self,
+        verbose=False,
+        plugins: list = [],
+        options: dict = {},
+        max_size: int | None = None,
+        max_gas: int | None = None,
+        report: str | None = None,
+        profiler: RunProfiler | None = None,
+        verify: str | None = None,
+        project: bool = False,
+        ignore_renaming: bool = False,
+    ):
         self.verbose = verbose
-        self.plugins = set()
+        self.options = options
+        self.plugins = []
+
+        # Budget of every contract, checked after the output is built
+        self.max_size = max_size
+        self.max_gas = max_gas
+        if self.options.get("policy") is None:
+            self.options = {**options, "policy": Policy()}
+
+        # Path of the JSON gas report, the source is compiled after every
+        # plugin if it's set. The report of run() and variants() collects all
+        # files of the run, see dump_report()
+        self.report = report
+        self.gas_report = GasReport() if report is not None else None
 
+        # Check that the output compiles, "ast" imports the tree into solc
+        # before it's built, "source" compiles the built source, "batch"
+        # compiles all outputs of the run in one job, see verify_batch()
+        if verify not in (None, "ast", "source", "batch"):
+            raise ValueError(f"Unknown verification mode {verify}")
+        self.verify = verify
+        self.ignore_renaming = ignore_renaming
+        # Outputs of run() and variants(), see verify_batch()
+        self.verifier = None
+        if verify == "batch":
+            self.verifier = BatchVerifier(ignore_renaming=ignore_renaming)
+
+        # Drop the AST annotations no plugin reads at load time, see fields.
+        # solc can't import projected trees, they lack members it requires
+        if project and verify == "ast":
+            raise ValueError("Projected trees can't be verified as ASTs")
+        self.project = project
+
+        # Hooks around every phase, they do nothing unless a profiler is given
+        self.profiler = profiler if profiler is not None else RunProfiler(False)
+
+        # Plugins run in the given order, each one once
         for name in plugins:
             if name not in dir():
                 plugin = import_module(name=".plugins." + name, package=__package__)
-                self.plugins.add(plugin)
             else:
-                self.plugins.add(dir()[name])
+                plugin = dir()[name]
+            if plugin not in self.plugins:
+                self.plugins.append(plugin)
 
             logger.debug(f"Loaded plugin {name}.")
 
-    def run(self, url: str, output: str):
+    @property
+    def fields(self) -> set | None:
+        """
+        AST annotations the run needs, documentation for the NatSpec tags of
+        the policy and the ones the plugins declare in FIELDS. None keeps all
+        of them, so does a plugin that declares nothing.
+        """
+        if not self.project:
+            return None
+        fields = {"documentation"}
+        for plugin in self.plugins:
+            if not hasattr(plugin, "FIELDS"):
+                return None
+            fields |= plugin.FIELDS
+        return fields
+
+    def new_context(self, seed: int | None = None) -> Context:
+        """
+        A context for one job, with its own copy of the policy. The outputs are
+        reported and verified with the ones of the run.
+        """
+        context = Context(seed, self.options["policy"])
+        context.gas_report = self.gas_report
+        context.verifier = self.verifier
+        return context
+
+    def plugin_options(self, plugin, context: Context | None = None) -> dict:
+        """
+        Pick the options that *plugin.run()* accepts as keyword arguments, the
+        context of the job is the "context" option and its policy is the
+        "policy" option.
+        """
+        params = inspect.signature(plugin.run).parameters
+        options = {**self.options, "context": context}
+        if context is not None:
+            options["policy"] = context.policy
+        return {k: v for k, v in options.items() if k in params}
+
+    def obfuscate(
+        self,
+        root: SourceUnit,
+        context: Context | None = None,
+        unit: str = "temp.sol",
+    ) -> SourceUnit:
+        """Run the plugins on *root*, its stages are reported as *unit*."""
+        if context is None:
+            context = self.new_context()
+        context.policy.assign(root)
+        gas_report, verifier = context.gas_report, context.verifier
+        if gas_report is not None:
+            gas_report.original(root, unit)
+
+        # We are calling plugins.plugin_name.run()
+        for plugin in self.plugins:
+            name = plugin.__name__.rsplit(".", 1)[-1]
+            if verifier is not None:
+                before = set(walk(root))
+            with self.profiler.phase(name, root) as phase:
+                root = plugin.run(root, **self.plugin_options(plugin, context))
+                phase.result(root)
+            if verifier is not None:
+                # Tag the new nodes with the plugin, see BatchVerifier.locate()
+                for n in walk(root):
+                    if n not in before:
+                        n.__dict__["_plugin"] = name
+            if gas_report is not None:
+                gas_report.stage(name, root)
+        return root
+
+    def over_budget(self, stats: dict, baseline: dict) -> dict[str, str]:
+        """
+        Check the compiled contracts against the budget.
+
+        Arguments:
+            stats: output of compile_source() on the obfuscated source
+            baseline: the same of the original source, by the same names
+
+        Returns:
+            out: {contract name: reason} of contracts over budget
+        """
+        over = {}
+        for name, stat in stats.items():
+            if self.max_size is not None and stat["size"] > self.max_size:
+                over[name] = f"runtime size {stat['size']} > {self.max_size} bytes"
+                continue
+            if self.max_gas is None:
+                continue
+            for sig, gas in stat["external"].items():
+                base = baseline.get(name, {}).get("external", {}).get(sig)
+                if gas is None and base is not None:
+                    # Bounded before, unbounded now, e.g. a flattened loop
+                    over[name] = f"{sig} gas is unbounded, {base} before"
+                    break
+                if gas is not None and gas > self.max_gas:
+                    over[name] = f"{sig} gas {gas} > {self.max_gas}"
+                    break
+        return over
+
+    def enforce_budget(
+        self,
+        original: SourceUnit,
+        root: SourceUnit,
+        context: Context | None = None,
+        unit: str = "temp.sol",
+    ) -> SourceUnit:
+        """
+        Back off the obfuscation intensity of contracts over budget and run the
+        plugins again on a fresh copy of *original* until every contract fits.
+        Contracts are renamed by the plugins, so they're matched by order.
+        """
+        if context is None:
+            context = self.new_context()
+        builder = SourceBuilder()
+        policy: Policy = context.policy
+
+        try:
+            baseline = compile_source(builder.build(original))
+        except Exception as e:
+            logger.error(f"Cannot compile the original source, budget skipped.\n{e}")
+            return root
+
+        # Terminates, every contract can only be backed off a few levels
+        while True:
+            try:
+                stats = compile_source(builder.build(root))
+            except Exception as e:
+                logger.error(f"Cannot compile the output, budget skipped.\n{e}")
+                return root
+            names = {
+                new.name: old for new, old in zip(root.contracts, original.contracts)
+            }
+            baseline_stats = {
+                new: baseline.get(old.name, {}) for new, old in names.items()
+            }
+            over = self.over_budget(stats, baseline_stats)
+            if len(over) == 0:
+                return root
+
+            backed_off = False
+            for name, reason in over.items():
+                contract = names[name]
+                given_up = policy.back_off(contract)
+                if len(given_up) == 0:
+                    continue
+                backed_off = True
+                logger.info(
+                    f"{contract.name} is over budget ({reason}), giving up: "
+                    + ", ".join(given_up)
+                )
+
+            if not backed_off:
+                break
+            root = self.obfuscate(original.clone(), context, unit)
+
+        for name, reason in over.items():
+            logger.warning(
+                f"{names[name].name} is still over budget ({reason}) with the "
+                "lowest intensity"
+            )
+        return root
+
+    def report_errors(self, errors: list[str]):
+        if len(errors) == 0:
+            logger.debug("The output compiles")
+        for error in errors:
+            logger.error(f"The output doesn't compile:\n{error}")
+
+    @staticmethod
+    def describe_problem(problem: dict) -> str:
+        """A problem found by BatchVerifier with where it comes from."""
+        where = ", ".join(
+            f"{k} {problem[k]}" for k in ("file", "contract", "plugin") if problem[k]
+        )
+        return f"{where}: {problem['message']}"
+
+    def verify_batch(self, verifier: BatchVerifier | None = None) -> list[dict]:
+        """
+        Compile all outputs collected so far in one solc job, see BatchVerifier.
+        The outputs of run() and variants() are collected by default, pass the
+        *verifier* of a context for its outputs only.
+
+        Returns:
+            out: problems found
+        """
+        if verifier is None:
+            verifier = self.verifier
+        if verifier is None:
+            return []
+        with self.profiler.phase("verify"):
+            problems = verifier.run()
+        for p in problems:
+            logger.error(self.describe_problem(p))
+        if len(problems) == 0:
+            logger.info(f"All {len(verifier.entries)} outputs compile")
+        verifier.entries.clear()
+        return problems
+
+    def compile(self, solc_options: dict) -> list[SourceUnit] | None:
+        """Run solc on a standard json input and load the syntax trees."""
         solc_options = {
-            "language": "Solidity",
-            "sources": {"temp.sol": {"urls": [url]}},
+            **solc_options,
             "settings": {"outputSelection": {"*": {"": ["ast"]}}},
         }
-
         logger.debug(f"Using solc standard json input {solc_options}.")
 
         try:
-            output_json = solcx.compile_standard(solc_options)
+            with self.profiler.phase("compile"):
+                output_json = solcx.compile_standard(solc_options)
         except Exception as e:
-            logger.error(f"Compilation error, check your input file path.\n{e}")
-            return
+            logger.error(f"Compilation error, check your input.\n{e}")
+            return None
 
-        # TODO: obfuscate all sources under a directory
-        nodes = from_standard_output(output_json)
+        with self.profiler.phase("load") as phase:
+            nodes = from_standard_output(output_json, self.fields)
+            phase.result(nodes[0])
         logger.debug(f"Get {nodes} from source.")
-        node = nodes[0]
+        return nodes
 
-        start_time = time.time()
-        logger.debug(
-            f"Obfuscation starts at {time.asctime(time.localtime(start_time))}."
+    def load(self, url: str) -> SourceUnit | None:
+        """Compile the file at *url* and return its syntax tree."""
+        # TODO: obfuscate all sources under a directory
+        nodes = self.compile(
+            {"language": "Solidity", "sources": {"temp.sol": {"urls": [url]}}}
         )
+        return nodes[0] if nodes is not None else None
 
-        root = node
+    def transform(
+        self,
+        url: str,
+        node: SourceUnit,
+        context: Context | None = None,
+        original_src: str | None = None,
+        unit: str | None = None,
+    ) -> str:
+        """
+        Obfuscate a loaded syntax tree and build the source.
 
-        # We are calling plugins.plugin_name.run()
-        for plugin in self.plugins:
-            root = plugin.run(root)
+        Arguments:
+            url: the file the tree is loaded from, for the verification
+            context: the job, errors of the verification are recorded in it
+            original_src: the original source, read from *url* if needed and
+                not given
+            unit: name of the output in the gas report, *url* by default
+        """
+        if context is None:
+            context = self.new_context()
+        if unit is None:
+            unit = url
+
+        # Levels and back-off steps are per tree, ids repeat across files
+        context.policy.reset()
+
+        # Original names of the contracts and their members, for verify_batch()
+        names = {}
+        if context.verifier is not None:
+            for contract in node.contracts:
+                for n in (contract, *contract):
+                    if hasattr(n, "id") and hasattr(n, "name"):
+                        names[n.id] = n.name
+
+        budgeted = self.max_size is not None or self.max_gas is not None
+        original = node.clone() if budgeted else None
+
+        root = self.obfuscate(node, context, unit)
+        if budgeted:
+            root = self.enforce_budget(original, root, context, unit)
+
+        if self.verify == "ast":
+            with self.profiler.phase("verify"):
+                errors = verify_ast(root)
+            context.errors += errors
+            self.report_errors(errors)
 
         # Convert and compress to source code
-        builder = SourceBuilder(verbose=self.verbose, indent=4)
+        builder = SourceBuilder(
+            verbose=self.verbose, indent=4, source_map=context.verifier is not None
+        )
         logger.debug("Converting syntax tree to source")
-        src = builder.build(root)
+        with self.profiler.phase("build", root):
+            src = builder.build(root)
+
+        if context.verifier is not None:
+            context.verifier.add(
+                url, src, root, builder.positions, names, original_src
+            )
+
+        if self.verify == "source":
+            with self.profiler.phase("verify"):
+                errors = verify_source(src)
+            context.errors += errors
+            self.report_errors(errors)
+        return src
+
+    def run(
+        self,
+        url: str,
+        output: str,
+        node: SourceUnit | None = None,
+        seed: int | None = None,
+    ) -> Context | None:
+        """
+        Obfuscate the file at *url* and write the result to *output*, *node*
+        is its syntax tree if it has been loaded already, e.g. from a build
+        artifact, then solc is not run. The same *seed* gives the same output.
+
+        Returns:
+            out: the context of the job, None if the file doesn't compile
+        """
+        self.profiler.start_run(url)
+        if node is None:
+            node = self.load(url)
+        if node is None:
+            return None
+
+        start_time = time.time()
+        logger.debug(
+            f"Obfuscation starts at {time.asctime(time.localtime(start_time))}."
+        )
+
+        context = self.new_context(seed)
+        src = self.transform(url, node, context)
 
         with open(output, "w") as fp:
             fp.write(src)
 
         elapsed = time.time() - start_time
         logger.debug(f"Obfuscation done! Time elapsed: {elapsed:.8f}s.")
+        return context
+
+    def variant(
+        self, url: str, node: SourceUnit, seed: int, unit: str | None = None
+    ) -> tuple[str, list[str]]:
+        """
+        Obfuscate a copy of *node* with *seed*, *node* is left untouched. The
+        variant is reported as *unit*, see transform().
+
+        Returns:
+            out: the source and the errors of its verification
+        """
+        context = self.new_context(seed)
+        src = self.transform(url, node.clone(), context, unit=unit)
+        return src, context.errors
+
+    def dump_report(self):
+        """Write the gas report of all files of the run to *report*."""
+        if self.gas_report is not None:
+            self.gas_report.dump(self.report)
+
+    def obfuscate_source(
+        self, source: str | dict, seed: int | None = None, name: str = "temp.sol"
+    ) -> dict | None:
+        """
+        Obfuscate in memory, no file is read or written, for embedding the
+        obfuscator in a long-lived process. Nothing is kept from one call to
+        the next, batch verification compiles the outputs of this call only.
+        *source* is left untouched, so the same input can be passed again.
+
+        Arguments:
+            source: Solidity source text named *name*, a solc standard json
+                input, or a standard json output with the ASTs of the sources
+            seed: seed of the random choices, see Context
+
+        Returns:
+            out: {"sources": {source unit name: obfuscated source}, "seed",
+                "replacements", "errors"} and the gas "report" if reporting,
+                None if the input doesn't compile
+        """
+        if isinstance(source, str):
+            source = {"language": "Solidity", "sources": {name: {"content": source}}}
+
+        sources = source.get("sources", {})
+        if all("ast" in s for s in sources.values()):
+            # Loading consumes the ASTs, the caller may pass the same input
+            # again
+            with self.profiler.phase("load"):
+                nodes = from_standard_output(deepcopy(source), self.fields)
+        else:
+            nodes = self.compile(source)
+        if nodes is None:
+            return None
+
+        # One context for all units, so that they're renamed consistently
+        context = self.new_context(seed)
+        if self.report is not None:
+            context.gas_report = GasReport()
+        if self.verify == "batch":
+            context.verifier = BatchVerifier(ignore_renaming=self.ignore_renaming)
+        outputs = {}
+        for node in nodes:
+            path = getattr(node, "absolutePath", name)
+            original_src = sources.get(path, {}).get("content")
+            outputs[path] = self.transform(path, node, context, original_src)
+
+        if context.verifier is not None:
+            problems = self.verify_batch(context.verifier)
+            context.errors += [self.describe_problem(p) for p in problems]
+        result = {"sources": outputs, **context.to_dict()}
+        if context.gas_report is not None:
+            result["report"] = context.gas_report.to_dict()
+        return result
+
+    def variants(
+        self,
+        url: str,
+        output: str,
+        seeds: list[int],
+        node: SourceUnit | None = None,
+        jobs: int = 1,
+    ) -> list[dict]:
+        """
+        Obfuscate the file at *url* once per seed, solc and the loading run
+        only once and every variant works on a copy of the tree. Passing the
+        seed of a variant to run() reproduces it.
+
+        Arguments:
+            output: path of the outputs with a {seed} placeholder
+            jobs: variants built in parallel by forked processes, the gas
+                report, the run report and the batch verification need the
+                variants to be built in this process, so they use one job
+
+        Returns:
+            out: [{"seed", "output", "sha256", "errors"}] of every variant,
+                errors of --verify ast|source, see transform()
+        """
+        if "{seed}" not in output:
+            raise ValueError(f"Output path {output} has no {{seed}} placeholder")
+
+        self.profiler.start_run(url)
+        if node is None:
+            node = self.load(url)
+        if node is None:
+            return []
+
+        in_process = (
+            self.report is not None
+            or self.verifier is not None
+            or self.profiler.enabled
+        )
+        if jobs > 1 and in_process:
+            logger.warning("Reports and batch verification build variants in one job")
+            jobs = 1
+        if jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            logger.warning("Parallel variants need fork, building them in one job")
+            jobs = 1
+
+        if jobs > 1:
+            # The children inherit the loaded tree instead of unpickling it
+            global _forked
+            _forked = (self, url, node)
+            fork = multiprocessing.get_context("fork")
+            with fork.Pool(min(jobs, len(seeds))) as pool:
+                results = pool.map(_variant_in_fork, seeds)
+            _forked = None
+        else:
+            # Every variant is reported by its output
+            results = [
+                self.variant(url, node, seed, output.format(seed=seed))
+                for seed in seeds
+            ]
+
+        manifest = []
+        for seed, (src, errors) in zip(seeds, results):
+            path = output.format(seed=seed)
+            with open(path, "w") as fp:
+                fp.write(src)
+            manifest.append(
+                {
+                    "seed": seed,
+                    "output": path,
+                    "sha256": hashlib.sha256(src.encode()).hexdigest(),
+                    "errors": errors,
+                }
+            )
+            logger.info(f"Variant {seed} written to {path}")
+        return manifest
+
+
+# (obfuscator, url, node) shared with the forked processes, see variants()
+_forked = None
+
+
+def _variant_in_fork(seed: int) -> tuple[str, list[str]]:
+    obfuscator, url, node = _forked
+    return obfuscator.variant(url, node, seed)
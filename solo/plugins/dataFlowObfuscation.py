@@ -1,42 +1,131 @@
 import logging
+import math
+import random
+import re
 
 from ..solidity.nodes import *
 from ..solidity.utils import *
 from .opaqueConstants import random_name
+from ..policy import Policy
+from ..context import Context
 
 
 logger = logging.getLogger(__name__)
 
+# Annotations of the solc AST this plugin reads, see utils.project()
+FIELDS = {"typeDescriptions"}
 
-def extract_literals(contract: ContractDefinition) -> dict[str, list] | None:
-    """Extract literals from the AST and store them in literal_storage."""
+# Rough gas prices for comparing literal tables, see estimate_gas()
+G_SSTORE_SET = 22100  # zero to non-zero, cold slot
+G_SLOAD_COLD = 2100
+G_CODE_DEPOSIT = 200  # per byte of runtime bytecode
+G_DECODE_LEVEL = 25  # DUP, PUSH, LT, ISZERO, PUSH, JUMPI, JUMPDEST
+G_CALL = 40  # internal call and return
 
-    literal_storage = {
-        "uint256": {"func": random_name(), "array": []},
-        "string": {"func": random_name(), "array": []},
-        "address": {"func": random_name(), "array": []},
-        "bool": {"func": random_name(), "array": []},
-    }
+# Rough bytecode size of a literal in a decode function, comparing and jumping
+# included
+LITERAL_SIZE = {"uint256": 44, "address": 32, "bool": 12, "string": 64}
 
-    success = False
+SUPPORTED_TYPES = ("uint256", "string", "address", "bool")
+SMALL_UINT = re.compile(r"uint([0-9]+)")
+
+
+def is_supported(type_str: str) -> bool:
+    return type_str in SUPPORTED_TYPES or SMALL_UINT.fullmatch(type_str) is not None
+
+
+def pack_width(type_str: str) -> int | None:
+    """Bits taken by a value of the type in a packed word, None if not packed."""
+    if type_str == "bool":
+        return 1
+    elif type_str == "address":
+        return 160
+    match = SMALL_UINT.fullmatch(type_str)
+    if match is not None and int(match.group(1)) < 256:
+        return int(match.group(1))
+    return None
+
+
+def literal_key(literal: Literal) -> tuple:
+    """Literals with the same key have the same value."""
+    return tuple(
+        getattr(literal, attr, None)
+        for attr in ("kind", "value", "hexValue", "subdenomination")
+    )
+
+
+def literal_int(literal: Literal) -> int | None:
+    """The value of a bool, address or number literal, None if unknown."""
+    if literal.kind == "bool":
+        return 1 if literal.value == "true" else 0
+    elif literal.kind != "number":
+        return None
+
+    # solc has taken care of sub-denominations and scientific notations
+    type_id = getattr(literal, "typeDescriptions", {}).get("typeIdentifier", "")
+    parts = type_id.split("_")
+    if type_id.startswith("t_rational_") and parts[2].isdigit() and parts[-1] == "1":
+        return int(parts[2])
+
+    try:
+        return int(literal.value.replace("_", ""), 0)
+    except (ValueError, AttributeError):
+        return None
+
+
+def extract_literals(
+    contract: ContractDefinition,
+    literal_storage: dict[str, list] | None = None,
+    policy: Policy | None = None,
+    rng: random.Random | None = None,
+) -> dict[str, list] | None:
+    """
+    Extract literals from the AST and store them in literal_storage, literals
+    of the same type and value share one entry.
+
+    Pass *literal_storage* to share the entries with other contracts. Literals
+    the *policy* has no "literals" for are left in place. The getters are
+    named by *rng*.
+    """
+
+    if literal_storage is None:
+        literal_storage = {}
 
     for node in contract:
         if isinstance(node, VariableDeclaration):
             if not (hasattr(node, "value") and isinstance(node.value, Literal)):
                 continue
-            type_str = node.typeName.typeDescriptions["typeString"]
-            try:
-                storage = literal_storage[type_str]
-                array: list = storage["array"]
-                func_name: str = storage["func"]
-                array.append(node.value)
-                index = len(array) - 1
-                node.value = FUNCALL(SYM(func_name), [NUM(index)])
-                success = True
-            except KeyError:
+            # Constants can't call the getters, see utils.in_constant(), and
+            # immutables are in the code already, a table would only add reads
+            if getattr(node, "constant", False) or (
+                getattr(node, "mutability", "mutable") != "mutable"
+            ):
+                continue
+            if policy is not None and not policy.literals(node.value):
+                continue
+            # Generated declarations have no type descriptions
+            descriptions = getattr(node.typeName, "typeDescriptions", None) or {}
+            type_str = descriptions.get("typeString")
+            if type_str is None:
+                logger.debug(f"Skipping {node.name}, its type is unknown")
+                continue
+            if not is_supported(type_str):
                 logger.warning(f"Variable type {type_str} not supported!")
+                continue
 
-    if success is True:
+            storage = literal_storage.setdefault(
+                type_str, {"func": random_name(rng=rng), "array": [], "index": {}}
+            )
+            array: list = storage["array"]
+            func_name: str = storage["func"]
+            key = literal_key(node.value)
+            if key not in storage["index"]:
+                array.append(node.value)
+                storage["index"][key] = len(array) - 1
+            index = storage["index"][key]
+            replace_with(node.value, FUNCALL(func_name, [NUM(index)]))
+
+    if len(literal_storage) > 0:
         return literal_storage
     else:
         return None
@@ -50,15 +139,29 @@ def generate_constant_arrays(
 
         array: list = literal_storage[key]["array"]
         func_name: str = literal_storage[key]["func"]
-        arr_dec = AVAR(ETYPE(key), "_" + func_name, array)
-        contract.main.append(arr_dec)
+        if len(array) == 0:
+            continue
+        # An inline array has a fixed length and the type of its first
+        # element, i.e. [1, 2] is uint8[2] memory
+        if key != "string":
+            array = [ETYPECONV(key, array[0]), *array[1:]]
+        arr_dec = AVAR(ETYPE(key), "_" + func_name, array, length=len(array))
+        # State variables are initialized in order, the arrays must be ready
+        # before the getters are called in other initializers
+        contract.main.insert(0, arr_dec)
 
 
-def generate_functions(contract: ContractDefinition, literal_storage: dict[str, list]):
+def generate_functions(
+    contract: ContractDefinition,
+    literal_storage: dict[str, list],
+    rng: random.Random | None = None,
+):
     for key in literal_storage.keys():
         array: list = literal_storage[key]["array"]
         func_name: str = literal_storage[key]["func"]
-        idx_var_name = random_name(4)
+        if len(array) == 0:
+            continue
+        idx_var_name = random_name(4, rng)
         func_dec = FunctionDefinition(
             kind="function",
             name=func_name,
@@ -93,15 +196,274 @@ def generate_functions(contract: ContractDefinition, literal_storage: dict[str,
         contract.main.append(func_dec)
 
 
-def run(node: SourceUnit) -> SourceUnit:
-    """Obfuscate the input AST node by replacing literals with function calls."""
+def unpack_value(key: str, bits: NodeBase) -> NodeBase:
+    """Convert the lowest bits of a packed word to a value of the type."""
+    if key == "bool":
+        return EQ(AND(bits, NUM(1)), NUM(1))
+    elif key == "address":
+        return ETYPECONV("address", ETYPECONV("uint160", bits))
+    else:
+        # The conversion cuts off the higher bits
+        return ETYPECONV(key, bits)
+
+
+def generate_unpacker(
+    unit: SourceUnit, key: str, rng: random.Random | None = None
+) -> str:
+    """
+    Generate a free function unpack(word, j) returning the j-th value of the
+    type in a packed word, it's shared by all contracts of the unit.
+    """
+    width = pack_width(key)
+    per_word = 256 // width
+    name = random_name(rng=rng)
+    word_name, j_name = random_name(4, rng), random_name(4, rng)
+
+    params = [EVAR(etype="uint256", name=word_name, value=None)]
+    bits = SYM(word_name)
+    if per_word > 1:
+        params.append(EVAR(etype="uint", name=j_name, value=None))
+        bits = RSL(bits, MUL(SYM(j_name), NUM(width)))
+
+    func_dec = FUNC(
+        name=name,
+        params=params,
+        returns=[EVAR(etype=key, name="", value=None)],
+        body=[Return(expression=unpack_value(key, bits))],
+        kind="freeFunction",
+    )
+    unit.main.append(func_dec)
+    return name
+
+
+def generate_packed_pool(
+    contract: ContractDefinition,
+    literal_storage: dict[str, list],
+    unpackers: dict[str, str] | None = None,
+    rng: random.Random | None = None,
+) -> set[str]:
+    """
+    Pack bools, addresses and small uints into the words of one shared uint256
+    array, then generate getters that unpack them.
+
+    If *unpackers* is given, the getters call the free functions in it to
+    unpack the words, missing ones are generated, see generate_unpacker().
+
+    Returns:
+        out: types that have been packed
+    """
+
+    pool_name = "_" + random_name(rng=rng)
+    words = []
+    packed = set()
+
+    for key in literal_storage.keys():
+        array: list = literal_storage[key]["array"]
+        func_name: str = literal_storage[key]["func"]
+        width = pack_width(key)
+        values = [literal_int(literal) for literal in array]
+        if width is None or len(array) == 0 or None in values:
+            continue
+
+        # Values of a type never share a word with other types, so the word
+        # and the offset of the i-th value are easy to compute
+        per_word = 256 // width
+        base = len(words)
+        for i in range(0, len(values), per_word):
+            word = 0
+            for j, value in enumerate(values[i : i + per_word]):
+                word |= (value & ((1 << width) - 1)) << (j * width)
+            words.append(word)
+
+        idx_var_name = random_name(4, rng)
+        index = DIV(SYM(idx_var_name), NUM(per_word)) if per_word > 1 else SYM(
+            idx_var_name
+        )
+        if base > 0:
+            index = ADD(NUM(base), index)
+        bits = IndexAccess(baseExpression=SYM(pool_name), indexExpression=index)
+        if unpackers is not None:
+            if key not in unpackers:
+                unpackers[key] = generate_unpacker(contract.parent, key, rng)
+            args = [bits]
+            if per_word > 1:
+                args.append(MOD(SYM(idx_var_name), NUM(per_word)))
+            value = FUNCALL(unpackers[key], args)
+        else:
+            if per_word > 1:
+                shift = MUL(MOD(SYM(idx_var_name), NUM(per_word)), NUM(width))
+                bits = RSL(bits, shift)
+            value = unpack_value(key, bits)
+
+        func_dec = FUNC(
+            name=func_name,
+            params=[EVAR(etype="uint", name=idx_var_name, value=None)],
+            returns=[EVAR(etype=key, name="", value=None)],
+            body=[Return(expression=value)],
+            mutability="view",
+        )
+        contract.main.append(func_dec)
+        packed.add(key)
+
+    if len(words) > 0:
+        array = [ETYPECONV("uint256", NUM(words[0])), *(NUM(w) for w in words[1:])]
+        pool_dec = AVAR(ETYPE("uint256"), pool_name, array, length=len(words))
+        contract.main.insert(0, pool_dec)
+
+    return packed
+
+
+def decode_tree(idx_var_name: str, array: list, lo: int, hi: int) -> NodeBase:
+    """
+    A binary search over the indices [lo, hi) that returns the literal at the
+    index, so a lookup costs log2(hi - lo) comparisons.
+    """
+    if hi - lo == 1:
+        return Return(expression=array[lo])
+
+    mid = (lo + hi) >> 1
+    return IF(
+        cond=LT(SYM(idx_var_name), NUM(mid)),
+        true_body=BLK([decode_tree(idx_var_name, array, lo, mid)]),
+        false_body=BLK([decode_tree(idx_var_name, array, mid, hi)]),
+    )
+
+
+def generate_decode_functions(
+    contract: ContractDefinition | SourceUnit,
+    literal_storage: dict[str, list],
+    rng: random.Random | None = None,
+):
+    """
+    Generate pure functions that decode the literals from the code, no storage
+    is used at all. They're free functions if generated in a source unit.
+    """
+    for key in literal_storage.keys():
+        array: list = literal_storage[key]["array"]
+        func_name: str = literal_storage[key]["func"]
+        if len(array) == 0:
+            continue
+        idx_var_name = random_name(4, rng)
+        func_dec = FUNC(
+            name=func_name,
+            params=[EVAR(etype="uint", name=idx_var_name, value=None)],
+            returns=[
+                EVAR(
+                    etype=key,
+                    name="",
+                    value=None,
+                    storage="memory" if key == "string" else "default",
+                )
+            ],
+            body=[decode_tree(idx_var_name, array, 0, len(array))],
+            kind="freeFunction" if isinstance(contract, SourceUnit) else "function",
+        )
+        contract.main.append(func_dec)
+
+
+def estimate_gas(key: str, length: int, literal_tables: str) -> tuple[int, int]:
+    """
+    Roughly estimate (deployment gas, gas per lookup) of a literal table with
+    *length* literals of type *key* from opcode prices, for the debug log. See
+    report.compare_literal_tables() for the gas estimated by solc.
+    """
+    if literal_tables == "code":
+        depth = math.ceil(math.log2(length)) if length > 1 else 0
+        deploy = G_CODE_DEPOSIT * LITERAL_SIZE.get(key, 44) * length
+        lookup = G_CALL + G_DECODE_LEVEL * depth
+    elif literal_tables == "packed" and pack_width(key) is not None:
+        # Every word takes a slot, the array has a fixed length
+        deploy = G_SSTORE_SET * math.ceil(length / (256 // pack_width(key)))
+        # Shifting and masking are cheap compared to the SLOAD
+        lookup = G_CALL + G_SLOAD_COLD + 30
+    else:
+        # The length and every element take a slot, long strings take more
+        deploy = G_SSTORE_SET * (length + 1)
+        # Bounds check reads the length, then the element is read
+        lookup = G_CALL + 2 * G_SLOAD_COLD
+    return deploy, lookup
+
+
+def log_estimates(name: str, literal_storage: dict[str, list]):
+    for key, storage in literal_storage.items():
+        length = len(storage["array"])
+        if length == 0:
+            continue
+        modes = ["storage", "code"]
+        if pack_width(key) is not None:
+            modes.append("packed")
+        for mode in modes:
+            deploy, lookup = estimate_gas(key, length, mode)
+            logger.debug(
+                f"{name}: {length} {key} literals in {mode}, "
+                f"estimated {deploy} gas to deploy, {lookup} gas per lookup"
+            )
+
+
+def run(
+    node: SourceUnit,
+    literal_tables: str = "storage",
+    pack_literals: bool = False,
+    shared_helpers: bool = False,
+    policy: Policy | None = None,
+    context: Context | None = None,
+) -> SourceUnit:
+    """
+    Obfuscate the input AST node by replacing literals with function calls.
+
+    Parameters:
+        node (SourceUnit): the root node to start obfuscation
+        literal_tables (str): where the literals are kept, "storage" for state
+            variable arrays, "code" for pure decode functions which never touch
+            the storage
+        pack_literals (bool): in storage, pack bools, addresses and small
+            uints into shared words
+        shared_helpers (bool): generate the helpers once as free functions
+            shared by all contracts of the unit. Code tables are merged into
+            one table per type, storage tables stay in their contracts but the
+            unpacking is shared
+        policy (Policy): literals of functions and contracts whose level has
+            no "literals" are left in place
+        context (Context): the job, its random generator names the tables and
+            getters
+    """
+    if literal_tables not in ("storage", "code"):
+        raise ValueError(f"Unknown literal tables {literal_tables}")
+
+    rng = context.random if context is not None else random
+
     logger.debug("Starting data flow obfuscation")
 
-    for contract in node.contracts:
-        literal_storage = extract_literals(contract)
-        if literal_storage is not None:
-            generate_functions(contract, literal_storage)
-            generate_constant_arrays(contract, literal_storage)
+    if shared_helpers is True and literal_tables == "code":
+        unit_storage = {}
+        for contract in node.contracts:
+            extract_literals(contract, unit_storage, policy, rng)
+        generate_decode_functions(node, unit_storage, rng)
+        log_estimates("source unit", unit_storage)
+
+    else:
+        unpackers = {} if shared_helpers is True else None
+        for contract in node.contracts:
+            literal_storage = extract_literals(contract, policy=policy, rng=rng)
+            if literal_storage is None:
+                continue
+
+            if literal_tables == "code":
+                generate_decode_functions(contract, literal_storage, rng)
+            else:
+                if pack_literals is True:
+                    packed = generate_packed_pool(
+                        contract, literal_storage, unpackers, rng
+                    )
+                else:
+                    packed = set()
+                unpacked = {
+                    k: v for k, v in literal_storage.items() if k not in packed
+                }
+                generate_functions(contract, unpacked, rng)
+                generate_constant_arrays(contract, unpacked)
+
+            log_estimates(contract.name, literal_storage)
 
     logger.debug("Data flow obfuscation completed")
     return node
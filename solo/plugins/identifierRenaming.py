@@ -1,7 +1,11 @@
 import hashlib
-import time
+import random
 
 from ..solidity.nodes import *
+from ..context import Context
+
+# Annotations of the solc AST this plugin reads, see utils.project()
+FIELDS = set()
 
 GLOBAL_VARIABLES = {
     "block",
@@ -17,18 +21,19 @@ GLOBAL_VARIABLES = {
     "value",
     "transfer",
 }  # ȫ�ֱ��������滻������û��Զ��������������bug��
-replacements = {}  # �������ֵ䣨�����滻�ظ����ֵı�����
 
 
 # ʹ��SHA-1�㷨�Ա�����+ʱ��Ϊ���������滻��
-def sha1_hash(value: str) -> str:
-    combined_value = f"{value}_{time.time()}"
+def sha1_hash(value: str, rng: random.Random | None = None) -> str:
+    # Salted from the random generator of the job, so that its seed reproduces
+    # the names, the global one if None
+    combined_value = f"{value}_{(rng or random).getrandbits(64)}"
     return hashlib.sha1(combined_value.encode()).hexdigest()
 
 
 # ���Ϸ����滻��ǰ���_ʹ֮�Ϸ�
-def make_valid_name(name: str) -> str:
-    hashed = sha1_hash(name)
+def make_valid_name(name: str, rng: random.Random | None = None) -> str:
+    hashed = sha1_hash(name, rng)
 
     # �����ֿ�ͷ�Ĳ��Ϸ��滻��
     if hashed[0].isdigit():
@@ -41,7 +46,14 @@ def make_valid_name(name: str) -> str:
 
 
 # �滻������
-def renaming(node: NodeBase) -> NodeBase:
+def renaming(
+    node: NodeBase, replacements: dict[str, str], rng: random.Random | None = None
+) -> NodeBase:
+    """
+    Rename in place, *replacements* maps the original names to new ones, new
+    names are salted by *rng*.
+    """
+
     # ʹ��ջ��ģ��ݹ�
     stack = [node]
     processed_nodes = set()  # ���ڸ����Ѵ����Ľڵ�
@@ -81,7 +93,7 @@ def renaming(node: NodeBase) -> NodeBase:
                             if original_name not in replacements:
                                 # �����滻��������������ֵ�
                                 replacements[original_name] = make_valid_name(
-                                    original_name
+                                    original_name, rng
                                 )
 
                             # �滻����
@@ -95,7 +107,7 @@ def renaming(node: NodeBase) -> NodeBase:
                         # ������ڱ������ֵ��У���һ�γ��ֵı�������
                         if original_name not in replacements:
                             # �����滻��������������ֵ�
-                            replacements[original_name] = make_valid_name(original_name)
+                            replacements[original_name] = make_valid_name(original_name, rng)
 
                         # �滻����
                         current_node.memberName = replacements[original_name]
@@ -112,7 +124,7 @@ def renaming(node: NodeBase) -> NodeBase:
                             # ������ڱ������ֵ��У���һ�γ��ֵı�������
                             if name not in replacements:
                                 # �����滻��������������ֵ�
-                                replacements[name] = make_valid_name(name)
+                                replacements[name] = make_valid_name(name, rng)
 
                             # �滻����
                             current_node.names[current_node.names.index(name)] = (
@@ -137,8 +149,11 @@ def renaming(node: NodeBase) -> NodeBase:
 
 
 # �������滻����
-def run(node: SourceUnit) -> SourceUnit:
+def run(node: SourceUnit, context: Context | None = None) -> SourceUnit:
+    # The names are kept by the job, see Context
+    replacements = context.replacements if context is not None else {}
+    rng = context.random if context is not None else random
     # �滻������
-    node = renaming(node)
+    node = renaming(node, replacements, rng)
 
     return node
@@ -2,14 +2,21 @@ import logging
 import random
 
 from collections import deque
+from functools import lru_cache
 from math import gcd
+from typing import Callable
 from gmpy2 import gcdext
 
 from ..solidity.nodes import *
 from ..solidity.utils import *
+from ..policy import Policy
+from ..context import Context
 
 logger = logging.getLogger(__name__)
 
+# Annotations of the solc AST this plugin reads, see utils.project()
+FIELDS = {"typeDescriptions"}
+
 mask = lambda x: (1 << x) - 1  # 0x1111_1111_...
 
 OPAQUE0 = (
@@ -32,64 +39,99 @@ OPAQUE0 = (
 )
 
 
-def random_number(bits: int = 128) -> int:
+def random_number(bits: int = 128, rng: random.Random | None = None) -> int:
     """
     Return a random positive number that can be represented by integer of bit
-    *bits*
+    *bits*, drawn from *rng*, the global random generator if None
+    """
+    return (rng or random).randint(1 << (bits - 2), (1 << (bits - 1)) - 1)
+
+
+class RandomPool:
     """
-    return random.randint(1 << (bits - 2), (1 << (bits - 1)) - 1)
+    Random numbers of the same distribution as random_number(), they're drawn
+    in batches of *batch* to save calls to the random generator *rng*.
+    """
+
+    def __init__(
+        self, bits: int = 128, batch: int = 256, rng: random.Random | None = None
+    ):
+        self.bits = bits
+        self.batch = batch
+        self.rng = rng or random
+        self.numbers = []
+
+    def next(self) -> int:
+        if len(self.numbers) == 0:
+            width = self.bits - 2
+            pool = self.rng.getrandbits(width * self.batch)
+            top = 1 << width
+            self.numbers = [
+                top | ((pool >> (i * width)) & mask(width))
+                for i in range(self.batch)
+            ]
+        return self.numbers.pop()
 
 
-def random_name(length: int = 16) -> str:
-    start = random.choice(AZAZDOLLAR_)
-    return start + "".join(random.sample(AZAZ09DOLLAR_, length - 1))
+def random_name(length: int = 16, rng: random.Random | None = None) -> str:
+    rng = rng or random
+    start = rng.choice(AZAZDOLLAR_)
+    return start + "".join(rng.sample(AZAZ09DOLLAR_, length - 1))
 
 
 def opaque_int(
-    m: int, x_name: str, x: int, y_name: str, y: int, bits: int = 128
+    m: int,
+    x_name: str,
+    x: int,
+    y_name: str,
+    y: int,
+    bits: int = 128,
+    helpers: tuple[str, str] | None = None,
+    k: int | None = None,
+    rng: random.Random | None = None,
 ) -> dict:
     """
     Generate an AST representation of opaque integer of value m with linear
     combination of x and y based on Bezout's theorem
 
     We assume that x and y are positive coprime integers with 127 bits
-    """
 
-    if gcd(x, y) != 1:
-        raise ValueError(
-            f"opaque const generation: bad x, y value {hex(x)} and {hex(y)}"
-        )
+    If *helpers* is given, the outermost subtraction (and the multiplications
+    under it) are done by calling the unchecked helpers (msub, sub), see
+    gen_helpers().
+
+    *k* is the random number hiding the coefficients, a fresh one is drawn
+    from *rng* if not given.
+    """
 
     # When m is zero, generate opaque 0 based on ast_id equations
     if m == 0:
         # template of opaque0
-        opaque0: callable = random.choice(OPAQUE0)
-        return opaque0(x_name=x_name, x=x, y_name=y_name, y=y)
+        opaque0: callable = (rng or random).choice(OPAQUE0)
+        expr = opaque0(x_name=x_name, x=x, y_name=y_name, y=y)
+        if helpers is not None:
+            _, sub_name = helpers
+            expr = FUNCALL(sub_name, [expr.leftExpression, expr.rightExpression])
+        return expr
 
-    # When m is not zero, we're trying to find two const *aa* and *bb* that
-    # aa*xx - bb*yy = m or bb*yy - aa*xx = m
-    # If aa*xx - bb*yy equals to -1, we use bb*yy - aa*xx
-    sign = True
-    _, a, b = gcdext(x, y)
-    a, b = int(a), int(b)
-
-    if a < 0 and b > 0:
-        a = -a  # a*x - b*y = -1
-        sign = not sign
-    elif a > 0 and b < 0:
-        b = -b  # a*x - b*y = 1
-    else:
-        raise ValueError(
-            f"opaque const generation: bad x, y value {hex(x)} and {hex(y)}"
-        )
+    a, b, sign = bezout(x, y)
 
-    k = random_number(bits)
+    if k is None:
+        k = random_number(bits, rng)
     # (m*a + k*y)*x - (m*b + k*x)*y = m*(a*x - b*y)
     aa = (m * a + k * y) & mask(bits)
     bb = (m * b + k * x) & mask(bits)
 
+    # The products never exceed int256, but checked arithmetic still costs
+    if helpers is not None:
+        msub_name, _ = helpers
+        if sign is True:
+            args = [NUM(aa), SYM(x_name), NUM(bb), SYM(y_name)]
+        else:
+            args = [NUM(bb), SYM(y_name), NUM(aa), SYM(x_name)]
+        expr = FUNCALL(msub_name, args)
     # sign is inverted twice or not inverted, We have aa*xx - bb*yy = m
-    if sign is True:
+    elif sign is True:
         expr = SUB(
             MUL(NUM(aa), SYM(x_name)),
             MUL(NUM(bb), SYM(y_name)),
@@ -104,28 +146,281 @@ def opaque_int(
     return expr
 
 
+@lru_cache(maxsize=16)
+def bezout(x: int, y: int) -> tuple[int, int, bool]:
+    """
+    Find positive *a* and *b* that a*x - b*y = 1 (sign is True) or -1 (sign is
+    False), the result is cached since x and y are fixed during a run.
+    """
+
+    if gcd(x, y) != 1:
+        raise ValueError(
+            f"opaque const generation: bad x, y value {hex(x)} and {hex(y)}"
+        )
+
+    # When m is not zero, we're trying to find two const *aa* and *bb* that
+    # aa*xx - bb*yy = m or bb*yy - aa*xx = m
+    # If aa*xx - bb*yy equals to -1, we use bb*yy - aa*xx
+    sign = True
+    _, a, b = gcdext(x, y)
+    a, b = int(a), int(b)
+
+    if a < 0 and b > 0:
+        a = -a  # a*x - b*y = -1
+        sign = not sign
+    elif a > 0 and b < 0:
+        b = -b  # a*x - b*y = 1
+    else:
+        raise ValueError(
+            f"opaque const generation: bad x, y value {hex(x)} and {hex(y)}"
+        )
+
+    return a, b, sign
+
+
 def opaque_fixed() -> dict:
     # TODO opaque fixed
     pass
 
 
-def run(node: SourceUnit) -> SourceUnit:
+def gen_helpers(
+    node: SourceUnit, index: int, rng: random.Random | None = None
+) -> tuple[str, str]:
+    """
+    Insert the free functions msub(a, x, b, y) = a*x - b*y and
+    sub(a, b) = a - b into the source unit at *index*, both are unchecked.
+
+    Returns:
+        out: names of msub and sub
+    """
+
+    msub_name, sub_name = random_name(rng=rng), random_name(rng=rng)
+    a, x, b, y = (random_name(4, rng) for _ in range(4))
+    msub = UNCHECKED_FUNC(
+        "int", msub_name, [a, x, b, y], SUB(MUL(SYM(a), SYM(x)), MUL(SYM(b), SYM(y)))
+    )
+    sub = UNCHECKED_FUNC("int", sub_name, [a, b], SUB(SYM(a), SYM(b)))
+    node.main.insert(index, sub)
+    node.main.insert(index, msub)
+    return msub_name, sub_name
+
+
+def opaque_literal(
+    value: int,
+    x_name: str,
+    x: int,
+    y_name: str,
+    y: int,
+    helpers: tuple[str, str] | None = None,
+    pool: RandomPool | None = None,
+    rng: random.Random | None = None,
+) -> FunctionCall:
+    """
+    Generate an opaque expression that has the same bit representation as the
+    integer *value*, converted to uint or int.
+
+    If *pool* is given, the random numbers are taken from it, the other random
+    choices are made by *rng*.
+    """
+
+    # Same arguments for every part of the value
+    opaque = partial(
+        opaque_int, x_name=x_name, x=x, y_name=y_name, y=y, helpers=helpers, rng=rng
+    )
+    k = lambda: None if pool is None else pool.next()
+
+    # We can represent *value* using 128 bits
+    if value == 0:
+        expr = opaque(value, k=k())
+    elif (value >> 128) == 0:
+        expr = opaque(value, k=k())
+        # Note that there'll be junk values in the high
+        # 128 bits of the result
+        expr = AND(expr, NUM(mask(128)))
+    # 128 bits, but negative
+    elif (value >> 128) == -1:
+        expr = opaque(value, k=k())
+        # Because mask(128) << 128 can not be represented by
+        # int256, we generate the expression (-1) << 128
+        # instead
+        expr = OR(expr, LSL(NEG(NUM(1)), NUM(128)))
+    # We cannot represent *value* using 128 bits
+    else:
+        value_low = value & mask(128)
+        value_high = value >> 128
+        expr_low = opaque(value_low, k=k())
+        expr_low = AND(expr_low, NUM(mask(128)))
+        expr_high = opaque(value_high, k=k())
+        expr = OR(expr_low, LSL(expr_high, NUM(128)))
+
+    # Now expr holds a int that has the same bit
+    # representation as *value*
+
+    # TODO type conversion??
+    # TODO sub-denomination
+    if value < 0:
+        return ETYPECONV("int", expr)
+    else:
+        return ETYPECONV("uint", expr)
+
+
+LOOP_STMT = (ForStatement, WhileStatement, DoWhileStatement)
+
+# Every hoisted constant takes a stack slot, keep some room for the locals of
+# the function itself to avoid "stack too deep"
+MAX_HOISTED = 4
+
+
+def loop_context(
+    n: NodeBase,
+) -> tuple[FunctionDefinition | ModifierDefinition | None, NodeBase | None]:
+    """
+    Find the function of *n* and the outermost loop that evaluates *n* on
+    every iteration, the loop is None if there's no such loop.
+    """
+
+    loop = None
+    child, curr = n, n.parent
+    while curr is not None:
+        if isinstance(curr, (FunctionDefinition, ModifierDefinition)):
+            return curr, loop
+        # Array lengths must be constants, never hoist them
+        elif isinstance(curr, ArrayTypeName):
+            return None, None
+        # The initialization expression is evaluated only once
+        elif isinstance(curr, LOOP_STMT) and (
+            curr.children.get(child) != "initializationExpression"
+        ):
+            loop = curr
+        child, curr = curr, curr.parent
+    return None, None
+
+
+def hoist(
+    func: FunctionDefinition | ModifierDefinition,
+    occurrences: dict[int, list[tuple[NodeBase, NodeBase]]],
+    make_expr: Callable[[int], NodeBase],
+    unchecked: bool = False,
+    rng: random.Random | None = None,
+) -> list[tuple[NodeBase, int]]:
+    """
+    Hoist opaque constants used in loops of *func* into locals.
+
+    A value used in only one loop is computed right before that loop, a value
+    used in several loops is computed once at the beginning of the function.
+
+    Arguments:
+        occurrences: {value: [(literal node, outermost loop)]}
+        make_expr: generates the opaque expression of a value
+        unchecked: compute the locals in unchecked blocks
+        rng: random generator naming the locals
+    Returns:
+        out: (literal node, value) pairs that were not hoisted
+    """
+
+    # Values that occur most often are the most rewarding ones
+    values = sorted(occurrences, key=lambda v: len(occurrences[v]), reverse=True)
+    rest = [(n, v) for v in values[MAX_HOISTED:] for n, _ in occurrences[v]]
+
+    for value in values[:MAX_HOISTED]:
+        name = random_name(rng=rng)
+        etype = "int" if value < 0 else "uint"
+        expr = make_expr(value)
+        if unchecked is True:
+            # uint name; unchecked { name = expr; }
+            var_dec_stmts = [
+                EVAR(etype, name, None, stmt=True),
+                UNCHECKED([ASSIGN(SYM(name), expr)]),
+            ]
+        else:
+            var_dec_stmts = [EVAR(etype, name, expr, stmt=True)]
+
+        loops = {id(loop): loop for _, loop in occurrences[value]}
+        loop = next(iter(loops.values()))
+        if len(loops) == 1 and isinstance(loop.parent, Block):
+            stmts = loop.parent.statements
+            index = stmts.index(loop)
+        else:
+            stmts = func.body.statements
+            index = 0
+        stmts[index:index] = var_dec_stmts
+
+        for n, _ in occurrences[value]:
+            replace_with(n, SYM(name))
+
+    return rest
+
+
+def gen_shared(
+    node: SourceUnit,
+    index: int,
+    values: Iterable[int],
+    make_expr: Callable[[int], NodeBase],
+    unchecked: bool = False,
+    rng: random.Random | None = None,
+) -> dict[int, str]:
+    """
+    Insert a free function returning the opaque expression for each value into
+    the source unit at *index*, so that all the occurrences share one copy.
+
+    Returns:
+        out: {value: function name}
+    """
+
+    shared = {}
+    for value in values:
+        name = random_name(rng=rng)
+        etype = "int" if value < 0 else "uint"
+        if unchecked is True:
+            func = UNCHECKED_FUNC(etype, name, [], make_expr(value))
+        else:
+            func = FUNC(
+                name=name,
+                params=[],
+                returns=[EVAR(etype, "", None)],
+                body=[Return(expression=make_expr(value))],
+                kind="freeFunction",
+            )
+        node.main.insert(index, func)
+        shared[value] = name
+    return shared
+
+
+def run(
+    node: SourceUnit,
+    unchecked: bool = False,
+    share_constants: bool = False,
+    policy: Policy | None = None,
+    context: Context | None = None,
+) -> SourceUnit:
     """
     This function implements opaque constant obfuscation while keeping extra gas
     cost as low as possible
     Parameters:
         node (NodeBase): the root node to start obfuscation
+        unchecked (bool): evaluate the generated arithmetic without overflow
+            checks, the values are correct modulo 2^128 anyway
+        share_constants (bool): values that occur more than once are generated
+            by one shared function instead of one expression per occurrence
+        policy (Policy): literals of functions and contracts whose level has
+            no "constants" are left as they are
+        context (Context): the job, its random generator makes the choices
     Returns:
         out (NodeBase): the obfuscated root node
     """
 
+    if policy is None:
+        policy = Policy()
+    rng = context.random if context is not None else random
+
     logger.debug(f"Applying opaque constant obfuscation on {node}")
 
     # Generate const_x with a random name at beginning of the contract
-    x, y = random_number(), random_number()
+    x, y = random_number(rng=rng), random_number(rng=rng)
     while gcd(x, y) != 1:
-        y = random_number()
-    x_name, y_name = random_name(), random_name()  # TODO: label name conflict
+        y = random_number(rng=rng)
+    x_name = random_name(rng=rng)  # TODO: label name conflict
+    y_name = random_name(rng=rng)
     x_dec, y_dec = EVAR("int", x_name, x, const=True), EVAR(
         "int", y_name, y, const=True
     )
@@ -138,8 +433,15 @@ def run(node: SourceUnit) -> SourceUnit:
             break
     node.main.insert(index, x_dec)
     node.main.insert(index, y_dec)
+    index += 2
+    if unchecked is True:
+        helpers = gen_helpers(node, index, rng)
+        index += 2
+    else:
+        helpers = None
     # TODO how to defend against compiler optimization of "constant variables"
 
+    literals = []  # (node, value)
     bfs_queue = deque([node])
 
     while len(bfs_queue) > 0:
@@ -164,43 +466,8 @@ def run(node: SourceUnit) -> SourceUnit:
                     denominator = int(parts[-1])
 
                     # integer
-                    if denominator == 1:
-                        value = numerator
-                        # We can represent *value* using 128 bits
-                        if value == 0:
-                            expr = opaque_int(value, x_name, x, y_name, y)
-                        elif (value >> 128) == 0:
-                            expr = opaque_int(value, x_name, x, y_name, y)
-                            # Note that there'll be junk values in the high
-                            # 128 bits of the result
-                            expr = AND(expr, NUM(mask(128)))
-                        # 128 bits, but negative
-                        elif (value >> 128) == -1:
-                            expr = opaque_int(value, x_name, x, y_name, y)
-                            # Because mask(128) << 128 can not be represented by
-                            # int256, we generate the expression (-1) << 128
-                            # instead
-                            expr = OR(expr, LSL(NEG(NUM(1)), NUM(128)))
-                        # We cannot represent *value* using 128 bits
-                        else:
-                            value_low = value & mask(128)
-                            value_high = value >> 128
-                            expr_low = opaque_int(value_low, x_name, x, y_name, y)
-                            expr_low = AND(expr_low, NUM(mask(128)))
-                            expr_high = opaque_int(value_high, x_name, x, y_name, y)
-                            expr = OR(expr_low, LSL(expr_high, NUM(128)))
-
-                        # Now expr holds a int that has the same bit
-                        # representation as *value*
-
-                        # TODO type conversion??
-                        # TODO sub-denomination
-                        if value < 0:
-                            expr = ETYPECONV("int", expr)
-                        else:
-                            expr = ETYPECONV("uint", expr)
-
-                        replace_with(n, expr)
+                    if denominator == 1 and policy.constants(n):
+                        literals.append((n, numerator))
 
                     # TODO fixed
                     else:
@@ -211,6 +478,59 @@ def run(node: SourceUnit) -> SourceUnit:
             # Otherwise, add the node to bfs queue and continue the loop
             bfs_queue.append(n)
 
+    pool = RandomPool(rng=rng)
+    shared = {}
+
+    def make_expr(
+        value: int, helpers: tuple[str, str] | None = None, share: bool = True
+    ) -> NodeBase:
+        if share is True and value in shared:
+            return FUNCALL(shared[value], [])
+        return opaque_literal(value, x_name, x, y_name, y, helpers, pool, rng)
+
+    if share_constants is True:
+        # Constant contexts can't call the shared functions, see in_constant()
+        counts = {}
+        for n, value in literals:
+            if not in_constant(n):
+                counts[value] = counts.get(value, 0) + 1
+        repeated = [value for value, count in counts.items() if count > 1]
+        # With *unchecked*, the shared functions compute in unchecked blocks,
+        # otherwise checked like the inline expressions, no helpers either way
+        shared = gen_shared(
+            node, index, repeated, make_expr, unchecked=unchecked, rng=rng
+        )
+        logger.debug(f"{len(shared)} values are shared by {len(literals)} literals")
+
+    # Literals evaluated in loops are hoisted out of the loops, so that the
+    # opaque expressions are not evaluated on every iteration
+    in_loops: dict[int, tuple[NodeBase, dict]] = {}
+    rest = []
+    for n, value in literals:
+        func, loop = loop_context(n)
+        if loop is None:
+            rest.append((n, value))
+        else:
+            _, occurrences = in_loops.setdefault(id(func), (func, {}))
+            occurrences.setdefault(value, []).append((n, loop))
+
+    for func, occurrences in in_loops.values():
+        rest.extend(
+            hoist(func, occurrences, make_expr, unchecked=unchecked, rng=rng)
+        )
+
+    for n, value in rest:
+        # Constant initializers and array lengths can't call the helpers or
+        # the shared functions, the inline arithmetic is still a constant
+        # expression. No need to call the helpers if we're already unchecked
+        if in_constant(n):
+            expr = make_expr(value, share=False)
+        elif helpers is not None and in_unchecked(n):
+            expr = make_expr(value)
+        else:
+            expr = make_expr(value, helpers)
+        replace_with(n, expr)
+
     logger.debug(f"Generating opaque constants done!")
 
     return node
@@ -1,66 +1,345 @@
 import logging
 import random
 from collections import deque
+from functools import lru_cache
 
 from ..solidity.utils import *
 from ..solidity.nodes import *
 from .opaqueConstants import random_name, random_number, opaque_int
+from ..policy import Policy
+from ..context import Context
+from ..report import compile_source
 
 logger = logging.getLogger(__name__)
 
+# Annotations of the solc AST this plugin reads, see utils.project()
+FIELDS = set()
+
+
+class OpaquePredicate:
+    """
+    An always-false predicate template with its estimated runtime cost.
+
+    The estimates are counted from the opcodes solc 0.8.28 emits without the
+    optimizer, reads of the inputs x and y are counted in *reads* only. With a
+    budget the costs are measured with the local solc instead, see
+    measure_costs(), the estimates are the fallback if it can't be run.
+
+    Attributes:
+        template: a callable (x_name, x, y_name, y) -> predicate expression
+        gas: gas to evaluate the predicate, input reads excluded
+        size: bytecode size in bytes, input reads excluded
+        reads: number of times x or y is read in the worst case
+    """
+
+    def __init__(self, template: callable, gas: int, size: int, reads: int):
+        self.template = template
+        self.gas = gas
+        self.size = size
+        self.reads = reads
+
+    def __call__(self, x_name: str, x: int, y_name: str, y: int) -> NodeBase:
+        return self.template(x_name=x_name, x=x, y_name=y_name, y=y)
+
 
 OPAQUE_FALSE = (
-    lambda x_name, x, y_name, y: LAND(  # (x % 2 == 0) && (x % 2 == 1)
-        EQ(MOD(SYM(x_name), NUM(2)), NUM(0)),
-        EQ(MOD(SYM(x_name), NUM(2)), NUM(1)),
+    OpaquePredicate(  # (x | 1) == (x & ~1), an odd number is never even
+        lambda x_name, x, y_name, y: EQ(
+            OR(SYM(x_name), NUM(1, leaves=LEAVES)),
+            AND(SYM(x_name), NOT(NUM(1, leaves=LEAVES))),
+        ),
+        gas=15,
+        size=38,
+        reads=2,
+    ),
+    OpaquePredicate(  # (x >= y) && (x < y)
+        lambda x_name, x, y_name, y: LAND(
+            GE(SYM(x_name), SYM(y_name)),
+            LT(SYM(x_name), SYM(y_name)),
+        ),
+        gas=34,
+        size=12,
+        reads=4,
     ),
-    lambda x_name, x, y_name, y: LAND(  # (x >= y) && (x < y)
-        GE(SYM(x_name), SYM(y_name)),
-        LT(SYM(x_name), SYM(y_name)),
+    OpaquePredicate(  # (x & y) > (x | y), x and y are positive
+        lambda x_name, x, y_name, y: GT(
+            AND(SYM(x_name), SYM(y_name)),
+            OR(SYM(x_name), SYM(y_name)),
+        ),
+        gas=9,
+        size=3,
+        reads=4,
+    ),
+    OpaquePredicate(  # x * x % 4 == 2, squares are 0 or 1 modulo 4
+        lambda x_name, x, y_name, y: EQ(
+            MOD(MUL(SYM(x_name), SYM(x_name)), NUM(4, leaves=LEAVES)),
+            NUM(2, leaves=LEAVES),
+        ),
+        gas=75,
+        size=45,
+        reads=2,
     ),
     # Feel free to add more!
     # Note that transactions will be reverted if there's an overflow, so avoid
     # using a lot of multiplies. Bit operations are recommended!
+    # Please estimate the costs of new templates as well.
 )
 
+# Where x and y come from, (setup gas, setup size, size per read)
+# Every read costs 3 gas: a DUP for locals, a PUSH for constants and immutables
+INPUT_COST = {
+    "local": (6, 34, 1),  # two PUSH16 at the beginning of the function
+    "constant": (0, 0, 17),  # PUSH16 on every read, may be folded by solc
+    "immutable": (0, 0, 33),  # PUSH32 on every read
+}
+
+# ISZERO, PUSH2, JUMPI and JUMPDEST of the if statement
+BRANCH_COST = (17, 6)
 
-def garbage_code(length: int = 1) -> Block:
+
+def predicate_cost(
+    predicate: OpaquePredicate,
+    inputs: str,
+    measured: dict[tuple[int, str], tuple[int, int]] | None = None,
+) -> tuple[int, int]:
+    """
+    Runtime (gas, bytecode size) overhead of a predicate in a function, taken
+    from *measured* if it's there, see measure_costs().
+    """
+    key = (OPAQUE_FALSE.index(predicate), inputs)
+    if measured is not None and key in measured:
+        return measured[key]
+    setup_gas, setup_size, read_size = INPUT_COST[inputs]
+    branch_gas, branch_size = BRANCH_COST
+    gas = branch_gas + setup_gas + predicate.gas + 3 * predicate.reads
+    size = branch_size + setup_size + predicate.size + read_size * predicate.reads
+    return gas, size
+
+
+# Contracts compiled by measure_costs(), f() has the predicate *cond* and the
+# inputs of *kind* declared as {locals} or {states}, B is the baseline
+MEASURE_BASELINE = "contract B{function f(uint a)external returns(uint){return a;}}"
+MEASURE_CONTRACT = (
+    "contract {name}{{{states}function f(uint a)external returns(uint)"
+    "{{{locals}if({cond}){{}}return a;}}}}"
+)
+
+
+@lru_cache(maxsize=1)
+def measure_costs() -> dict[tuple[int, str], tuple[int, int]]:
+    """
+    Measure the runtime (gas, bytecode size) overhead of every template with
+    every kind of inputs, with the local solc and without the optimizer as the
+    output is compiled. A contract whose function f() evaluates the predicate
+    is compiled next to the same contract without it, the costs are the
+    differences of the solc gas estimates of f() and of the runtime sizes.
+    Junk in the dead branch is not included.
+
+    Pairs solc can't bound are left out, so is everything if solc fails.
+
+    Returns:
+        out: {(index in OPAQUE_FALSE, inputs): (gas, size)}
+    """
+    builder = SourceBuilder()
+    x, y = 0x4F17F5C4414C343C1027C4D1C386BBC4, 0x7C7288307311D8A3C2CE6F447ED4D57B
+    names = {}
+    contracts = [MEASURE_BASELINE]
+    for i, predicate in enumerate(OPAQUE_FALSE):
+        cond = builder.build(predicate(x_name="x", x=x, y_name="y", y=y))
+        for inputs in INPUT_COST:
+            decls = f"int x={x};int y={y};"
+            if inputs != "local":
+                decls = decls.replace("int ", f"int {inputs} ")
+            name = f"P{i}{inputs.capitalize()}"
+            contracts.append(
+                MEASURE_CONTRACT.format(
+                    name=name,
+                    states=decls if inputs != "local" else "",
+                    locals=decls if inputs == "local" else "",
+                    cond=cond,
+                )
+            )
+            names[(i, inputs)] = name
+
+    try:
+        stats = compile_source("".join(contracts))
+    except Exception as e:
+        logger.warning(f"Cannot measure the predicates, using the estimates.\n{e}")
+        return {}
+
+    sig = "f(uint256)"
+    base_gas, base_size = stats["B"]["external"].get(sig), stats["B"]["size"]
+    if base_gas is None:
+        return {}
+    measured = {}
+    for key, name in names.items():
+        gas = stats[name]["external"].get(sig)
+        if gas is not None:
+            measured[key] = (gas - base_gas, stats[name]["size"] - base_size)
+    logger.debug(f"Measured the costs of {len(measured)} predicates with solc")
+    return measured
+
+
+def garbage_code(length: int = 1, rng: random.Random | None = None) -> Block:
     # For now, just generate
     # require(random_value == random_value);
     body = []
     for _ in range(length):
-        value = random_number()
+        value = random_number(rng=rng)
         garbage_expr = FUNCALL("require", [EQ(NUM(value), NUM(value))])
         body.append(ExpressionStatement(expression=garbage_expr))
     return BLK(body)
 
 
-def run(node: SourceUnit) -> SourceUnit:
+def gen_inputs(
+    inputs: str = "local", rng: random.Random | None = None
+) -> tuple[str, int, str, int, list]:
+    """
+    Generate the inputs x and y, declared as local variable statements,
+    constants or immutables.
+    """
+    x, y = random_number(rng=rng), random_number(rng=rng)
+    x_name = random_name(rng=rng)  # TODO: label name conflict
+    y_name = random_name(rng=rng)
+    if inputs == "local":
+        x_dec = EVAR("int", x_name, x, stmt=True)
+        y_dec = EVAR("int", y_name, y, stmt=True)
+    elif inputs == "constant":
+        x_dec = EVAR("int", x_name, x, const=True)
+        y_dec = EVAR("int", y_name, y, const=True)
+    else:
+        x_dec = EVAR("int", x_name, x, mutability=inputs)
+        y_dec = EVAR("int", y_name, y, mutability=inputs)
+    return x_name, x, y_name, y, [x_dec, y_dec]
+
+
+def input_kind(func: FunctionDefinition | ModifierDefinition, inputs: str) -> str:
+    """
+    Immutables are only available to non-pure functions of contracts, use
+    constants for the others. Modifiers may be applied to pure functions, they
+    use constants too.
+    """
+    if inputs == "immutable":
+        parent = func.parent
+        if not (
+            isinstance(func, FunctionDefinition)
+            and isinstance(parent, ContractDefinition)
+            and parent.contractKind == "contract"
+            and getattr(func, "stateMutability", None) != "pure"
+        ):
+            return "constant"
+    return inputs
+
+
+def run(
+    node: SourceUnit,
+    predicate_budget: int | None = None,
+    predicate_inputs: str = "local",
+    policy: Policy | None = None,
+    context: Context | None = None,
+) -> SourceUnit:
+    """
+    Insert an opaque predicate at the beginning of every function.
+
+    Parameters:
+        node (SourceUnit): the root node to start obfuscation
+        predicate_budget (int): max gas a predicate may add to a call, functions
+            that cannot afford any predicate are skipped. The costs are
+            measured with solc, see measure_costs()
+        predicate_inputs (str): where x and y come from, one of "local"
+            (fresh locals in every function), "constant" or "immutable"
+        policy (Policy): obfuscation intensity per function, hot functions get
+            no predicate, cold ones get nested predicates with more junk
+        context (Context): the job, its random generator makes the choices
+    """
+    if policy is None:
+        policy = Policy()
+    rng = context.random if context is not None else random
+
+    if predicate_inputs not in INPUT_COST:
+        raise ValueError(f"Unknown predicate inputs {predicate_inputs}")
+
     logger.debug(f"Inserting opaque predicates on {node}")
+    measured = measure_costs() if predicate_budget is not None else None
+
+    constants = None  # shared by the whole source unit
+    immutables = {}  # {contract: inputs}
+    total_gas, total_size = 0, 0
 
     # traverse the ast to insert opaque predicates
-    for func in node.functions:
+    for func in list(node.functions):
         if hasattr(func, "body"):
             body: Block = func.body
 
-            x, y = random_number(), random_number()
-            x_name, y_name = (
-                random_name(),
-                random_name(),
-            )  # TODO: label name conflict
-            x_dec_stmt = EVAR("int", x_name, x, stmt=True)
-            y_dec_stmt = EVAR("int", y_name, y, stmt=True)
-
-            statements = body.main
-            opaque_false = random.choice(OPAQUE_FALSE)
-            opaque = IF(
-                cond=opaque_false(x_name=x_name, x=x, y_name=y_name, y=y),
-                true_body=garbage_code(length=4),
-                false_body=BLK(statements),
-            )
+            rounds = policy.predicates(func)
+            if rounds == 0:
+                logger.debug(f"Skipping {policy.level(func)} function {func}")
+                continue
+
+            inputs = input_kind(func, predicate_inputs)
+            candidates = [
+                p
+                for p in OPAQUE_FALSE
+                if predicate_budget is None
+                or predicate_cost(p, inputs, measured)[0] <= predicate_budget
+            ]
+            if len(candidates) == 0:
+                logger.debug(f"No opaque predicate fits the budget of {func}")
+                continue
+            if predicate_budget is not None:
+                cheapest = min(predicate_cost(p, inputs, measured)[0] for p in candidates)
+                rounds = min(rounds, predicate_budget // max(cheapest, 1))
+                candidates = [
+                    p
+                    for p in candidates
+                    if predicate_cost(p, inputs, measured)[0] * rounds <= predicate_budget
+                ]
+
+            if inputs == "local":
+                x_name, x, y_name, y, prologue = gen_inputs("local", rng)
+            elif inputs == "constant":
+                if constants is None:
+                    constants = gen_inputs("constant", rng)
+                    index = 0
+                    for n in node:
+                        if isinstance(n, PragmaDirective):
+                            index += 1
+                        else:
+                            break
+                    node.main[index:index] = constants[4]
+                x_name, x, y_name, y, _ = constants
+                prologue = []
+            else:
+                contract = func.parent
+                if id(contract) not in immutables:
+                    immutables[id(contract)] = gen_inputs("immutable", rng)
+                    contract.main[0:0] = immutables[id(contract)][4]
+                x_name, x, y_name, y, _ = immutables[id(contract)]
+                prologue = []
+
+            # Detach the statements first so that they are moved instead of
+            # copied into the new block
+            statements = list(body.main)
+            body.main.clear()
+
+            for _ in range(rounds):
+                opaque_false = rng.choice(candidates)
+                opaque = IF(
+                    cond=opaque_false(x_name=x_name, x=x, y_name=y_name, y=y),
+                    true_body=garbage_code(length=policy.junk(func), rng=rng),
+                    false_body=BLK(statements),
+                )
+                statements = [opaque]
+
+                gas, size = predicate_cost(opaque_false, inputs, measured)
+                total_gas += gas
+                total_size += size
 
-            body.main = [x_dec_stmt, y_dec_stmt, opaque]
+            body.main = [*prologue, *statements]
 
-    logger.debug("Opaque predicates insertion done")
+    logger.debug(
+        f"Opaque predicates insertion done, estimated overhead: {total_gas} gas "
+        f"over all functions, {total_size} bytes"
+    )
 
     return node
@@ -0,0 +1,243 @@
+import json
+import logging
+import re
+from copy import copy
+
+from .solidity.nodes import (
+    ContractDefinition,
+    FunctionDefinition,
+    ModifierDefinition,
+    NodeBase,
+)
+
+logger = logging.getLogger(__name__)
+
+# NatSpec tag to pin the intensity of a function, e.g.
+# /// @custom:obfuscate hot
+NATSPEC_TAG = re.compile(r"@custom:obfuscate\s+(\w+)")
+
+# What every intensity level gets, functions on hot paths are left as they are
+# so that production gas stays close to the baseline. "constants" and
+# "literals" are opaque constants and dfo literal tables, hot functions keep
+# them as they cost little per call
+LEVELS = {
+    "off": {
+        "flatten": False,
+        "predicates": 0,
+        "junk": 0,
+        "constants": False,
+        "literals": False,
+    },
+    "hot": {
+        "flatten": False,
+        "predicates": 0,
+        "junk": 0,
+        "constants": True,
+        "literals": True,
+    },
+    "normal": {
+        "flatten": True,
+        "predicates": 1,
+        "junk": 4,
+        "constants": True,
+        "literals": True,
+    },
+    "cold": {
+        "flatten": True,
+        "predicates": 2,
+        "junk": 8,
+        "constants": True,
+        "literals": True,
+    },
+}
+
+# Levels from the most to the least intense, each back-off step moves the
+# functions of a contract one level down
+LADDER = ["cold", "normal", "hot", "off"]
+
+
+def function_key(func: NodeBase) -> str:
+    """
+    Name a function the way profiles do: Contract.function, free functions are
+    named by themselves. Unnamed functions are named by their kind, e.g.
+    Contract.constructor, Contract.fallback.
+    """
+    name = getattr(func, "name", "") or getattr(func, "kind", "")
+    if isinstance(func.parent, ContractDefinition):
+        return f"{func.parent.name}.{name}"
+    return name
+
+
+def scope_of(node: NodeBase) -> NodeBase | None:
+    """
+    The function, modifier or contract *node* is in, whose level applies to
+    it. None if it's at the file level.
+    """
+    curr = node.parent
+    while curr is not None:
+        if isinstance(curr, (FunctionDefinition, ModifierDefinition)):
+            return curr
+        elif isinstance(curr, ContractDefinition):
+            return curr
+        curr = curr.parent
+    return None
+
+
+def profile_weight(entry) -> float:
+    """A profile entry is a call count / gas number or {"calls": n, "gas": g}."""
+    if isinstance(entry, dict):
+        if "gas" in entry:
+            return float(entry["gas"])
+        return float(entry.get("calls", 0))
+    return float(entry)
+
+
+class Policy:
+    """
+    Obfuscation intensity of every function, picked from a call frequency or
+    gas profile and NatSpec tags. Tags win over the profile, functions that
+    neither mention are "normal".
+
+    Call assign() before any plugin renames the functions, the levels are then
+    kept by the solc AST ids which survive renaming and copying.
+
+    Arguments:
+        profile(dict): {"Contract.function": weight}, see profile_weight()
+        hot_threshold(float): functions weighing at least this much are "hot",
+            default 10% of the heaviest function, no function is hot by
+            default if they all weigh nothing
+        cold_threshold(float): functions weighing at most this much are "cold",
+            it wins over *hot_threshold* if they overlap
+    """
+
+    def __init__(
+        self,
+        profile: dict | None = None,
+        hot_threshold: float | None = None,
+        cold_threshold: float = 0,
+    ):
+        self.weights = {k: profile_weight(v) for k, v in (profile or {}).items()}
+        if hot_threshold is None and len(self.weights) > 0:
+            heaviest = max(self.weights.values())
+            if heaviest > 0:
+                hot_threshold = heaviest * 0.1
+        self.hot_threshold = hot_threshold
+        self.cold_threshold = cold_threshold
+        self.levels = {}  # {function id: level}
+        self.backoff = {}  # {contract id: steps}
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "Policy":
+        with open(path, "r") as fp:
+            profile = json.load(fp)
+        logger.debug(f"Loaded profile of {len(profile)} functions from {path}")
+        return cls(profile=profile, **kwargs)
+
+    def job(self) -> "Policy":
+        """
+        A policy of the same profile and thresholds for one job, with its own
+        levels and back-off steps, see Context.
+        """
+        policy = copy(self)
+        policy.levels = {}
+        policy.backoff = {}
+        return policy
+
+    def assign(self, unit: NodeBase):
+        """Pick the levels of all functions in *unit* by their current names."""
+        for func in unit.functions:
+            if hasattr(func, "id"):
+                self.levels[func.id] = self.base_level(func)
+
+    def level(self, func: NodeBase) -> str:
+        """
+        Level of a function, or of the code of a contract outside its
+        functions, e.g. state variable values, which starts as "normal".
+        """
+        if isinstance(func, ContractDefinition):
+            level, contract = "normal", func
+        else:
+            level, contract = self.levels.get(getattr(func, "id", None)), func.parent
+        if level is None:
+            level = self.base_level(func)
+        steps = self.backoff.get(getattr(contract, "id", None), 0)
+        if steps > 0 and level in LADDER:
+            level = LADDER[min(LADDER.index(level) + steps, len(LADDER) - 1)]
+        return level
+
+    def base_level(self, func: NodeBase) -> str:
+        documentation = getattr(func, "documentation", None)
+        text = getattr(documentation, "text", None) or ""
+        match = NATSPEC_TAG.search(text)
+        if match is not None:
+            if match.group(1) in LEVELS:
+                return match.group(1)
+            logger.warning(f"Unknown obfuscation level {match.group(1)} of {func}")
+
+        # Only qualified names, functions of the same name in different
+        # contracts are different functions
+        weight = self.weights.get(function_key(func))
+        if weight is None:
+            return "normal"
+        if weight <= self.cold_threshold:
+            return "cold"
+        if self.hot_threshold is not None and weight >= self.hot_threshold:
+            return "hot"
+        return "normal"
+
+    def reset(self):
+        """Forget the levels and back-off steps of the previous tree."""
+        self.levels.clear()
+        self.backoff.clear()
+
+    def back_off(self, contract: ContractDefinition) -> list[str]:
+        """
+        Lower the intensity of every function in *contract* by one level.
+
+        Returns:
+            out: what has been given up, empty if nothing is left to give up
+        """
+        scopes = [contract, *(f for f in contract.functions() if hasattr(f, "body"))]
+        before = {id(f): LEVELS[self.level(f)] for f in scopes}
+        self.backoff[contract.id] = self.backoff.get(contract.id, 0) + 1
+
+        given_up = []
+        for scope in scopes:
+            old, new = before[id(scope)], LEVELS[self.level(scope)]
+            name = contract.name if scope is contract else function_key(scope)
+            # Outside the functions there's no control flow to obfuscate
+            if scope is not contract:
+                if old["flatten"] and not new["flatten"]:
+                    given_up.append(f"flattening of {name}")
+                if new["predicates"] < old["predicates"]:
+                    given_up.append(
+                        f"{old['predicates'] - new['predicates']} opaque "
+                        f"predicate(s) of {name}"
+                    )
+            if old["constants"] and not new["constants"]:
+                given_up.append(f"opaque constants of {name}")
+            if old["literals"] and not new["literals"]:
+                given_up.append(f"literal tables of {name}")
+        return given_up
+
+    def flatten(self, func: NodeBase) -> bool:
+        """Whether to flatten the control flow of *func*."""
+        return LEVELS[self.level(func)]["flatten"]
+
+    def predicates(self, func: NodeBase) -> int:
+        """How many opaque predicates to wrap the body of *func* in."""
+        return LEVELS[self.level(func)]["predicates"]
+
+    def junk(self, func: NodeBase) -> int:
+        """How many garbage statements to put in each dead branch of *func*."""
+        return LEVELS[self.level(func)]["junk"]
+
+    def constants(self, node: NodeBase) -> bool:
+        """Whether to hide the literal *node* behind an opaque constant."""
+        scope = scope_of(node)
+        return scope is None or LEVELS[self.level(scope)]["constants"]
+
+    def literals(self, node: NodeBase) -> bool:
+        """Whether to move the literal *node* into a dfo literal table."""
+        scope = scope_of(node)
+        return scope is None or LEVELS[self.level(scope)]["literals"]
@@ -0,0 +1,164 @@
+import cProfile
+import json
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from .solidity.nodes import NodeBase
+
+logger = logging.getLogger(__name__)
+
+
+def count_nodes(root: NodeBase) -> int:
+    count = 0
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        count += 1
+        stack.extend(node._children)
+    return count
+
+
+class Phase:
+    """What a phase hook has measured, see RunProfiler.phase()."""
+
+    def __init__(self, name: str, nodes_before: int | None = None):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.nodes_before = nodes_before
+        self.nodes_after = None
+        self.peak_memory = None
+        self.root = None
+
+    def result(self, root: NodeBase):
+        """Give the root node the phase has produced, its nodes are counted."""
+        self.root = root
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "nodes_before": self.nodes_before,
+            "nodes_after": self.nodes_after,
+            "peak_memory": self.peak_memory,
+        }
+
+
+class RunProfiler:
+    """
+    Hooks around the phases of the obfuscation: compile, load, every plugin and
+    build. Every phase records its wall and CPU time and the node counts before
+    and after it, optionally the peak memory allocated and a cProfile dump.
+
+    Arguments:
+        enabled(bool): if turned off, the hooks do nothing
+        memory(bool): trace the peak memory allocated by every phase, it slows
+            the phases down a lot
+        profile_dir(str): dump the cProfile stats of every phase in this
+            directory as [run].[file].[seq].[phase].prof, *seq* is the index
+            of the phase in the run as phases repeat, e.g. for every variant
+    """
+
+    def __init__(
+        self, enabled: bool = True, memory: bool = False, profile_dir: str = None
+    ):
+        self.enabled = enabled
+        self.memory = memory
+        self.profile_dir = profile_dir
+        self.runs = []
+
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def start_run(self, file: str):
+        """Start recording the phases of *file*."""
+        if self.enabled:
+            self.runs.append({"file": file, "phases": []})
+
+    @contextmanager
+    def phase(self, name: str, root: NodeBase | None = None):
+        """
+        Measure the code in the with statement, call result() of the returned
+        Phase to count the nodes it has produced.
+
+            with profiler.phase("plugin", root) as phase:
+                root = plugin.run(root)
+                phase.result(root)
+        """
+        if not self.enabled or len(self.runs) == 0:
+            yield Phase(name)
+            return
+
+        phase = Phase(name, count_nodes(root) if root is not None else None)
+
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+
+        profile = None
+        if self.profile_dir is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield phase
+        finally:
+            phase.wall = time.perf_counter() - wall
+            phase.cpu = time.process_time() - cpu
+
+            if profile is not None:
+                profile.disable()
+                run = len(self.runs) - 1
+                file = os.path.basename(self.runs[-1]["file"])
+                seq = len(self.runs[-1]["phases"])
+                path = os.path.join(self.profile_dir, f"{run}.{file}.{seq}.{name}.prof")
+                profile.dump_stats(path)
+            if self.memory:
+                phase.peak_memory = tracemalloc.get_traced_memory()[1] - base
+            if tracing:
+                tracemalloc.stop()
+
+            if phase.root is not None:
+                phase.nodes_after = count_nodes(phase.root)
+                phase.root = None
+            self.runs[-1]["phases"].append(phase.to_dict())
+            logger.debug(
+                f"Phase {name} done in {phase.wall:.6f}s, CPU {phase.cpu:.6f}s"
+            )
+
+    def aggregate(self) -> dict[str, dict]:
+        """Sum up the phases of the same name over all runs."""
+        total = {}
+        for run in self.runs:
+            for phase in run["phases"]:
+                entry = total.setdefault(
+                    phase["name"],
+                    {"count": 0, "wall": 0.0, "cpu": 0.0, "peak_memory": None},
+                )
+                entry["count"] += 1
+                entry["wall"] += phase["wall"]
+                entry["cpu"] += phase["cpu"]
+                if phase["peak_memory"] is not None:
+                    entry["peak_memory"] = max(
+                        entry["peak_memory"] or 0, phase["peak_memory"]
+                    )
+        return total
+
+    def to_dict(self) -> dict:
+        for run in self.runs:
+            run["wall"] = sum(p["wall"] for p in run["phases"])
+            run["cpu"] = sum(p["cpu"] for p in run["phases"])
+        return {"runs": self.runs, "aggregate": self.aggregate()}
+
+    def dump(self, path: str):
+        with open(path, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=2)
+        logger.info(f"Run report written to {path}")
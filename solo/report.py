@@ -0,0 +1,232 @@
+import json
+import logging
+import time
+
+import solcx
+
+from .context import Context, random_seed
+from .plugins import dataFlowObfuscation
+from .solidity.nodes import NodeBase, SourceBuilder, SourceUnit
+
+logger = logging.getLogger(__name__)
+
+
+def gas_value(gas: str) -> int | None:
+    """solc reports gas as a decimal string, or "infinite" if it's unbounded."""
+    return None if gas == "infinite" else int(gas)
+
+
+def compile_source(src: str) -> dict[str, dict]:
+    """
+    Compile *src* and collect the runtime size and gas estimates of every
+    contract.
+
+    Returns:
+        out: {contract name: {"size": bytes, "creation": gas,
+            "external": {signature: gas}, "internal": {signature: gas}}},
+            gas is None if solc cannot bound it
+    """
+    solc_options = {
+        "language": "Solidity",
+        "sources": {"temp.sol": {"content": src}},
+        "settings": {
+            "outputSelection": {
+                "*": {"*": ["evm.deployedBytecode.object", "evm.gasEstimates"]}
+            }
+        },
+    }
+    output_json = solcx.compile_standard(solc_options)
+
+    stats = {}
+    for name, contract in output_json["contracts"]["temp.sol"].items():
+        evm = contract["evm"]
+        estimates = evm.get("gasEstimates") or {}
+        creation = estimates.get("creation", {}).get("totalCost", "infinite")
+        stats[name] = {
+            "size": len(evm["deployedBytecode"]["object"]) // 2,
+            "creation": gas_value(creation),
+            "external": {
+                sig: gas_value(gas)
+                for sig, gas in estimates.get("external", {}).items()
+            },
+            "internal": {
+                sig: gas_value(gas)
+                for sig, gas in estimates.get("internal", {}).items()
+            },
+        }
+    return stats
+
+
+def delta(new: int | None, old: int | None) -> int | None:
+    if new is None or old is None:
+        return None
+    return new - old
+
+
+# dfo options of every way of keeping the literal tables
+LITERAL_TABLES = {
+    "storage": {"literal_tables": "storage"},
+    "packed": {"literal_tables": "storage", "pack_literals": True},
+    "code": {"literal_tables": "code"},
+}
+
+
+def compare_literal_tables(
+    root: SourceUnit, shared_helpers: bool = False, seed: int | None = None
+) -> dict:
+    """
+    Measure the literal tables of dfo: a copy of *root* is obfuscated by dfo
+    alone with every kind of tables and compiled, the size and the gas
+    estimates of solc are compared with the source without dfo. Every kind is
+    generated with the same *seed*, a random one if None.
+
+    Returns:
+        out: {"original" or kind of tables: {contract name: stats}}, stats are
+            as in compile_source(), with "size_delta", "creation_delta" and
+            "external_delta" against the original, kinds that don't compile
+            are left out
+    """
+    builder = SourceBuilder()
+    original = compile_source(builder.build(root))
+    results = {"original": original}
+    if seed is None:
+        seed = random_seed()
+
+    for kind, options in LITERAL_TABLES.items():
+        node = dataFlowObfuscation.run(
+            root.clone(),
+            shared_helpers=shared_helpers,
+            context=Context(seed),
+            **options,
+        )
+        try:
+            stats = compile_source(builder.build(node))
+        except Exception as e:
+            logger.error(f"Cannot compile {kind} literal tables, not compared.\n{e}")
+            continue
+
+        for name, stat in stats.items():
+            if name not in original:
+                continue
+            stat["size_delta"] = stat["size"] - original[name]["size"]
+            stat["creation_delta"] = delta(
+                stat["creation"], original[name]["creation"]
+            )
+            stat["external_delta"] = {
+                sig: delta(gas, original[name]["external"].get(sig))
+                for sig, gas in stat["external"].items()
+            }
+        results[kind] = stats
+    return results
+
+
+class GasReport:
+    """
+    Static gas and bytecode overhead of every plugin, the source is compiled
+    after every stage and compared with the previous one.
+
+    Contracts and functions are reported by their original names, renamed ones
+    are matched by their position and solc AST ids. Every source unit of a run
+    is reported separately, by the name it's given in original().
+    """
+
+    def __init__(self):
+        self.builder = SourceBuilder()
+        self.units = {}  # {unit name: {"plugins": [...], "contracts": {...}}}
+        self.plugins = []  # of the current unit
+        self.contracts = {}  # {original name: [stage stats]} of the current unit
+        self.contract_names = []  # original names in source order
+        self.function_names = {}  # {function id: original name}
+
+    def original(self, root: SourceUnit, unit: str = "temp.sol"):
+        """
+        Record the names and the stats of the source before obfuscation, the
+        following stages are reported as *unit*. Reporting a unit again, e.g.
+        when the budget runs the plugins again, replaces it.
+        """
+        self.plugins, self.contracts = [], {}
+        self.units[unit] = {"plugins": self.plugins, "contracts": self.contracts}
+        self.contract_names = [c.name for c in root.contracts]
+        self.function_names = {
+            f.id: f.name for f in root.functions if hasattr(f, "id")
+        }
+        self.stage("original", root)
+
+    def rename_signature(self, sig: str, names: dict[str, str]) -> str:
+        name, _, params = sig.partition("(")
+        return f"{names.get(name, name)}({params}"
+
+    def stage(self, plugin: str, root: SourceUnit):
+        """Compile *root* and record its stats as the output of *plugin*."""
+        try:
+            stats = compile_source(self.builder.build(root))
+        except Exception as e:
+            logger.error(f"Cannot compile the output of {plugin}, not reported.\n{e}")
+            return
+
+        if plugin != "original":
+            self.plugins.append(plugin)
+
+        # {current name: original name}
+        names = {
+            f.name: self.function_names[f.id]
+            for f in root.functions
+            if getattr(f, "id", None) in self.function_names
+        }
+
+        for contract, name in zip(root.contracts, self.contract_names):
+            if contract.name not in stats:
+                continue
+            stat = stats[contract.name]
+            stages = self.contracts.setdefault(name, [])
+            previous = stages[-1] if len(stages) > 0 else None
+
+            entry = {"plugin": plugin, "size": stat["size"]}
+            entry["creation"] = stat["creation"]
+            for kind in ("external", "internal"):
+                entry[kind] = {
+                    self.rename_signature(sig, names): gas
+                    for sig, gas in stat[kind].items()
+                }
+
+            if previous is not None:
+                entry["size_delta"] = entry["size"] - previous["size"]
+                entry["creation_delta"] = delta(
+                    entry["creation"], previous["creation"]
+                )
+                for kind in ("external", "internal"):
+                    entry[f"{kind}_delta"] = {
+                        sig: delta(gas, previous[kind].get(sig))
+                        for sig, gas in entry[kind].items()
+                    }
+            stages.append(entry)
+
+    def to_dict(self) -> dict:
+        units = {}
+        for unit, report in self.units.items():
+            contracts = {}
+            for name, stages in report["contracts"].items():
+                first, last = stages[0], stages[-1]
+                contracts[name] = {
+                    "stages": stages,
+                    "total": {
+                        "size_delta": last["size"] - first["size"],
+                        "creation_delta": delta(last["creation"], first["creation"]),
+                        "external_delta": {
+                            sig: delta(gas, first["external"].get(sig))
+                            for sig, gas in last["external"].items()
+                        },
+                    },
+                }
+            units[unit] = {"plugins": report["plugins"], "contracts": contracts}
+
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "solc": str(solcx.get_solc_version()),
+            "units": units,
+        }
+
+    def dump(self, path: str):
+        with open(path, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=2)
+        logger.info(f"Gas report written to {path}")
@@ -0,0 +1,149 @@
+"""
+This module loads syntax trees from existing build artifacts, such as solc
+standard json output, Hardhat build-info files and Foundry out/ artifacts,
+without loading the whole file.
+
+The file is memory-mapped and scanned, only the ASTs of the requested source
+units are decoded, everything else is skipped over.
+"""
+
+import json
+import mmap
+import re
+from typing import Iterable
+
+from .nodes import SourceUnit, node_class_factory
+from .utils import project
+
+WHITESPACE = re.compile(rb"\s*")
+STRING = re.compile(rb'"[^"\\]*+(?:\\.[^"\\]*+)*+"')
+SCALAR = re.compile(rb"[^,}\]\s]+")
+# Everything up to the next bracket, strings are consumed as a whole so that
+# brackets in them are skipped. Possessive quantifiers keep it linear.
+BRACKET = re.compile(rb'(?:[^"{}\[\]]++|"[^"\\]*+(?:\\.[^"\\]*+)*+")*+([{}\[\]])')
+
+
+def skip_value(buf, pos: int) -> int:
+    """Returns the end offset of the JSON value starting at *pos*."""
+    pos = WHITESPACE.match(buf, pos).end()
+    char = buf[pos : pos + 1]
+    if char == b'"':
+        return STRING.match(buf, pos).end()
+    if char in (b"{", b"["):
+        depth = 0
+        while True:
+            m = BRACKET.match(buf, pos)
+            if m is None:
+                raise ValueError(f"Unterminated JSON value at {pos}")
+            pos = m.end()
+            depth += 1 if buf[pos - 1] in b"{[" else -1
+            if depth == 0:
+                return pos
+    # Numbers, true, false and null
+    return SCALAR.match(buf, pos).end()
+
+
+def iter_members(buf, pos: int) -> "Iterable[tuple[str, int]]":
+    """
+    Iterates over the members of the JSON object starting at *pos*, the value
+    of a member is only skipped over when the iteration goes on, so breaking
+    out at the member you want costs nothing.
+
+    Returns:
+        out: (key, start) of every member, the value starts at buf[start]
+    """
+    pos = WHITESPACE.match(buf, pos).end()
+    if buf[pos : pos + 1] != b"{":
+        raise ValueError(f"Expect a JSON object at {pos}")
+    pos += 1
+
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        char = buf[pos : pos + 1]
+        if char == b"}":
+            return
+        elif char == b",":
+            pos += 1
+            continue
+
+        m = STRING.match(buf, pos)
+        if m is None:
+            raise ValueError(f"Expect a key at {pos}")
+        key = json.loads(m.group())
+        pos = WHITESPACE.match(buf, m.end()).end()
+        if buf[pos : pos + 1] != b":":
+            raise ValueError(f"Expect ':' at {pos}")
+
+        start = WHITESPACE.match(buf, pos + 1).end()
+        yield key, start
+        pos = skip_value(buf, start)
+
+
+def find_member(buf, pos: int, key: str) -> int | None:
+    """Returns the start offset of *key* in the object at *pos*."""
+    for k, start in iter_members(buf, pos):
+        if k == key:
+            return start
+    return None
+
+
+def decode(buf, pos: int):
+    """Decode the JSON value starting at *pos*."""
+    return json.loads(buf[pos : skip_value(buf, pos)])
+
+
+def load_artifact(
+    path: str, sources: Iterable[str] | None = None, fields: set | None = None
+) -> dict[str, SourceUnit]:
+    """
+    Load the source units of a build artifact without reading the whole file.
+
+    Supported layouts are solc standard json output ({"sources": ...}), Hardhat
+    and Foundry build-info files ({"output": {"sources": ...}}) and Foundry
+    per-contract artifacts ({"ast": ...}).
+
+    Arguments:
+        path: path of the artifact
+        sources: source unit names (absolute paths as in the artifact) to load,
+            all of them if None
+        fields: annotations to keep, all of them if None, see utils.project()
+
+    Returns:
+        out: {source unit name: SourceUnit}
+    """
+    wanted = set(sources) if sources is not None else None
+    units = {}
+
+    def load(ast: dict) -> SourceUnit:
+        return node_class_factory(ast if fields is None else project(ast, fields))
+
+    with open(path, "rb") as fp, mmap.mmap(
+        fp.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buf:
+        found = None
+        for key, start in iter_members(buf, 0):
+            if key == "ast":
+                unit = load(decode(buf, start))
+                if wanted is None or unit.absolutePath in wanted:
+                    units[unit.absolutePath] = unit
+                return units
+            elif key == "output":
+                found = find_member(buf, start, "sources")
+                break
+            elif key == "sources":
+                found = start
+                break
+        if found is None:
+            raise ValueError(f"No sources found in {path}")
+
+        for name, start in iter_members(buf, found):
+            if wanted is not None and name not in wanted:
+                continue
+            ast = find_member(buf, start, "ast")
+            if ast is None:
+                continue
+            units[name] = load(decode(buf, ast))
+            if wanted is not None and len(units) == len(wanted):
+                break
+
+    return units
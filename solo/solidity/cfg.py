@@ -0,0 +1,606 @@
+"""
+This module provides a per-function control flow graph (CFG) shared by plugins.
+
+Basic blocks do not copy statements, they hold ranges of the statement lists of
+the function body. Analyses are computed on demand and cached, the cache is
+dropped whenever the graph or the function body changes.
+"""
+
+import random
+from collections import deque
+from typing import Callable, Generator, Iterable
+
+from .nodes import *
+
+
+class StatementRange:
+    """
+    A view of the statements *stmts[start:stop]*, nothing is copied.
+
+    Arguments:
+        stmts: the statement list, usually the *statements* of a Block
+        start: index of the first statement
+        stop: index after the last statement, default to the end of *stmts*
+    """
+
+    def __init__(self, stmts: list | tuple, start: int = 0, stop: int | None = None):
+        self.stmts = stmts
+        self.start = start
+        self.stop = len(stmts) if stop is None else stop
+
+    def head(self, length: int) -> "StatementRange":
+        """The first *length* statements of this range."""
+        return StatementRange(self.stmts, self.start, self.start + length)
+
+    def tail(self, index: int) -> "StatementRange":
+        """Statements of this range starting at *index*."""
+        return StatementRange(self.stmts, self.start + index, self.stop)
+
+    def __iter__(self) -> Iterable:
+        for i in range(self.start, self.stop):
+            yield self.stmts[i]
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __repr__(self) -> str:
+        return f"<StatementRange [{self.start}:{self.stop}] {id(self.stmts)}>"
+
+
+def range_of(node: NodeBase | None) -> StatementRange:
+    """Statements of a block, a single statement or nothing."""
+    if node is None:
+        return StatementRange(())
+    elif isinstance(node, Block):
+        return StatementRange(node.statements)
+    else:
+        return StatementRange((node,))
+
+
+class StateSegment:
+
+    def __init__(
+        self,
+        state: int,
+        next_state: int,
+        body: StatementRange,
+        break_to: int | None = None,
+        continue_at: int | None = None,
+    ):
+        self.state = state
+        self.body = body
+        self.next_state = next_state
+        if break_to is not None:
+            self.break_to = break_to
+        if continue_at is not None:
+            self.continue_at = continue_at
+
+
+class BasicBlock:
+    """
+    A basic block, its body is a list of statement ranges and single nodes.
+
+    If *cond* is present, the block jumps to *jump_state* when *cond* holds and
+    to *next_state* otherwise.
+    """
+
+    def __init__(
+        self,
+        state: int,
+        next_state: int,
+        body: Iterable = [],
+        cond: NodeBase | None = None,
+        jump_state: int | None = None,
+    ):
+        self.state = state
+        self.body = list(body)
+        self.next_state = next_state
+        if cond is not None:
+            self.cond = cond
+            self.jump_state = jump_state
+
+    @property
+    def statements(self) -> "Generator[NodeBase]":
+        for part in self.body:
+            if isinstance(part, StatementRange):
+                yield from part
+            elif part is not None:
+                yield part
+
+    @property
+    def edges(self) -> int:
+        return 2 if hasattr(self, "cond") else 1
+
+    @property
+    def successors(self) -> list[int]:
+        if hasattr(self, "cond"):
+            return [self.next_state, self.jump_state]
+        return [self.next_state]
+
+    def is_empty(self) -> bool:
+        return all(
+            part is None or (isinstance(part, StatementRange) and len(part) == 0)
+            for part in self.body
+        )
+
+    def is_forwarding(self) -> bool:
+        """An unconditional block with an empty body, it only jumps."""
+        return self.is_empty() and not hasattr(self, "cond")
+
+
+class CFG:
+
+    BRANCH_STMT = (IfStatement, ForStatement, WhileStatement, DoWhileStatement)
+    STATE_LB = 1 << 127
+    STATE_UB = (1 << 128) - 1
+
+    def gen_state(self):
+        state = self.rand.randint(CFG.STATE_LB, CFG.STATE_UB)
+        while state in self.states:
+            state = self.rand.randint(CFG.STATE_LB, CFG.STATE_UB)
+        self.states.add(state)
+        return state
+
+    def __init__(self, rng: random.Random | None = None):
+        # The states are drawn from their own generator seeded by *rng*, the
+        # random generator of the job, the global one if None
+        self.seed = (rng or random).randint(CFG.STATE_LB, CFG.STATE_UB)
+        self.rand = random.Random(x=self.seed)
+        self.states = set()
+        self.blocks: dict[int, BasicBlock] = {}
+        self.init_state = self.gen_state()
+        self.end_state = self.gen_state()
+        self._analyses: dict = {}
+
+    def add_bb(
+        self,
+        state: int,
+        next_state: int,
+        body: list = [],
+        cond: NodeBase | None = None,
+        jump_state: int | None = None,
+    ):
+        if state in self.blocks:
+            raise ValueError("Conflict state, check it again")
+
+        if state not in self.states:
+            raise ValueError("Unknown state, check it again")
+
+        self.blocks[state] = BasicBlock(
+            state=state,
+            next_state=next_state,
+            body=body,
+            cond=cond,
+            jump_state=jump_state,
+        )
+        self.invalidate()
+
+    @property
+    def edges(self) -> int:
+        return sum(bb.edges for bb in self.blocks.values())
+
+    def get_bb(self, state: int):
+        return self.blocks[state]
+
+    def remove_bb(self, state: int):
+        self.blocks.pop(state)
+        self.states.discard(state)
+        self.invalidate()
+
+    def redirect(self, old_state: int, new_state: int):
+        """Make every jump to *old_state* go to *new_state* instead."""
+        for bb in self.blocks.values():
+            if bb.next_state == old_state:
+                bb.next_state = new_state
+            if hasattr(bb, "cond") and bb.jump_state == old_state:
+                bb.jump_state = new_state
+        if self.init_state == old_state:
+            self.init_state = new_state
+        self.invalidate()
+
+    def eliminate_forwarding(self):
+        """
+        Remove blocks that have an empty body and only jump to the next state,
+        jumps to them are redirected to their targets.
+        """
+        for state in list(self.blocks):
+            bb = self.blocks.get(state)
+            # A forwarding block jumping to itself is an empty infinite loop,
+            # keep it
+            if bb is None or not bb.is_forwarding() or bb.next_state == state:
+                continue
+            self.redirect(state, bb.next_state)
+            self.remove_bb(state)
+
+    def coalesce(self):
+        """
+        Merge straight-line chains, i.e. an unconditional block and its
+        successor which has no other predecessors.
+        """
+        preds = {state: 0 for state in self.blocks}
+        for bb in self.blocks.values():
+            for succ in bb.successors:
+                if succ in preds:
+                    preds[succ] += 1
+
+        for state in list(self.blocks):
+            bb = self.blocks.get(state)
+            while bb is not None and not hasattr(bb, "cond"):
+                succ = bb.next_state
+                if (
+                    succ == state
+                    or succ == self.init_state
+                    or succ not in self.blocks
+                    or preds[succ] != 1
+                ):
+                    break
+
+                nb = self.blocks[succ]
+                bb.body.extend(nb.body)
+                bb.next_state = nb.next_state
+                if hasattr(nb, "cond"):
+                    bb.cond = nb.cond
+                    bb.jump_state = nb.jump_state
+                self.remove_bb(succ)
+
+    def optimize(self):
+        """Shrink the CFG so that the dispatcher loop iterates less."""
+        self.eliminate_forwarding()
+        self.coalesce()
+
+    def invalidate(self):
+        """Drop all cached analyses, call it after modifying the blocks."""
+        self._analyses.clear()
+
+    def _cached(self, key: str, compute: Callable):
+        if key not in self._analyses:
+            self._analyses[key] = compute()
+        return self._analyses[key]
+
+    @property
+    def predecessors(self) -> dict[int, list[int]]:
+        """Predecessors of every state, including the end state."""
+        return self._cached("predecessors", self._predecessors)
+
+    def _predecessors(self) -> dict[int, list[int]]:
+        preds = {state: [] for state in self.blocks}
+        preds.setdefault(self.end_state, [])
+        for state, bb in self.blocks.items():
+            for succ in bb.successors:
+                preds.setdefault(succ, []).append(state)
+        return preds
+
+    @property
+    def reachable(self) -> set[int]:
+        """Blocks reachable from the initial state."""
+        return self._cached("reachable", self._reachable)
+
+    def _reachable(self) -> set[int]:
+        visited = set()
+        bfs_queue = deque([self.init_state])
+        while len(bfs_queue) > 0:
+            state = bfs_queue.popleft()
+            if state in visited or state not in self.blocks:
+                continue
+            visited.add(state)
+            bfs_queue.extend(self.blocks[state].successors)
+        return visited
+
+    @property
+    def rpo(self) -> list[int]:
+        """Reachable blocks in reverse post-order."""
+        return self._cached("rpo", self._rpo)
+
+    def _rpo(self) -> list[int]:
+        order = []
+        visited = set()
+        if self.init_state in self.blocks:
+            # Iterative DFS, *i* is the index of the next successor to visit
+            stack = [(self.init_state, 0)]
+            visited.add(self.init_state)
+            while len(stack) > 0:
+                state, i = stack.pop()
+                succs = self.blocks[state].successors
+                if i < len(succs):
+                    stack.append((state, i + 1))
+                    succ = succs[i]
+                    if succ in self.blocks and succ not in visited:
+                        visited.add(succ)
+                        stack.append((succ, 0))
+                else:
+                    order.append(state)
+        order.reverse()
+        return order
+
+    @property
+    def dominators(self) -> dict[int, frozenset[int]]:
+        """Dominator set of every reachable block."""
+        return self._cached("dominators", self._dominators)
+
+    def _dominators(self) -> dict[int, frozenset[int]]:
+        order = self.rpo
+        if len(order) == 0:
+            return {}
+
+        preds = self.predecessors
+        everything = frozenset(order)
+        dom = {state: everything for state in order}
+        dom[order[0]] = frozenset((order[0],))
+
+        changed = True
+        while changed is True:
+            changed = False
+            for state in order[1:]:
+                new_dom = None
+                for pred in preds[state]:
+                    if pred not in dom:
+                        continue  # unreachable predecessor
+                    new_dom = dom[pred] if new_dom is None else new_dom & dom[pred]
+                new_dom = (new_dom or frozenset()) | {state}
+                if new_dom != dom[state]:
+                    dom[state] = new_dom
+                    changed = True
+        return dom
+
+    @property
+    def loops(self) -> dict[int, frozenset[int]]:
+        """Natural loops as {header: blocks of the loop}."""
+        return self._cached("loops", self._loops)
+
+    def _loops(self) -> dict[int, frozenset[int]]:
+        dom = self.dominators
+        preds = self.predecessors
+        loops = {}
+        for tail in dom:
+            for header in self.blocks[tail].successors:
+                # A back edge is an edge to one of its dominators
+                if header not in dom[tail]:
+                    continue
+                body = set(loops.get(header, ()))
+                body.add(header)
+                stack = [tail]
+                while len(stack) > 0:
+                    state = stack.pop()
+                    if state in body:
+                        continue
+                    body.add(state)
+                    stack.extend(p for p in preds[state] if p in dom)
+                loops[header] = frozenset(body)
+        return loops
+
+    @property
+    def loop_parent(self) -> dict[int, int | None]:
+        """The header of the innermost enclosing loop of every loop header."""
+        return self._cached("loop_parent", self._loop_parent)
+
+    def _loop_parent(self) -> dict[int, int | None]:
+        loops = self.loops
+        parent = {}
+        for header, body in loops.items():
+            outer = [
+                h for h, b in loops.items() if h != header and body < b
+            ]
+            # The innermost enclosing loop is the smallest one
+            parent[header] = min(outer, key=lambda h: len(loops[h]), default=None)
+        return parent
+
+    @property
+    def loop_depth(self) -> dict[int, int]:
+        """Loop nesting depth of every reachable block, 0 if not in a loop."""
+        return self._cached("loop_depth", self._loop_depth)
+
+    def _loop_depth(self) -> dict[int, int]:
+        depth = {state: 0 for state in self.dominators}
+        for body in self.loops.values():
+            for state in body:
+                depth[state] += 1
+        return depth
+
+    @staticmethod
+    def gen_cfg(body: Block | list, rng: random.Random | None = None) -> "CFG":
+        cfg = CFG(rng)
+        if isinstance(body, Block):
+            body = range_of(body)
+        elif not isinstance(body, StatementRange):
+            body = StatementRange(body)
+        bfs_queue = deque(
+            [StateSegment(body=body, state=cfg.init_state, next_state=cfg.end_state)]
+        )
+
+        while len(bfs_queue) > 0:
+            ss: StateSegment = bfs_queue.popleft()
+            continue_at = getattr(ss, "continue_at", None)
+            break_to = getattr(ss, "break_to", None)
+
+            for i, x in enumerate(ss.body):
+
+                # Jump out statements
+                if isinstance(x, Continue):
+                    if continue_at is None:
+                        raise ValueError(
+                            "A continue statement in non-loop environment, maybe the AST is broken??"
+                        )
+                    cfg.add_bb(
+                        state=ss.state, next_state=continue_at, body=[ss.body.head(i)]
+                    )
+                    break
+                elif isinstance(x, Break):
+                    if break_to is None:
+                        raise ValueError(
+                            "A break statement in non-loop environment, maybe the AST is broken??"
+                        )
+                    cfg.add_bb(
+                        state=ss.state, next_state=break_to, body=[ss.body.head(i)]
+                    )
+                    break
+
+                # Do BFS on the final branch if present
+                # Otherwise, the final state should be ss's next state
+                if isinstance(x, CFG.BRANCH_STMT):
+                    if i == len(ss.body) - 1:
+                        final_state = ss.next_state
+                    else:
+                        final_state = cfg.gen_state()
+                        bfs_queue.append(
+                            StateSegment(
+                                state=final_state,
+                                next_state=ss.next_state,
+                                body=ss.body.tail(i + 1),
+                                continue_at=continue_at,
+                                break_to=break_to,
+                            )
+                        )
+
+                if isinstance(x, IfStatement):
+                    # Do BFS on the true branch
+                    true_body = range_of(x.trueBody)
+                    if len(true_body) == 0:
+                        true_state = final_state
+                    else:
+                        true_state = cfg.gen_state()
+                        bfs_queue.append(
+                            StateSegment(
+                                body=true_body,
+                                state=true_state,
+                                next_state=final_state,
+                                continue_at=continue_at,
+                                break_to=break_to,
+                            )
+                        )
+
+                    # Do BFS on the false branch if present
+                    false_body = range_of(getattr(x, "falseBody", None))
+                    if len(false_body) > 0:
+                        false_state = cfg.gen_state()
+                        bfs_queue.append(
+                            StateSegment(
+                                body=false_body,
+                                state=false_state,
+                                next_state=final_state,
+                                continue_at=continue_at,
+                                break_to=break_to,
+                            )
+                        )
+                    else:
+                        false_state = final_state
+
+                    cfg.add_bb(
+                        body=[ss.body.head(i)],
+                        state=ss.state,
+                        next_state=false_state,
+                        cond=x.condition,
+                        jump_state=true_state,
+                    )
+
+                    break
+
+                elif isinstance(x, ForStatement):
+                    cond_state = cfg.gen_state()
+                    loop_state = cfg.gen_state()
+
+                    true_state = cfg.gen_state()
+                    bfs_queue.append(
+                        StateSegment(
+                            state=true_state,
+                            next_state=loop_state,
+                            body=range_of(x.body),
+                            continue_at=loop_state,
+                            break_to=final_state,
+                        )
+                    )
+
+                    # Add the beginning block
+                    cfg.add_bb(
+                        state=ss.state,
+                        next_state=cond_state,
+                        body=[
+                            ss.body.head(i),
+                            getattr(x, "initializationExpression", None),
+                        ],
+                    )
+
+                    # Add the condition block, for(;;) loops forever
+                    if getattr(x, "condition", None) is None:
+                        cfg.add_bb(state=cond_state, next_state=true_state)
+                    else:
+                        cfg.add_bb(
+                            state=cond_state,
+                            next_state=final_state,
+                            cond=x.condition,
+                            jump_state=true_state,
+                        )
+
+                    # Add the loop block, eg. i+=1
+                    cfg.add_bb(
+                        state=loop_state,
+                        next_state=cond_state,
+                        body=[getattr(x, "loopExpression", None)],
+                    )
+
+                    break
+
+                elif isinstance(x, (WhileStatement, DoWhileStatement)):
+                    # Pre-compute state of the condition block
+                    cond_state = cfg.gen_state()
+
+                    # Do BFS on while body
+                    while_body = range_of(x.body)
+                    if len(while_body) == 0:
+                        true_state = cond_state
+                    else:
+                        true_state = cfg.gen_state()
+                        bfs_queue.append(
+                            StateSegment(
+                                state=true_state,
+                                next_state=cond_state,
+                                body=while_body,
+                                continue_at=cond_state,
+                                break_to=final_state,
+                            )
+                        )
+
+                    # Add the beginning block
+                    if isinstance(x, WhileStatement):  # while
+                        cfg.add_bb(
+                            state=ss.state,
+                            next_state=cond_state,
+                            body=[ss.body.head(i)],
+                        )
+                    else:  # do-while
+                        cfg.add_bb(
+                            state=ss.state,
+                            next_state=true_state,
+                            body=[ss.body.head(i)],
+                        )
+
+                    # Add the condition block (*body* is empty)
+                    cfg.add_bb(
+                        state=cond_state,
+                        next_state=final_state,
+                        cond=x.condition,
+                        jump_state=true_state,
+                    )
+
+                    break
+            else:
+                cfg.add_bb(ss.state, ss.next_state, body=[ss.body])
+
+        return cfg
+
+
+def get_cfg(
+    func: FunctionDefinition | ModifierDefinition, rng: random.Random | None = None
+) -> CFG:
+    """
+    Get the CFG of a function, it's built once and shared until the function
+    body changes. A new CFG draws its states from *rng*, see CFG.
+    """
+
+    cfg = func.__dict__.get("_cfg")
+    if cfg is None:
+        if not hasattr(func, "body"):
+            raise ValueError(f"{func} is not implemented, it has no CFG")
+        cfg = CFG.gen_cfg(func.body, rng)
+        func.__dict__["_cfg"] = cfg
+        NodeBase._cached_cfgs += 1
+    return cfg
@@ -0,0 +1,226 @@
+"""
+This module builds a struct-of-arrays view of a syntax tree for analyses that
+scan the whole tree, such as "find all t_rational expressions" or "which
+functions contain loops", without walking the Python object graph.
+
+Nodes are numbered in pre-order, so the subtree of node i is the range
+[i, end[i]) and a node is inside another one if its index falls in that range.
+Node types, names and type identifiers are interned into small tables and the
+columns hold their indices.
+"""
+
+from array import array
+from bisect import bisect_left
+from itertools import compress
+from typing import Iterable
+
+from .nodes import NodeBase
+
+NONE = -1
+
+
+class Columns:
+    """
+    Attributes:
+        types: node type of every node, an index into type_names
+        parent: index of the parent node, NONE for the root
+        end: one past the last node of the subtree of every node
+        start, length: source offsets from src, NONE if there is no src
+        name: the name of every node, an index into strings, NONE if unnamed
+        type_id: typeDescriptions.typeIdentifier, an index into strings, NONE
+            if there is none
+        nodes: the NodeBase of every node if the view is built from a tree
+    """
+
+    def __init__(self):
+        self.types = array("H")
+        self.parent = array("i")
+        self.end = array("i")
+        self.start = array("i")
+        self.length = array("i")
+        self.name = array("i")
+        self.type_id = array("i")
+
+        self.type_names: list[str] = []
+        self.strings: list[str] = []
+        self.nodes: list[NodeBase] | None = None
+
+        self._type_index: dict[str, int] = {}
+        self._string_index: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def _intern(self, table: list, index: dict, value: str) -> int:
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(table)
+            table.append(value)
+        return i
+
+    def _add(
+        self,
+        parent: int,
+        node_type: str,
+        src: str | None,
+        name: str | None,
+        type_id: str | None,
+    ) -> int:
+        i = len(self.types)
+        node_type = self._intern(self.type_names, self._type_index, node_type)
+        self.types.append(node_type)
+        self.parent.append(parent)
+        self.end.append(i + 1)
+        if src is not None:
+            start, length, _ = src.split(":", 2)
+            self.start.append(int(start))
+            self.length.append(int(length))
+        else:
+            self.start.append(NONE)
+            self.length.append(NONE)
+        for column, value in ((self.name, name), (self.type_id, type_id)):
+            if isinstance(value, str):
+                value = self._intern(self.strings, self._string_index, value)
+            else:
+                value = NONE
+            column.append(value)
+        return i
+
+    @classmethod
+    def from_tree(cls, root: NodeBase) -> "Columns":
+        """Build the view of a tree in one pass, shared leaves are in every use."""
+        view = cls()
+        view.nodes = []
+        # (node, parent index), None marks the end of the subtree on top
+        stack = [(root, NONE)]
+        opened = []
+        while len(stack) > 0:
+            entry = stack.pop()
+            if entry is None:
+                i = opened.pop()
+                view.end[i] = len(view.types)
+                continue
+
+            node, parent = entry
+            node_type = (
+                node.nodeType if "nodeType" in node._fields else type(node).__name__
+            )
+            types = node.__dict__.get("typeDescriptions")
+            i = view._add(
+                parent,
+                node_type,
+                node._src,
+                node.__dict__.get("name"),
+                types.get("typeIdentifier") if isinstance(types, dict) else None,
+            )
+            view.nodes.append(node)
+            opened.append(i)
+            stack.append(None)
+
+            children = []
+            for key, value in node.__dict__.items():
+                if key not in node._fields:
+                    continue
+                if isinstance(value, NodeBase):
+                    children.append(value)
+                elif isinstance(value, list):
+                    children.extend(v for v in value if isinstance(v, NodeBase))
+            stack.extend((c, i) for c in reversed(children))
+        return view
+
+    @classmethod
+    def from_json(cls, ast: dict) -> "Columns":
+        """Build the view straight from a solc AST, no NodeBase is created."""
+        view = cls()
+        stack = [(ast, NONE)]
+        opened = []
+        while len(stack) > 0:
+            entry = stack.pop()
+            if entry is None:
+                i = opened.pop()
+                view.end[i] = len(view.types)
+                continue
+
+            node, parent = entry
+            types = node.get("typeDescriptions")
+            i = view._add(
+                parent,
+                node["nodeType"],
+                node.get("src"),
+                node.get("name"),
+                types.get("typeIdentifier") if isinstance(types, dict) else None,
+            )
+            opened.append(i)
+            stack.append(None)
+
+            children = []
+            for value in node.values():
+                if isinstance(value, dict) and "nodeType" in value:
+                    children.append(value)
+                elif isinstance(value, list):
+                    children.extend(
+                        v for v in value if isinstance(v, dict) and "nodeType" in v
+                    )
+            stack.extend((c, i) for c in reversed(children))
+        return view
+
+    def find(self, *node_types: str) -> list[int]:
+        """Indices of the nodes of *node_types*, in pre-order."""
+        wanted = {self._type_index[t] for t in node_types if t in self._type_index}
+        return list(
+            compress(range(len(self.types)), map(wanted.__contains__, self.types))
+        )
+
+    def with_type(self, prefix: str) -> list[int]:
+        """Indices of the nodes whose typeIdentifier starts with *prefix*."""
+        wanted = {i for i, s in enumerate(self.strings) if s.startswith(prefix)}
+        return list(
+            compress(range(len(self.type_id)), map(wanted.__contains__, self.type_id))
+        )
+
+    def children(self, i: int) -> Iterable[int]:
+        """Direct children of node *i*, in order."""
+        child = i + 1
+        while child < self.end[i]:
+            yield child
+            child = self.end[child]
+
+    def ancestors(self, i: int) -> Iterable[int]:
+        i = self.parent[i]
+        while i != NONE:
+            yield i
+            i = self.parent[i]
+
+    def count_within(self, scope_type: str, *node_types: str) -> dict[int, int]:
+        """
+        Count the nodes of *node_types* in every node of *scope_type*, e.g.
+        the identifiers of every function.
+
+        Returns:
+            out: {scope index: count}
+        """
+        found = self.find(*node_types)
+        return {
+            i: bisect_left(found, self.end[i]) - bisect_left(found, i + 1)
+            for i in self.find(scope_type)
+        }
+
+    def containing(self, scope_type: str, *node_types: str) -> list[int]:
+        """Nodes of *scope_type* that contain a node of *node_types*."""
+        counts = self.count_within(scope_type, *node_types)
+        return [i for i, n in counts.items() if n > 0]
+
+    def type_name(self, i: int) -> str:
+        return self.type_names[self.types[i]]
+
+    def name_of(self, i: int) -> str | None:
+        return self.strings[self.name[i]] if self.name[i] != NONE else None
+
+    def type_of(self, i: int) -> str | None:
+        return self.strings[self.type_id[i]] if self.type_id[i] != NONE else None
+
+    def node(self, i: int) -> NodeBase:
+        """The NodeBase of node *i*, only if the view is built from a tree."""
+        if self.nodes is None:
+            raise ValueError("The view is built from JSON, it has no nodes")
+        return self.nodes[i]
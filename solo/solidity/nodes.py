@@ -50,33 +50,59 @@ class NodeBase:
         offset: Absolute source offsets as a (start, stop) tuple
         contract_id: Contract ID as given by the standard compiler JSON
 
+        _src: The "start:length:contract_id" string offset and contract_id are
+            parsed from
+
         _fields: List of syntax attributes for this node
         _parent: Reference to the parent node in the AST
         _children: Dictionary with key pair {object : attribute_name}
+        _shared: Flyweight leaf shared by many parents, it has no parent and
+            is not in their children, see utils.LEAF()
     """
 
+    _shared = False
+    # Number of CFGs cached on function nodes, an upper bound as the functions
+    # may be gone already. Nothing to drop if it's 0, see _invalidate()
+    _cached_cfgs = 0
+
     def _bind(self, node: "NodeBase", key: str) -> "NodeBase":
         """
-        If the node already has a parent, we make a deepcopy of it to avoid
-        dangling children pointers.
+        If the node already has a parent, we make a copy of it to avoid
+        dangling children pointers, see clone().
         """
 
+        if node._shared:
+            return node
+
         if node._parent is not self:
             if node._parent is not None:
-                # Save the original parent to prevent deepcopy() from copying
-                # the parent node
-                saved_parent, node._parent = node._parent, None
-                temp = deepcopy(node)
-                node._parent = saved_parent
-                node = temp
+                node = node.clone()
             node._parent = self
             self._children[node] = key
+            self._invalidate()
         return node
 
     def _unbind(self, node: "NodeBase"):
         if node._parent is self:
             del self._children[node]
             node._parent = None
+            self._invalidate()
+
+    def _invalidate(self):
+        """
+        The subtree has changed, drop the cached CFG of the enclosing function
+        (see cfg.py) if there is one.
+        """
+
+        if NodeBase._cached_cfgs == 0:
+            return
+
+        node = self
+        while node is not None:
+            if node.__dict__.pop("_cfg", None) is not None:
+                NodeBase._cached_cfgs -= 1
+                break
+            node = node._parent
 
     class NodeList(list):
 
@@ -221,16 +247,11 @@ class NodeBase:
         self.__dict__[name] = value
 
     def __init__(self, **ast: dict):
-        if "src" in ast:
-            src: str = ast.pop("src")
-            src = [int(i) for i in src.split(":")]
-            self.offset = (src[0], src[0] + src[1])
-            self.contract_id = src[2]
-        else:
-            self.offset = (0, 0)
-            self.contract_id = -1
+        # Parsed lazily, see offset and contract_id
+        self._src: str | None = ast.pop("src", None)
 
-        self._fields: set = set()
+        # Ordered, so that walks over the fields are deterministic
+        self._fields: dict = {}
         self._parent: "NodeBase" = None
         self._children: dict = {}
 
@@ -240,9 +261,108 @@ class NodeBase:
             if isinstance(value, (dict, list)):
                 value = node_class_factory(ast=value)
 
-            self._fields.add(key)
+            self._fields[key] = None
             self.__setattr__(key, value)
 
+    @classmethod
+    def make(cls, **fields) -> "NodeBase":
+        """
+        Fast constructor for nodes built in code, see utils.SYM() etc. Values
+        are nodes, lists or plain values and are set directly, no AST dict is
+        converted. Children without a parent are adopted in bulk, the others
+        are copied as in _bind().
+        """
+        self = cls.__new__(cls)
+        children = {}
+        d = self.__dict__
+        d["_src"] = None
+        d["_fields"] = dict.fromkeys(fields)
+        d["_parent"] = None
+        d["_children"] = children
+        d["__setattr__"] = self._setattr
+
+        for key, value in fields.items():
+            if isinstance(value, NodeBase) and not value._shared:
+                if value._parent is None:
+                    value._parent = self
+                    children[value] = key
+                else:
+                    value = self._bind(value, key)
+            elif isinstance(value, list):
+                items = NodeBase.NodeList((), parent=self, parent_key=key)
+                for v in value:
+                    if isinstance(v, NodeBase) and not v._shared:
+                        if v._parent is None:
+                            v._parent = self
+                            children[v] = key
+                        else:
+                            v = self._bind(v, key)
+                    list.append(items, v)
+                value = items
+            d[key] = value
+        return self
+
+    def _copy(self) -> "NodeBase":
+        """A detached copy of this node alone, without its children."""
+        node = type(self).__new__(type(self))
+        d = node.__dict__
+        for key, value in self.__dict__.items():
+            # The cached CFG belongs to the original subtree
+            if key not in ("_parent", "_children", "__setattr__", "_cfg"):
+                d[key] = value
+        d["_fields"] = dict(self._fields)
+        d["_parent"] = None
+        d["_children"] = {}
+        d["__setattr__"] = node._setattr
+        return node
+
+    def clone(self, share: bool = True) -> "NodeBase":
+        """
+        Copy the subtree iteratively, unlike deepcopy() it doesn't recurse, so
+        deep trees don't hit the recursion limit, and the parent and children
+        bookkeeping is rebuilt directly. Shared leaves stay shared.
+
+        Arguments:
+            share: share the plain dicts of the fields, such as
+                typeDescriptions, which are never modified in place, otherwise
+                they are deep-copied
+
+        Returns:
+            out: the copy, it has no parent
+        """
+        root = self._copy()
+        stack = [(self, root)]
+
+        def copy_value(value, key: str, parent: "NodeBase"):
+            if isinstance(value, NodeBase):
+                if value._shared:
+                    return value
+                child = value._copy()
+                child.__dict__["_parent"] = parent
+                parent._children[child] = key
+                stack.append((value, child))
+                return child
+            if isinstance(value, dict) and not share:
+                return deepcopy(value)
+            return value
+
+        while len(stack) > 0:
+            node, copied = stack.pop()
+            d = copied.__dict__
+            for key in node._fields:
+                if key not in node.__dict__:
+                    continue
+                value = node.__dict__[key]
+                if isinstance(value, list):
+                    items = NodeBase.NodeList((), parent=copied, parent_key=key)
+                    for v in value:
+                        list.append(items, copy_value(v, key, copied))
+                    value = items
+                else:
+                    value = copy_value(value, key, copied)
+                d[key] = value
+        return root
+
     def __repr__(self) -> str:
         repr_str = f"<{type(self).__name__}"
         if isinstance(self, IterableNodeBase):
@@ -260,6 +380,19 @@ class NodeBase:
     def tokenize(self, sb: "SourceBuilder"):
         pass
 
+    @property
+    def offset(self) -> tuple[int, int]:
+        if self._src is None:
+            return (0, 0)
+        start, length, _ = self._src.split(":")
+        return (int(start), int(start) + int(length))
+
+    @property
+    def contract_id(self) -> int:
+        if self._src is None:
+            return -1
+        return int(self._src.rsplit(":", 1)[1])
+
     @property
     def children(self) -> dict:
         return self._children
@@ -269,7 +402,7 @@ class NodeBase:
         return self._parent
 
     @property
-    def fields(self) -> set:
+    def fields(self) -> dict:
         return self._fields
 
 
@@ -665,7 +798,9 @@ class VariableDeclarationStatement(NodeBase):
             sb.add_tuple(self.declarations)
         else:
             sb.add(self.declarations[0])
-        sb.add("=").add(self.initialValue)
+        # The initial value is optional, i.e. uint x;
+        if getattr(self, "initialValue", None) is not None:
+            sb.add("=").add(self.initialValue)
         # Special case in for statement:
         # Variable declaration statement is used as an expression
         if not (
@@ -876,7 +1011,8 @@ def node_class_factory(ast):
         if node_type not in globals():
             # raise NotImplementedError(f"Node of type {node_type} isn't supported yet!")
             logger.warning(f"Node of type {node_type} isn't supported yet!")
-            return NodeBase(**ast)
+            # Keep the node type for to_ast()
+            return NodeBase(nodeType=node_type, **ast)
 
         return globals()[node_type](**ast)
 
@@ -893,13 +1029,29 @@ class SourceBuilder:
     Arguments:
         verbose(bool): verbose mode, if turned on, output indented source
         indent(int): indent width, default 4
+        source_map(bool): record the (start, stop) offsets of every node in the
+            output in *positions*, a list of (start, stop, node)
     """
 
-    def __init__(self, verbose: bool = False, indent: int = 4):
+    class _End:
+        """Marks the end of a node on the pre-order stack."""
+
+        def __init__(self, node: NodeBase, start: int):
+            self.node = node
+            self.start = start
+
+    def __init__(
+        self, verbose: bool = False, indent: int = 4, source_map: bool = False
+    ):
         self.tokens: list = []
         self.cache: deque = deque()
         self.verbose = verbose
         self.indent = indent
+        self.source_map = source_map
+        self.positions: list = []
+        # Length of the output so far in UTF-8 bytes, as solc's source
+        # locations are, iff. source_map is on
+        self.length = 0
 
         if verbose is True:
             self.x_semicolon = ";\n"
@@ -918,7 +1070,10 @@ class SourceBuilder:
             last = self.tokens[-1]
             if token[0] in AZAZ09DOLLAR_ and last[-1] in AZAZ09DOLLAR_:
                 self.tokens.append(" ")
+                self.length += 1
         self.tokens.append(token)
+        if self.source_map:
+            self.length += len(token.encode())
 
     def add(self, item: str | NodeBase) -> "SourceBuilder":
         """Add an item to temporary cache."""
@@ -1019,9 +1174,13 @@ class SourceBuilder:
             # a node
             # We need to split it into tokens and subnodes and put 'em back to stack
             elif isinstance(x, NodeBase):
+                if self.source_map is True:
+                    pre_ord_stack.append(SourceBuilder._End(x, self.length))
                 x.tokenize(sb=self)
                 pre_ord_stack.extend(self.cache)
                 self.cache.clear()
+            elif isinstance(x, SourceBuilder._End):
+                self.positions.append((x.start, self.length, x.node))
             # Undefined behaviors goes here
             else:
                 logger.error(
@@ -1030,4 +1189,5 @@ class SourceBuilder:
 
         result = "".join(self.tokens)
         self.tokens.clear()
+        self.length = 0
         return result
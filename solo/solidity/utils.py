@@ -5,6 +5,7 @@ Author: Yu 'goudunz1' Sheng
 """
 
 import json
+import sys
 from pathlib import Path
 from functools import partial
 from typing import Any
@@ -14,30 +15,112 @@ from .nodes import *
 
 def from_standard_output_json(path):
     """
-    Generates SourceUnit objects from a standard output json file.
+    Generates SourceUnit objects from a standard output json file, the whole
+    file is loaded, see artifacts.load_artifact() for big ones.
 
     Arguments:
         path: path to the json file
     """
 
-    output_json = json.load(Path(path).open())
+    with Path(path).open() as fp:
+        output_json = json.load(fp)
     return from_standard_output(output_json)
 
 
-def from_standard_output(output_json):
+def from_standard_output(output_json, fields: set | None = None):
     """
-    Generates SourceUnit objects from a standard output json as a dict.
+    Generates SourceUnit objects from a standard output json as a dict, the
+    ASTs in it are consumed, pass a copy to load them again.
 
     Arguments:
         output_json: dict of standard compiler output
+        fields: annotations to keep, the other ones are dropped, see project()
     """
 
-    source_nodes = [
-        node_class_factory(v["ast"]) for v in output_json["sources"].values()
-    ]
+    source_nodes = []
+    for v in output_json["sources"].values():
+        ast = v["ast"] if fields is None else project(v["ast"], fields)
+        source_nodes.append(node_class_factory(ast))
     return source_nodes
 
 
+# Annotations solc adds to the syntax, SourceBuilder never reads them and the
+# plugins declare the ones they need in FIELDS
+ANNOTATIONS = {
+    "argumentTypes",
+    "baseFunctions",
+    "canonicalName",
+    "contractDependencies",
+    "documentation",
+    "errorSelector",
+    "eventSelector",
+    "exportedSymbols",
+    "fullyImplemented",
+    "functionSelector",
+    "implemented",
+    "internalFunctionIDs",
+    "isConstant",
+    "isLValue",
+    "isPure",
+    "lValueRequested",
+    "linearizedBaseContracts",
+    "nameLocation",
+    "nameLocations",
+    "overloadedDeclarations",
+    "referencedDeclaration",
+    "scope",
+    "stateVariable",
+    "typeDescriptions",
+    "usedErrors",
+    "usedEvents",
+}
+
+# String members repeated all over the tree
+INTERNED = {
+    "kind",
+    "mutability",
+    "name",
+    "nodeType",
+    "operator",
+    "stateMutability",
+    "storageLocation",
+    "typeIdentifier",
+    "typeString",
+    "visibility",
+}
+
+
+def project(ast: dict, fields: set = set()) -> dict:
+    """
+    Drop the annotations not in *fields* from a raw AST in place, intern the
+    repeated strings and share equal typeDescriptions, which are read-only.
+    """
+
+    drop = ANNOTATIONS - fields
+    types = {}
+    stack = [ast]
+    while len(stack) > 0:
+        x = stack.pop()
+        if isinstance(x, list):
+            stack.extend(x)
+            continue
+        if not isinstance(x, dict):
+            continue
+
+        for key in drop & x.keys():
+            del x[key]
+        for key, value in x.items():
+            if isinstance(value, str):
+                if key in INTERNED:
+                    x[key] = sys.intern(value)
+            elif key == "typeDescriptions":
+                type_key = (value.get("typeIdentifier"), value.get("typeString"))
+                x[key] = types.setdefault(type_key, value)
+            elif isinstance(value, (dict, list)):
+                stack.append(value)
+    return ast
+
+
 def from_ast(ast):
     """
     Generates a SourceUnit object from the given AST. Dependencies are not set.
@@ -46,6 +129,148 @@ def from_ast(ast):
     return node_class_factory(ast)
 
 
+# Members solc's AST importer requires but our generated nodes may lack, the
+# nullable ones must be present as null. Name locations must be strings,
+# "-1:-1:-1" is no location
+NO_LOCATION = "-1:-1:-1"
+AST_DEFAULTS = {
+    "SourceUnit": {"absolutePath": "temp.sol", "exportedSymbols": {}, "license": None},
+    "ContractDefinition": {
+        "abstract": False,
+        "baseContracts": [],
+        "contractKind": "contract",
+        "documentation": None,
+        "nameLocation": NO_LOCATION,
+    },
+    "InheritanceSpecifier": {"arguments": None},
+    "FunctionDefinition": {
+        "documentation": None,
+        "modifiers": [],
+        "nameLocation": NO_LOCATION,
+        "overrides": None,
+        "virtual": False,
+    },
+    "ModifierDefinition": {
+        "documentation": None,
+        "nameLocation": NO_LOCATION,
+        "overrides": None,
+        "virtual": False,
+    },
+    "ModifierInvocation": {"arguments": None},
+    "EventDefinition": {
+        "anonymous": False,
+        "documentation": None,
+        "nameLocation": NO_LOCATION,
+    },
+    "ErrorDefinition": {"documentation": None, "nameLocation": NO_LOCATION},
+    "StructDefinition": {"documentation": None, "nameLocation": NO_LOCATION},
+    "EnumDefinition": {"documentation": None, "nameLocation": NO_LOCATION},
+    "EnumValue": {"nameLocation": NO_LOCATION},
+    "UserDefinedValueTypeDefinition": {"nameLocation": NO_LOCATION},
+    "VariableDeclaration": {
+        "constant": False,
+        "documentation": None,
+        "mutability": "mutable",
+        "nameLocation": NO_LOCATION,
+        "overrides": None,
+        "storageLocation": "default",
+        "value": None,
+        "visibility": "internal",
+    },
+    "VariableDeclarationStatement": {"initialValue": None},
+    "ArrayTypeName": {"length": None},
+    "Mapping": {
+        "keyName": "",
+        "keyNameLocation": NO_LOCATION,
+        "valueName": "",
+        "valueNameLocation": NO_LOCATION,
+    },
+    "Identifier": {"overloadedDeclarations": []},
+    "Literal": {"subdenomination": None},
+    "FunctionCall": {"names": [], "nameLocations": [], "tryCall": False},
+    "MemberAccess": {"memberLocation": NO_LOCATION},
+    "IndexAccess": {"indexExpression": None},
+    "IfStatement": {"falseBody": None},
+    "ForStatement": {
+        "condition": None,
+        "initializationExpression": None,
+        "loopExpression": None,
+    },
+    "Return": {"expression": None},
+    "TupleExpression": {"isInlineArray": False},
+}
+
+
+def to_ast(node: NodeBase) -> dict:
+    """
+    Serialise a (mutated) tree back to solc's compact AST JSON, so that it can
+    be compiled with the "SolidityAST" input language without building and
+    parsing the source text.
+
+    Generated nodes get fresh ids and the members solc requires, nodes copied
+    from others get fresh ids as well since ids must be unique. Annotations
+    such as typeDescriptions and referencedDeclaration are kept as they are,
+    solc analyses the imported tree again anyway. The tree must be loaded
+    with all its members, projected trees lack some that solc requires.
+    """
+
+    next_id = 0
+    stack = [node]
+    while len(stack) > 0:
+        n = stack.pop()
+        if isinstance(getattr(n, "id", None), int) and "id" in n._fields:
+            next_id = max(next_id, n.id + 1)
+        stack.extend(n._children)
+
+    seen_ids = set()
+
+    # Iterative, trees can be deeper than the recursion limit. Every entry is
+    # (value, container, key), the exported value goes to container[key]
+    holder = [None]
+    stack = [(node, holder, 0)]
+    while len(stack) > 0:
+        n, container, key = stack.pop()
+        if isinstance(n, list):
+            items = container[key] = [None] * len(n)
+            stack.extend((n[i], items, i) for i in reversed(range(len(n))))
+            continue
+        if not isinstance(n, NodeBase):
+            container[key] = n
+            continue
+
+        node_type = n.nodeType if "nodeType" in n._fields else type(n).__name__
+        ast = {"nodeType": node_type, "src": n._src or "0:0:-1"}
+        container[key] = ast
+
+        # Members set here, the others are exported as they are
+        node_id = getattr(n, "id", None) if "id" in n._fields else None
+        if not isinstance(node_id, int) or node_id in seen_ids:
+            node_id = next_id
+            next_id += 1
+        seen_ids.add(node_id)
+        fixed = {"nodeType": node_type, "id": node_id}
+        if node_type == "Literal" and isinstance(getattr(n, "value", None), str):
+            # solc reads the value from hexValue, the hex of the value text,
+            # generated literals have the number in it instead
+            fixed["hexValue"] = n.value.encode().hex()
+
+        fields = [k for k in n._fields if k not in fixed]
+        for k in n._fields:
+            if k != "nodeType":
+                ast[k] = fixed.get(k)
+        stack.extend((getattr(n, k), ast, k) for k in reversed(fields))
+
+        for k, value in {**fixed, **AST_DEFAULTS.get(node_type, {})}.items():
+            if k not in ast:
+                ast[k] = deepcopy(value)
+        if node_type == "FunctionDefinition":
+            ast.setdefault("implemented", getattr(n, "body", None) is not None)
+        elif node_type == "VariableDeclaration":
+            ast.setdefault("stateVariable", isinstance(n.parent, ContractDefinition))
+
+    return holder[0]
+
+
 def replace_with(node: NodeBase, new_node: NodeBase):
     """
     Replace node with a new node, update the parental relationship.
@@ -55,6 +280,9 @@ def replace_with(node: NodeBase, new_node: NodeBase):
         new_node(NodeBase): the new node
     """
 
+    if node._shared:
+        raise ValueError(f"{node} is a shared leaf, it has no parent to update")
+
     parent = node.parent
     parent_key = parent.children[node]
     object = getattr(parent, parent_key)
@@ -65,53 +293,129 @@ def replace_with(node: NodeBase, new_node: NodeBase):
     if isinstance(object, list):
         object[object.index(node)] = new_node
     else:
-        setattr(parent, parent_key, new_node)
+        parent.__setattr__(parent_key, new_node)
 
 
-def SYM(name: str) -> Identifier:
-    """Wrapper for a name in source code, AKA. identifier."""
-    return Identifier(name=name)
+# Flyweight leaves shared by all jobs, {(class, fields): node}. Only leaves
+# that are never renamed belong here, such as type names and fixed numbers,
+# the others are cached per job, see Context.leaves
+LEAVES = {}
 
 
-def NUM(value: int) -> Literal:
+def LEAF(cls: type, leaves: dict, **fields) -> NodeBase:
+    """
+    A leaf shared by all its uses instead of a new node, for the identical
+    leaves generated code repeats thousands of times. *leaves* is the cache
+    the leaf is taken from, {(class, fields): node}.
+
+    A shared leaf has no parent and is not in the children of the nodes using
+    it, so walks over children skip it and it can't be replaced, only leaves
+    that are never rewritten afterwards should be shared. Renaming one in
+    place renames all its uses, as renaming does by name anyway.
     """
-    A number, big numbers are represented as hex values.
+    key = (cls, tuple(fields.items()))
+    leaf = leaves.get(key)
+    # A renamed leaf no longer matches its key
+    if leaf is None or any(leaf.__dict__.get(k) != v for k, v in fields.items()):
+        leaf = cls.make(**fields)
+        leaf.__dict__["_shared"] = True
+        leaves[key] = leaf
+    return leaf
+
+
+def SYM(name: str, leaves: dict | None = None) -> Identifier:
+    """
+    Wrapper for a name in source code, AKA. identifier. Names that won't be
+    replaced can be shared through the cache *leaves*, see LEAF().
+    """
+    if leaves is not None:
+        return LEAF(Identifier, leaves, name=name)
+    return Identifier.make(name=name)
+
+
+def NUM(value: int, leaves: dict | None = None) -> Literal:
+    """
+    A number, big numbers are represented as hex values. Numbers that won't be
+    replaced can be shared through the cache *leaves*, see LEAF().
 
     Note that literal numbers are always positive.
     """
-    return Literal(
-        kind="number",
-        hexValue=hex(value),
-        value=hex(value) if value > 255 else str(value),
-    )
+    fields = {
+        "kind": "number",
+        "hexValue": hex(value),
+        "value": hex(value) if value > 255 else str(value),
+    }
+    if leaves is not None:
+        return LEAF(Literal, leaves, **fields)
+    return Literal.make(**fields)
 
 
 def BLK(statements: list) -> Block:
     """Wrapper for a list of statements in source code, AKA. block."""
-    return Block(statements=statements)
+    return Block.make(statements=statements)
+
+
+def UNCHECKED(statements: list) -> UncheckedBlock:
+    """Wrapper for a list of statements in an unchecked block."""
+    return UncheckedBlock.make(statements=statements)
+
+
+def in_unchecked(node: NodeBase) -> bool:
+    """Check if the node is evaluated inside an unchecked block."""
+    curr = node.parent
+    while curr is not None:
+        if isinstance(curr, UncheckedBlock):
+            return True
+        # Unchecked blocks do not cross function boundaries
+        elif isinstance(curr, (FunctionDefinition, ModifierDefinition)):
+            return False
+        curr = curr.parent
+    return False
+
+
+def in_constant(node: NodeBase) -> bool:
+    """
+    Check if the node must be a compile-time constant, i.e. it's in the value
+    of a constant variable or in an array length, where no function can be
+    called.
+    """
+    curr = node.parent
+    while curr is not None:
+        if isinstance(curr, ArrayTypeName):
+            return True
+        elif isinstance(curr, VariableDeclaration) and curr.__dict__.get(
+            "constant", False
+        ):
+            return True
+        elif isinstance(curr, (FunctionDefinition, ModifierDefinition)):
+            return False
+        curr = curr.parent
+    return False
 
 
 def PAREN(sub_expr: NodeBase) -> TupleExpression:
     """A pair parentheses."""
-    return TupleExpression(components=[sub_expr], isInlineArray=False)
+    return TupleExpression.make(components=[sub_expr], isInlineArray=False)
 
 
 def TUPLE(components: list, is_arr: bool = False) -> TupleExpression:
     """A true tuple(list) with list of components."""
-    return TupleExpression(components=components, isInlineArray=is_arr)
+    return TupleExpression.make(components=components, isInlineArray=is_arr)
 
 
 def ASSIGN(left: NodeBase, right: NodeBase) -> ExpressionStatement:
     """An assignment statement [left]=[right];"""
-    assignment = Assignment(leftHandSide=left, operator="=", rightHandSide=right)
-    return ExpressionStatement(expression=assignment)
+    assignment = Assignment.make(
+        leftHandSide=left, operator="=", rightHandSide=right
+    )
+    return ExpressionStatement.make(expression=assignment)
 
 
 def FOR(
     init_expr: NodeBase, cond: NodeBase, loop_expr: NodeBase, body: Block
 ) -> ForStatement:
     """A for statement."""
-    return ForStatement(
+    return ForStatement.make(
         initializationExpression=init_expr,
         condition=cond,
         loopExpression=loop_expr,
@@ -124,37 +428,79 @@ def IF(
 ) -> IfStatement:
     """An if statement with(out) false branch."""
     if false_body is not None:
-        return IfStatement(
+        return IfStatement.make(
             condition=cond,
             trueBody=true_body,
             falseBody=false_body,
         )
     else:
-        return IfStatement(condition=cond, trueBody=true_body)
+        return IfStatement.make(condition=cond, trueBody=true_body)
 
 
 def WHILE(cond: NodeBase, body: Block, do=False) -> DoWhileStatement | WhileStatement:
     """A (do-)while loop."""
     if do is True:
-        return DoWhileStatement(condition=cond, body=body)
+        return DoWhileStatement.make(condition=cond, body=body)
     else:
-        return WhileStatement(condition=cond, body=body)
+        return WhileStatement.make(condition=cond, body=body)
 
 
 def FUNCALL(name: str, args: list, names: list = []) -> FunctionCall:
     """Call a function, or more precisely, generate a call instruction to a function."""
-    return FunctionCall(expression=SYM(name), arguments=args, names=names)
+    return FunctionCall.make(expression=SYM(name), arguments=args, names=names)
+
+
+def FUNC(
+    name: str,
+    params: list,
+    returns: list,
+    body: list,
+    visibility: str = "internal",
+    mutability: str = "pure",
+    kind: str = "function",
+) -> FunctionDefinition:
+    """
+    A function definition without modifiers, use kind="freeFunction" for
+    functions outside of contracts.
+    """
+    return FunctionDefinition.make(
+        kind=kind,
+        name=name,
+        parameters=ParameterList.make(parameters=params),
+        visibility=visibility,
+        stateMutability=mutability,
+        modifiers=[],
+        virtual=False,
+        returnParameters=ParameterList.make(parameters=returns),
+        body=BLK(body),
+    )
+
+
+def UNCHECKED_FUNC(
+    etype: str, name: str, params: list[str], expr: NodeBase
+) -> FunctionDefinition:
+    """
+    A free pure function returning *expr* evaluated in an unchecked block, all
+    the parameters and the return value are of the elementary type *etype*.
+    """
+    return FUNC(
+        name=name,
+        params=[EVAR(etype, p, None) for p in params],
+        returns=[EVAR(etype, "", None)],
+        body=[UNCHECKED([Return.make(expression=expr)])],
+        kind="freeFunction",
+    )
 
 
 def ETYPE(name: str) -> ElementaryTypeName:
-    """Wrapper for an elementary in source code, AKA. type"""
-    return ElementaryTypeName(name=name)
+    """Wrapper for an elementary in source code, AKA. type, it's shared."""
+    return LEAF(ElementaryTypeName, LEAVES, name=name)
 
 
 def ETYPECONV(name: str, expr: NodeBase) -> FunctionCall:
     """Explicit conversion of an elementary."""
-    return FunctionCall(
-        expression=ElementaryTypeNameExpression(typeName=ETYPE(name)),
+    return FunctionCall.make(
+        expression=ElementaryTypeNameExpression.make(typeName=ETYPE(name)),
         kind="typeConversion",
         arguments=[expr],
         names=[],
@@ -164,24 +510,30 @@ def ETYPECONV(name: str, expr: NodeBase) -> FunctionCall:
 def EVAR(
     etype: str,
     name: str,
-    value: int | None,
+    value: int | NodeBase | None,
     const: bool = False,
     mutability: str = "mutable",
     storage: str = "default",
     stmt: bool = False,
 ) -> VariableDeclaration:
-    """Declaration of an elementary variable."""
+    """
+    Declaration of an elementary variable, the initial value can be a number
+    or an expression.
+    """
+    if isinstance(value, int):
+        value = NUM(value)
+
     if stmt is False and value is not None:
-        return VariableDeclaration(
+        return VariableDeclaration.make(
             typeName=ETYPE(etype),
             constant=const,
             mutability=mutability,
             storageLocation=storage,
             name=name,
-            value=NUM(value),
+            value=value,
         )
     else:
-        var_dec = VariableDeclaration(
+        var_dec = VariableDeclaration.make(
             typeName=ETYPE(etype),
             constant=const,
             mutability=mutability,
@@ -189,11 +541,11 @@ def EVAR(
             name=name,
         )
         if stmt is True and value is not None:
-            return VariableDeclarationStatement(
-                declarations=[var_dec], initialValue=NUM(value)
+            return VariableDeclarationStatement.make(
+                declarations=[var_dec], initialValue=value
             )
         elif stmt is True and value is None:
-            return VariableDeclarationStatement(declarations=[var_dec])
+            return VariableDeclarationStatement.make(declarations=[var_dec])
         elif stmt is False:
             return var_dec
 
@@ -203,9 +555,9 @@ def ATYPE(
 ) -> ArrayTypeName:
     """Wrapper for an array type in source code."""
     if length is None:
-        return ArrayTypeName(baseType=base)
+        return ArrayTypeName.make(baseType=base)
     else:
-        return ArrayTypeName(baseType=base, length=length)
+        return ArrayTypeName.make(baseType=base, length=NUM(length))
 
 
 def AVAR(
@@ -220,7 +572,7 @@ def AVAR(
 ):
     """Declaration of an array variable."""
     if stmt is False and value is not None:
-        return VariableDeclaration(
+        return VariableDeclaration.make(
             typeName=ATYPE(base, length),
             constant=const,
             mutability=mutability,
@@ -229,7 +581,7 @@ def AVAR(
             value=TUPLE(value, is_arr=True),
         )
     else:
-        var_dec = VariableDeclaration(
+        var_dec = VariableDeclaration.make(
             typeName=ATYPE(base, length),
             constant=const,
             mutability=mutability,
@@ -237,11 +589,11 @@ def AVAR(
             name=name,
         )
         if stmt is True and value is not None:
-            return VariableDeclarationStatement(
+            return VariableDeclarationStatement.make(
                 declarations=[var_dec], initialValue=TUPLE(value, is_arr=True)
             )
         elif stmt is True and value is None:
-            return VariableDeclarationStatement(declarations=[var_dec])
+            return VariableDeclarationStatement.make(declarations=[var_dec])
         elif stmt is False:
             return var_dec
 
@@ -285,7 +637,7 @@ def BOP(operator: str, left: NodeBase, right: NodeBase) -> BinaryOperation:
         if right_pred >= curr_pred:
             right = PAREN(right)
 
-    return BinaryOperation(
+    return BinaryOperation.make(
         operator=operator, leftExpression=left, rightExpression=right
     )
 
@@ -337,7 +689,7 @@ def UOP(operator: str, sub_expr: NodeBase) -> UnaryOperation:
     if isinstance(sub_expr, BinaryOperation):
         sub_expr = PAREN(sub_expr)
 
-    return UnaryOperation(operator=operator, subExpression=sub_expr)
+    return UnaryOperation.make(operator=operator, subExpression=sub_expr)
 
 
 # P2
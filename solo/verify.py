@@ -0,0 +1,266 @@
+import logging
+
+import solcx
+from solcx.exceptions import SolcError
+
+from .solidity.nodes import ContractDefinition, SourceUnit
+from .solidity.utils import to_ast
+
+logger = logging.getLogger(__name__)
+
+
+def compile_errors(solc_input: dict) -> list[str]:
+    """Run solc on the standard json input and collect its error messages."""
+    try:
+        output_json = solcx.compile_standard(solc_input)
+    except SolcError as e:
+        # py-solc-x raises on errors, the errors are kept in the exception
+        errors = getattr(e, "error_dict", None) or [
+            {"severity": "error", "formattedMessage": str(e)}
+        ]
+        output_json = {"errors": errors}
+    return [
+        error.get("formattedMessage", error.get("message", ""))
+        for error in output_json.get("errors", [])
+        if error.get("severity") == "error"
+    ]
+
+
+def selection(codegen: bool) -> dict:
+    # abi needs the analysis only, bytecode needs the code generation as well
+    outputs = ["evm.bytecode.object"] if codegen else ["abi"]
+    return {"outputSelection": {"*": {"*": outputs}}}
+
+
+def verify_ast(root: SourceUnit, codegen: bool = False) -> list[str]:
+    """
+    Check that the tree compiles by importing it into solc as an AST, no
+    source text is built or parsed.
+
+    Arguments:
+        root: the tree to check
+        codegen: generate the bytecode as well, e.g. to catch "stack too
+            deep", otherwise only the analysis is run
+
+    Returns:
+        out: error messages, empty if it compiles
+    """
+    ast = to_ast(root)
+    path = ast.get("absolutePath", "temp.sol")
+    return compile_errors(
+        {
+            "language": "SolidityAST",
+            "sources": {path: {"ast": ast}},
+            "settings": selection(codegen),
+        }
+    )
+
+
+def verify_source(src: str, codegen: bool = False) -> list[str]:
+    """The same as verify_ast() but compiles the source text."""
+    return compile_errors(
+        {
+            "language": "Solidity",
+            "sources": {"temp.sol": {"content": src}},
+            "settings": selection(codegen),
+        }
+    )
+
+
+def normalize_abi(abi: list, names: dict[str, str] = {}) -> dict[str, dict]:
+    """
+    Key the ABI entries by their signatures, names are translated by *names*,
+    parameter names and internal types are left out.
+    """
+
+    def types(params: list) -> list:
+        return [
+            {k: v for k, v in p.items() if k not in ("name", "internalType")}
+            for p in params
+        ]
+
+    entries = {}
+    for entry in abi:
+        name = names.get(entry.get("name", ""), entry.get("name", ""))
+        inputs = types(entry.get("inputs", []))
+        sig = f"{entry['type']} {name}({','.join(p['type'] for p in inputs)})"
+        entries[sig] = {
+            "inputs": inputs,
+            "outputs": types(entry.get("outputs", [])),
+            "stateMutability": entry.get("stateMutability"),
+            "anonymous": entry.get("anonymous"),
+        }
+    return entries
+
+
+class BatchVerifier:
+    """
+    Collects the outputs of a run and compiles them with their originals in one
+    solc job. Errors are mapped back to the original file, contract and the
+    plugin that has generated the failing node, and the ABI of every output
+    contract is checked against its original.
+
+    Arguments:
+        codegen(bool): generate the bytecode as well, see verify_ast()
+        ignore_renaming(bool): compare the ABIs modulo renaming, members are
+            matched by their original names. Otherwise renamed external and
+            public members are reported, their selectors have changed
+    """
+
+    def __init__(self, codegen: bool = False, ignore_renaming: bool = False):
+        self.codegen = codegen
+        self.ignore_renaming = ignore_renaming
+        self.entries = []
+
+    def add(
+        self,
+        url: str,
+        src: str,
+        root: SourceUnit,
+        positions: list,
+        names: dict[int, str],
+        original: str | None = None,
+    ):
+        """
+        Arguments:
+            url: path of the original file
+            src: obfuscated source
+            root: obfuscated tree, nodes are tagged with the plugin that has
+                generated them, see Obfuscator.obfuscate()
+            positions: source map of *src* from SourceBuilder
+            names: {solc AST id: original name} of the contracts and their
+                members before obfuscation
+            original: the original source, read from *url* if None
+        """
+        self.entries.append(
+            {
+                "url": url,
+                "src": src,
+                "root": root,
+                "positions": positions,
+                "names": names,
+                "original": original,
+            }
+        )
+
+    def locate(self, entry: dict, offset: int) -> tuple[str | None, str | None]:
+        """Find the original contract and the plugin of the node at *offset*."""
+        best = None
+        for start, stop, node in entry["positions"]:
+            # Shared leaves have no parent to find the contract from
+            if node._shared:
+                continue
+            if start <= offset < stop:
+                if best is None or stop - start < best[1] - best[0]:
+                    best = (start, stop, node)
+        if best is None:
+            return None, None
+
+        # Nodes kept from the original have no plugin
+        plugin, contract = best[2].__dict__.get("_plugin"), None
+        node = best[2]
+        while node is not None:
+            if isinstance(node, ContractDefinition):
+                contract = entry["names"].get(getattr(node, "id", None), node.name)
+            node = node.parent
+        return contract, plugin
+
+    def run(self) -> list[dict]:
+        """
+        Returns:
+            out: problems found, each one is {"file", "contract", "plugin",
+                "message"}
+        """
+        if len(self.entries) == 0:
+            return []
+
+        sources = {}
+        for i, entry in enumerate(self.entries):
+            original = entry["original"]
+            if original is None:
+                with open(entry["url"], "r") as fp:
+                    original = fp.read()
+            sources[f"original/{i}.sol"] = {"content": original}
+            sources[f"output/{i}.sol"] = {"content": entry["src"]}
+
+        solc_input = {
+            "language": "Solidity",
+            "sources": sources,
+            "settings": selection(self.codegen),
+        }
+        try:
+            output_json = solcx.compile_standard(solc_input)
+        except SolcError as e:
+            output_json = {
+                "errors": getattr(e, "error_dict", None)
+                or [{"severity": "error", "formattedMessage": str(e)}]
+            }
+
+        problems = []
+        for error in output_json.get("errors", []):
+            if error.get("severity") != "error":
+                continue
+            location = error.get("sourceLocation", {})
+            kind, _, name = location.get("file", "").partition("/")
+            contract, plugin = None, None
+            if name != "":
+                entry = self.entries[int(name.split(".")[0])]
+                if kind == "output":
+                    contract, plugin = self.locate(entry, location.get("start", 0))
+                file = entry["url"]
+            else:
+                file = None
+            problems.append(
+                {
+                    "file": file,
+                    "contract": contract,
+                    "plugin": plugin if kind == "output" else "original",
+                    "message": error.get("formattedMessage", error.get("message")),
+                }
+            )
+
+        contracts = output_json.get("contracts", {})
+        for i, entry in enumerate(self.entries):
+            problems += self.check_abi(
+                entry,
+                contracts.get(f"original/{i}.sol", {}),
+                contracts.get(f"output/{i}.sol", {}),
+            )
+        return problems
+
+    def check_abi(self, entry: dict, original: dict, output: dict) -> list[dict]:
+        """Compare the ABI of every output contract with its original."""
+        problems = []
+        for contract in entry["root"].contracts:
+            old_name = entry["names"].get(getattr(contract, "id", None))
+            if old_name not in original or contract.name not in output:
+                continue
+
+            # {current name: original name} of the members
+            names = {}
+            if self.ignore_renaming:
+                for n in contract:
+                    old = entry["names"].get(getattr(n, "id", None))
+                    if old is not None and hasattr(n, "name"):
+                        names[n.name] = old
+
+            expected = normalize_abi(original[old_name]["abi"])
+            actual = normalize_abi(output[contract.name]["abi"], names)
+            for sig in expected.keys() | actual.keys():
+                if expected.get(sig) == actual.get(sig):
+                    continue
+                if sig not in actual:
+                    message = f"ABI entry {sig} is missing"
+                elif sig not in expected:
+                    message = f"ABI entry {sig} is added"
+                else:
+                    message = f"ABI entry {sig} has changed"
+                problems.append(
+                    {
+                        "file": entry["url"],
+                        "contract": old_name,
+                        "plugin": None,
+                        "message": message,
+                    }
+                )
+        return problems
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+import solcx
+
+from solo.obfuscator import Obfuscator
+from solo.verify import verify_ast
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PLUGINS = [
+    "opaqueConstants",
+    "opaquePredicates",
+    "dataFlowObfuscation",
+    "controlFlowFlatten",
+    "identifierRenaming",
+]
+
+
+@pytest.fixture(scope="module")
+def erc20() -> dict:
+    """Standard json input of tests/ERC20.sol, skips without a working solc."""
+    try:
+        solcx.get_solc_version()
+    except Exception as e:
+        pytest.skip(f"solc is not available: {e}")
+    with open(os.path.join(HERE, "ERC20.sol"), "r") as fp:
+        return {"language": "Solidity", "sources": {"temp.sol": {"content": fp.read()}}}
+
+
+@pytest.mark.parametrize("plugin", PLUGINS)
+def test_to_ast_compiles(erc20, plugin):
+    obfuscator = Obfuscator(plugins=[plugin])
+    nodes = obfuscator.compile(erc20)
+    if nodes is None:
+        pytest.skip("solc can't compile tests/ERC20.sol")
+
+    root = obfuscator.obfuscate(nodes[0], obfuscator.new_context(1))
+    assert verify_ast(root) == []
@@ -0,0 +1,35 @@
+import json
+import os
+from copy import deepcopy
+
+from solo.obfuscator import Obfuscator
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PLUGINS = [
+    "opaqueConstants",
+    "opaquePredicates",
+    "dataFlowObfuscation",
+    "controlFlowFlatten",
+    "identifierRenaming",
+]
+
+
+def load_output(name: str) -> dict:
+    """The solc standard json output in tests/<name>.output.json."""
+    with open(os.path.join(HERE, f"{name}.output.json"), "r") as fp:
+        return json.load(fp)
+
+
+def test_obfuscate_source_twice():
+    source = load_output("Constants")
+    before = deepcopy(source)
+
+    obfuscator = Obfuscator(plugins=PLUGINS)
+    first = obfuscator.obfuscate_source(source, seed=7)
+    assert source == before
+
+    second = obfuscator.obfuscate_source(source, seed=7)
+    assert source == before
+    assert first["sources"] == second["sources"]
+    assert first["replacements"] == second["replacements"]